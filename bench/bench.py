@@ -0,0 +1,265 @@
+# Benchmarks the mesher.py pipeline and the mesher binary on synthetic rasters.
+#
+# For each DEM size a fractal DEM, with flat areas and nodata holes, and a landcover raster are generated (seeded, so
+# every run and every commit sees the same data). Then every combination of size, error metric and with/without the
+# landcover as a category raster is run through mesher.py, and the mesher binary is run again on its own on the same
+# PLGS with --profile. Wall time, peak memory, triangle count and the per step breakdown of mesher.py's run report are
+# written to results_<git hash>.csv and steps_<git hash>.csv in the output directory. Everything runs offline.
+#
+#   python bench.py --sizes 256 512 --metrics rmse max_tol
+#   python bench.py --compare results/results_a19a8da.csv results/results_bc177a2.csv
+
+from osgeo import gdal, osr
+import numpy as np
+import argparse
+import subprocess
+import itertools
+import time
+import json
+import csv
+import os
+import sys
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+result_fields = ['commit', 'case', 'size', 'metric', 'category', 'pipeline_seconds', 'pipeline_maxrss_kb',
+                 'mesher_seconds', 'mesher_maxrss_kb', 'refine_seconds', 'vertices', 'triangles']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark mesher on synthetic DEMs and landcover')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 512, 1024], help='DEM sizes, in cells a side')
+    parser.add_argument('--metrics', nargs='+', default=['rmse', 'mean_tol', 'max_tol'], help='Error metrics to run')
+    parser.add_argument('--mesher', default=os.path.join(repo_dir, 'bin', 'Release', 'mesher'), help='mesher binary')
+    parser.add_argument('--out', default=os.path.join(repo_dir, 'bench', 'results'), help='Output directory')
+    parser.add_argument('--cellsize', type=float, default=30., help='DEM cell size in m')
+    parser.add_argument('--tolerance', type=float, default=10., help='Error tolerance of the DEM')
+    parser.add_argument('--category-frac', type=float, default=0.8, help='Landcover category fraction')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the synthetic rasters')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='Compare two results csv files and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.compare[0], args.compare[1])
+        return
+
+    if not os.path.exists(args.mesher):
+        print 'mesher binary %s does not exist, build it or pass --mesher' % args.mesher
+        exit(1)
+
+    commit = git_hash()
+    data_dir = os.path.join(args.out, 'data')
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+
+    results = []
+    steps = []
+    for size in args.sizes:
+        dem, lc = make_rasters(data_dir, size, args.cellsize, args.seed)
+
+        for metric, category in itertools.product(args.metrics, [False, True]):
+            case = 'dem%d_%s_%s' % (size, metric, 'lc' if category else 'nolc')
+            print 'Running ' + case
+
+            row, case_steps = run_case(args, case, dem, lc if category else None, size, metric)
+            row.update({'commit': commit, 'case': case, 'size': size, 'metric': metric, 'category': category})
+            results.append(row)
+            steps += [dict(s, commit=commit, case=case) for s in case_steps]
+
+    with open(os.path.join(args.out, 'results_%s.csv' % commit), 'w') as f:
+        writer = csv.DictWriter(f, result_fields)
+        writer.writeheader()
+        writer.writerows(results)
+
+    with open(os.path.join(args.out, 'steps_%s.csv' % commit), 'w') as f:
+        writer = csv.DictWriter(f, ['commit', 'case', 'name', 'seconds', 'maxrss_kb', 'children_maxrss_kb'])
+        writer.writeheader()
+        writer.writerows(steps)
+
+    print_table(results)
+
+
+# Short hash of the checked out commit, with -dirty if there are local changes
+def git_hash():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_dir).strip()
+        if subprocess.call(['git', 'diff', '--quiet', 'HEAD'], cwd=repo_dir) != 0:
+            commit += '-dirty'
+        return commit
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+# Fractal (1/f^beta) surface of n x n cells scaled to 0..1 from random phases
+def fractal_surface(n, beta, rng):
+    kx = np.fft.fftfreq(n)
+    k = np.sqrt(kx[:, np.newaxis] ** 2 + kx[np.newaxis, :] ** 2)
+    k[0, 0] = 1.
+
+    amplitude = k ** (-beta / 2.)
+    amplitude[0, 0] = 0.
+    phase = rng.uniform(0, 2 * np.pi, (n, n))
+
+    z = np.real(np.fft.ifft2(amplitude * np.exp(1j * phase)))
+    return (z - z.min()) / (z.max() - z.min())
+
+
+# dem_<size>.tif and lc_<size>.tif in data_dir, generated if they don't exist. The DEM is fractal terrain of ~2000 m
+# relief. Its lowest 15% is flattened into lakes, and randomly placed disks are nodata. The landcover is 5 classes
+# from a second, smoother, fractal with the lakes as a 6th class.
+def make_rasters(data_dir, size, cellsize, seed):
+    dem_fname = os.path.join(data_dir, 'dem_%d.tif' % size)
+    lc_fname = os.path.join(data_dir, 'lc_%d.tif' % size)
+    if os.path.exists(dem_fname) and os.path.exists(lc_fname):
+        return dem_fname, lc_fname
+
+    print 'Generating %d x %d rasters' % (size, size)
+    rng = np.random.RandomState(seed + size)
+
+    dem = 500. + 2000. * fractal_surface(size, 3.2, rng)
+
+    lake = np.percentile(dem, 15)
+    lakes = dem <= lake
+    dem[lakes] = lake
+
+    lc = fractal_surface(size, 4., rng)
+    lc = np.digitize(lc, np.percentile(lc, [20, 40, 60, 80])).astype(np.float32) + 1
+    lc[lakes] = 6
+
+    yy, xx = np.mgrid[0:size, 0:size]
+    for i in range(max(1, size // 128)):
+        cx, cy = rng.uniform(0.1, 0.9, 2) * size
+        r = rng.uniform(0.01, 0.04) * size
+        holes = (xx - cx) ** 2 + (yy - cy) ** 2 <= r ** 2
+        dem[holes] = -9999
+        lc[holes] = -9999
+
+    write_tif(dem_fname, dem, cellsize)
+    write_tif(lc_fname, lc, cellsize)
+    return dem_fname, lc_fname
+
+
+def write_tif(fname, data, cellsize):
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(26911)  # UTM 11N
+
+    ds = gdal.GetDriverByName('GTiff').Create(fname, data.shape[1], data.shape[0], 1, gdal.GDT_Float32)
+    ds.SetGeoTransform((500000., cellsize, 0., 5700000., 0., -cellsize))
+    ds.SetProjection(srs.ExportToWkt())
+    ds.GetRasterBand(1).SetNoDataValue(-9999)
+    ds.GetRasterBand(1).WriteArray(data)
+    ds = None
+
+
+# Runs cmd to completion with its output going to log. Returns the wall time and the peak resident memory, in KB, of
+# the process and all of its children
+def run(cmd, cwd, log):
+    with open(log, 'w') as f:
+        start = time.time()
+        p = subprocess.Popen(cmd, cwd=cwd, stdout=f, stderr=subprocess.STDOUT)
+        pid, status, usage = os.wait4(p.pid, 0)
+        seconds = time.time() - start
+
+    if status != 0:
+        print 'Failed: %s, see %s' % (' '.join(cmd), log)
+        exit(1)
+
+    return seconds, usage.ru_maxrss
+
+
+# Runs one case through mesher.py and then the mesher binary alone. Returns its row of the results and the steps of
+# mesher.py's run report
+def run_case(args, case, dem, lc, size, metric):
+    run_dir = os.path.join(args.out, 'runs', case)
+    if not os.path.isdir(run_dir):
+        os.makedirs(run_dir)
+
+    max_area = (size * args.cellsize) ** 2 / 50.
+    parameter_files = {}
+    if lc is not None:
+        parameter_files['landcover'] = {'file': lc, 'method': 'mode', 'tolerance': args.category_frac}
+
+    with open(os.path.join(run_dir, 'config.py'), 'w') as f:
+        f.write('dem_filename = %r\n' % dem)
+        f.write('max_area = %r\n' % max_area)
+        f.write('max_tolerance = %r\n' % args.tolerance)
+        f.write('errormetric = %r\n' % metric)
+        f.write('mesher_path = %r\n' % os.path.abspath(args.mesher))
+        f.write('user_output_dir = %r\n' % (run_dir + os.path.sep))
+        f.write('use_input_prj = True\n')
+        f.write('parameter_files = %r\n' % parameter_files)
+
+    pipeline_seconds, pipeline_maxrss = run([sys.executable, os.path.join(repo_dir, 'mesher.py'), 'config.py'],
+                                            run_dir, os.path.join(run_dir, 'mesher_py.log'))
+
+    base_name = os.path.splitext(os.path.basename(dem))[0]
+    base_dir = os.path.join(run_dir, base_name)
+
+    with open(os.path.join(base_dir, base_name + '_run_report.json')) as f:
+        case_steps = json.load(f)['steps']
+
+    # the binary on its own, on the PLGS and rasters mesher.py made
+    profile_fname = os.path.join(run_dir, 'mesher_profile.json')
+    cmd = [os.path.abspath(args.mesher),
+           '--poly-file', os.path.join(base_dir, 'PLGS' + base_name + '.poly'),
+           '--raster', os.path.join(base_dir, base_name + '_projected.tif'),
+           '--tolerance', str(args.tolerance),
+           '--area', str(max_area),
+           '--min-area', str(args.cellsize ** 2),
+           '--error-metric', metric,
+           '--profile', profile_fname]
+    if lc is not None:
+        cmd += ['--category-raster', os.path.join(base_dir, os.path.splitext(os.path.basename(lc))[0] + '_projected.tif'),
+                '--category-frac', str(args.category_frac)]
+    mesher_seconds, mesher_maxrss = run(cmd, run_dir, os.path.join(run_dir, 'mesher.log'))
+
+    with open(profile_fname) as f:
+        refine_seconds = json.load(f)['phases']['refine']['seconds']
+
+    # mesh file headers
+    with open(os.path.join(base_dir, 'PLGS' + base_name + '.1.node')) as f:
+        vertices = int(f.readline().split()[0])
+    with open(os.path.join(base_dir, 'PLGS' + base_name + '.1.ele')) as f:
+        triangles = int(f.readline().split()[0])
+
+    row = {'pipeline_seconds': pipeline_seconds, 'pipeline_maxrss_kb': pipeline_maxrss,
+           'mesher_seconds': mesher_seconds, 'mesher_maxrss_kb': mesher_maxrss,
+           'refine_seconds': refine_seconds, 'vertices': vertices, 'triangles': triangles}
+    return row, case_steps
+
+
+def print_table(results):
+    print '%-28s %10s %12s %10s %12s %10s %10s' % ('case', 'pipeline s', 'pipeline MB', 'mesher s', 'mesher MB',
+                                                   'refine s', 'triangles')
+    for r in results:
+        print '%-28s %10.2f %12.1f %10.2f %12.1f %10.2f %10d' % (r['case'], r['pipeline_seconds'],
+                                                                 r['pipeline_maxrss_kb'] / 1024., r['mesher_seconds'],
+                                                                 r['mesher_maxrss_kb'] / 1024., r['refine_seconds'],
+                                                                 r['triangles'])
+
+
+# Prints the times and triangle counts of the cases in both results files, and the after/before ratio of the times
+def compare(before_fname, after_fname):
+    def load(fname):
+        with open(fname) as f:
+            return dict((r['case'], r) for r in csv.DictReader(f))
+
+    before = load(before_fname)
+    after = load(after_fname)
+
+    print '%-28s %10s %10s %7s %10s %10s %7s %10s %10s' % ('case', 'pipeline', 'pipeline', 'ratio', 'mesher', 'mesher',
+                                                           'ratio', 'triangles', 'triangles')
+    for case in sorted(set(before) & set(after)):
+        b = before[case]
+        a = after[case]
+        print '%-28s %10.2f %10.2f %7.2f %10.2f %10.2f %7.2f %10s %10s' % (
+            case,
+            float(b['pipeline_seconds']), float(a['pipeline_seconds']),
+            float(a['pipeline_seconds']) / float(b['pipeline_seconds']),
+            float(b['mesher_seconds']), float(a['mesher_seconds']),
+            float(a['mesher_seconds']) / float(b['mesher_seconds']),
+            b['triangles'], a['triangles'])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+// Mesher
+// Copyright (C) 2017 Christopher Marsh
+
+// This program is free software: you can redistribute it and/or modify
+// it under the terms of the GNU General Public License as published by
+// the Free Software Foundation, either version 3 of the License, or
+// (at your option) any later version.
+
+// This program is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+
+// You should have received a copy of the GNU General Public License
+// along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+// Times the area computation used by the geographic mesher. The per triangle path is what Is_bad used to do: parse
+// both WKTs and build a new transform for every triangle. The cached path is the shared transform Is_bad uses now.
+// The projected path is the plain cartesian area used for projected rasters and is the target to be close to.
+//
+// The old path is built as it was, without an axis mapping strategy. On GDAL >= 3 that means the authority lat/long
+// order of EPSG:4326, so the x = longitude coordinates are taken as latitudes and its areas are not comparable. The
+// cached areas are therefore checked against the transformed polygon's get_Area with the new transform instead, and
+// against the old path only on GDAL < 3 where the axis order is the same.
+//
+// usage: geographic_area_bench [n_triangles]
+
+#include <iostream>
+#include <cstdlib>
+#include <vector>
+#include <chrono>
+#include <algorithm>
+
+#include <ogr_spatialref.h>
+#include <ogr_geometry.h>
+
+#include <gdal_version.h>
+
+#include "../src/geographic_area.h"
+
+//WGS84 lat/long, as a geographic DEM would have
+const char* const wgs84_wkt = "GEOGCS[\"WGS 84\",DATUM[\"WGS_1984\",SPHEROID[\"WGS 84\",6378137,298.257223563,AUTHORITY[\"EPSG\",\"7030\"]],AUTHORITY[\"EPSG\",\"6326\"]],PRIMEM[\"Greenwich\",0,AUTHORITY[\"EPSG\",\"8901\"]],UNIT[\"degree\",0.0174532925199433,AUTHORITY[\"EPSG\",\"9122\"]],AUTHORITY[\"EPSG\",\"4326\"]]";
+
+double seconds_since(std::chrono::high_resolution_clock::time_point start)
+{
+    return std::chrono::duration<double>(std::chrono::high_resolution_clock::now() - start).count();
+}
+
+int main(int argc, char* argv[])
+{
+    size_t n = 20000;
+    if(argc > 1)
+        n = std::strtoul(argv[1], nullptr, 10);
+
+    //small triangles scattered over western Canada, about the size the mesher produces
+    srand(42);
+    std::vector<double> x(n * 3), y(n * 3);
+    for(size_t i = 0; i < n; i++)
+    {
+        double cx = -125 + 15.0 * rand() / RAND_MAX;
+        double cy = 49 + 10.0 * rand() / RAND_MAX;
+        for(size_t j = 0; j < 3; j++)
+        {
+            x[i * 3 + j] = cx + 0.01 * rand() / RAND_MAX;
+            y[i * 3 + j] = cy + 0.01 * rand() / RAND_MAX;
+        }
+    }
+
+    std::vector<double> per_triangle(n), cached(n), polygon(n);
+
+    //old path, as Is_bad had it: new spatial references and transform for each triangle. The old code leaked the
+    //transform, it is destroyed here to keep the memory of large runs in check
+    auto start = std::chrono::high_resolution_clock::now();
+    for(size_t i = 0; i < n; i++)
+    {
+        char* srs_wkt = const_cast<char*>(wgs84_wkt);
+        OGRSpatialReference srs;
+        srs.importFromWkt(&srs_wkt);
+
+        OGRLinearRing ring;
+        ring.addPoint(x[i * 3], y[i * 3]);
+        ring.addPoint(x[i * 3 + 1], y[i * 3 + 1]);
+        ring.addPoint(x[i * 3 + 2], y[i * 3 + 2]);
+        ring.addPoint(x[i * 3], y[i * 3]); //close it
+
+        OGRPolygon poly;
+        poly.addRing(&ring);
+
+        char* out_wkt = const_cast<char*>(equal_area_wkt);
+        OGRSpatialReference srs_out;
+        srs_out.importFromWkt(&out_wkt);
+
+        auto poCT = OGRCreateCoordinateTransformation(&srs, &srs_out);
+        poly.transform(poCT);
+        per_triangle[i] = poly.get_Area();
+        OCTDestroyCoordinateTransformation(poCT);
+    }
+    double t_per_triangle = seconds_since(start);
+
+    //new path: one transform for the run
+    start = std::chrono::high_resolution_clock::now();
+    auto trans = make_equal_area_transform(wgs84_wkt);
+    for(size_t i = 0; i < n; i++)
+    {
+        cached[i] = equal_area(trans.get(), &x[i * 3], &y[i * 3]);
+    }
+    double t_cached = seconds_since(start);
+
+    //reference for the cached areas: the triangle as a polygon, transformed with the same transform
+    for(size_t i = 0; i < n; i++)
+    {
+        OGRLinearRing ring;
+        ring.addPoint(x[i * 3], y[i * 3]);
+        ring.addPoint(x[i * 3 + 1], y[i * 3 + 1]);
+        ring.addPoint(x[i * 3 + 2], y[i * 3 + 2]);
+        ring.addPoint(x[i * 3], y[i * 3]); //close it
+
+        OGRPolygon poly;
+        poly.addRing(&ring);
+        poly.transform(trans.get());
+        polygon[i] = poly.get_Area();
+    }
+
+    //projected rasters
+    start = std::chrono::high_resolution_clock::now();
+    double sum = 0;
+    for(size_t i = 0; i < n; i++)
+    {
+        sum += shoelace_area(&x[i * 3], &y[i * 3]);
+    }
+    double t_projected = seconds_since(start);
+
+    double max_rel = 0, max_rel_old = 0;
+    for(size_t i = 0; i < n; i++)
+    {
+        max_rel = std::max(max_rel, std::fabs(polygon[i] - cached[i]) / polygon[i]);
+        max_rel_old = std::max(max_rel_old, std::fabs(per_triangle[i] - cached[i]) / per_triangle[i]);
+    }
+
+    std::cout << "triangles            " << n << std::endl;
+    std::cout << "per triangle (s)     " << t_per_triangle << "  " << n / t_per_triangle << " tri/s" << std::endl;
+    std::cout << "cached (s)           " << t_cached << "  " << n / t_cached << " tri/s" << std::endl;
+    std::cout << "projected (s)        " << t_projected << "  " << n / t_projected << " tri/s" << " (" << sum << ")" << std::endl;
+    std::cout << "speedup              " << t_per_triangle / t_cached << "x" << std::endl;
+    std::cout << "max relative diff    " << max_rel << " (polygon), " << max_rel_old << " (old path)" << std::endl;
+
+    if(max_rel > 1e-9)
+    {
+        std::cout << "Cached and polygon areas disagree" << std::endl;
+        return 1;
+    }
+
+#if GDAL_VERSION_MAJOR >= 3
+    std::cout << "GDAL >= 3: the old path used the lat/long axis order, its areas are not expected to match" << std::endl;
+#else
+    if(max_rel_old > 1e-9)
+    {
+        std::cout << "Cached and per triangle areas disagree" << std::endl;
+        return 1;
+    }
+#endif
+
+    return 0;
+}
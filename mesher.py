@@ -16,20 +16,31 @@
  
 from osgeo import gdal, ogr, osr
 import subprocess
-import re
 import json
 import os
 import numpy as np
-import scipy.stats.mstats as sp
 import scipy.interpolate as sp_interp
 import sys
 import shutil
 import imp
 import vtk
+from vtk.util import numpy_support
 import itertools
 import collections
+import hashlib
+import marshal
+import multiprocessing
+import multiprocessing.pool
+import time
+import resource
+import contextlib
+import cProfile
+import pstats
 gdal.UseExceptions()  # Enable errors
 
+# file extension of the _USM triangulation for each supported OGR driver
+usm_extensions = {'ESRI Shapefile': '.shp', 'GPKG': '.gpkg', 'FlatGeobuf': '.fgb'}
+
 
 def main():
     #######  load user configurable paramters here    #######
@@ -90,6 +101,16 @@ def main():
     if hasattr(X, 'reuse_mesh'):
         reuse_mesh = X.reuse_mesh
 
+    #have the mesher binary also write the .node/.ele/.neigh as .npy arrays which are much faster to load
+    binary_mesh = True
+    if hasattr(X, 'binary_mesh'):
+        binary_mesh = X.binary_mesh
+
+    #memory budget, in MB, for the mesher binary to hold the DEM and tolerance rasters in RAM while refining. None uses its default
+    raster_memory = None
+    if hasattr(X, 'raster_memory'):
+        raster_memory = X.raster_memory
+
     # path to triangle executable
     triangle_path = '../../bin/Release/mesher'
     if hasattr(X,'mesher_path'):
@@ -99,6 +120,12 @@ def main():
     if hasattr(X,'verbose'):
         verbose = X.verbose
 
+    #keep the intermediate files of the domain extraction (the nodata mask raster and the domain polygon before and after
+    #buffering and simplifying) in the output directory. Otherwise they are only held in memory
+    debug = False
+    if hasattr(X,'debug'):
+        debug = X.debug
+
     user_output_dir = ''
     if hasattr(X,'user_output_dir'):
         user_output_dir = X.user_output_dir
@@ -126,6 +153,57 @@ def main():
     max_smooth_iter = 1
     if hasattr(X, 'max_smooth_iter'):
         max_smooth_iter = X.max_smooth_iter
+
+    #write the .mesh, .param and .ic json without any indentation or whitespace. Much smaller files
+    compact_json = False
+    if hasattr(X, 'compact_json'):
+        compact_json = X.compact_json
+
+    #also write the .mesh, .param and .ic as NumPy .npz files
+    npz_output = False
+    if hasattr(X, 'npz_output'):
+        npz_output = X.npz_output
+
+    #number of processes used to compute the parameters and initial conditions of each triangle
+    n_workers = 1
+    if hasattr(X, 'n_workers'):
+        n_workers = X.n_workers
+
+    #zlib compress the appended binary data in the .vtu
+    vtu_compress = True
+    if hasattr(X, 'vtu_compress'):
+        vtu_compress = X.vtu_compress
+
+    #OGR driver used for the _USM triangulation layer: 'ESRI Shapefile', 'GPKG' or 'FlatGeobuf'
+    usm_format = 'ESRI Shapefile'
+    if hasattr(X, 'usm_format'):
+        usm_format = X.usm_format
+
+    if usm_format not in usm_extensions:
+        print 'usm_format must be one of ' + ', '.join(usm_extensions.keys())
+        exit(1)
+
+    #how the parameter and initial condition rasters are resampled: 'subprocess' runs gdalwarp, 'gdal' uses the in-process
+    # gdal.Warp multithreaded and keeps rasters without a tolerance as VRTs. Up to n_workers rasters are warped at once
+    warp_mode = 'subprocess'
+    if hasattr(X, 'warp_mode'):
+        warp_mode = X.warp_mode
+
+    #split the domain into mesh_tiles x mesh_tiles tiles that the mesher binary refines in parallel, with n_workers threads,
+    # and stitches back into one triangulation. 1 refines the whole domain at once
+    mesh_tiles = 1
+    if hasattr(X, 'mesh_tiles'):
+        mesh_tiles = X.mesh_tiles
+
+    #keep the output directory of a previous run and skip every stage whose inputs and settings haven't changed since
+    resume = False
+    if hasattr(X, 'resume'):
+        resume = X.resume
+
+    #also run under cProfile and write the stats to <base_name>_run_report_profile.pstats and _profile.txt next to the run report
+    profile = False
+    if hasattr(X, 'profile'):
+        profile = X.profile
     ########################################################
 
     base_name = os.path.basename(dem_filename)
@@ -134,20 +212,23 @@ def main():
     base_dir = user_output_dir + base_name + os.path.sep
 
     # Delete previous dir (if exists)
-    if os.path.isdir(base_dir) and not reuse_mesh:
+    if os.path.isdir(base_dir) and not (reuse_mesh or resume):
         shutil.rmtree(base_dir, ignore_errors=True)
 
-    # these have to be separate ifs for the logic to work correctly
-    if not reuse_mesh:
-        # make new output dir
+    # make new output dir
+    if not os.path.isdir(base_dir):
         os.makedirs(base_dir)
 
-    # we want to reuse an already generated mesh, but we will need to clean up the shp file as gdal won't overwrite an existing one
-    if reuse_mesh:
-        try:
-            os.remove(base_dir + base_name + '_USM.shp')
-        except:
-            pass
+    output_usm = base_dir + base_name + '_USM' + usm_extensions[usm_format]
+
+    # the checkpoints of the stages already run in base_dir. Without resume base_dir was just emptied and nothing can be
+    # reused, so the inputs aren't hashed at all
+    stages = None
+    if resume or reuse_mesh:
+        stages = load_stages(base_dir)
+
+    # time and peak memory of each step that runs
+    report = new_report(base_dir + base_name + '_run_report', profile)
 
     # figure out what srs out input is in, we will reproject everything to this
     # if hasattr(X, 'EPSG'):
@@ -165,7 +246,6 @@ def main():
         print 'Unable to open file ' + dem_filename
         exit(1)
 
-
     if src_ds.GetProjection() == '':
         print "Input DEM must have spatial reference information."
         exit(1)
@@ -190,8 +270,12 @@ def main():
     else:
         output_file_name = '_projected.tif'
 
-    subprocess.check_call(['gdalwarp %s %s -overwrite -dstnodata -9999 -t_srs \"%s\"' % (
-        dem_filename, base_dir + base_name + output_file_name, srs_out.ExportToProj4())], shell=True)
+    # the output name changes with do_smoothing, and _projected.tif is the smoothed DEM when smoothing was on
+    skey = stage_key(stages, [dem_filename], [srs_out.ExportToProj4(), do_smoothing, output_file_name])
+    if not stage_current(stages, 'reproject', skey, [base_dir + base_name + output_file_name]):
+        with timed_step(report, 'reproject'):
+            reproject_dem(dem_filename, base_dir + base_name + output_file_name, srs_out)
+        finish_stage(stages, 'reproject', skey)
 
     src_ds = gdal.Open(base_dir + base_name + output_file_name)
 
@@ -216,19 +300,10 @@ def main():
             pixel_width * pixel_height)  # if the user doesn't specify, then limit to the underlying resolution. No point going past this!
 
     if do_smoothing:
-        for iter in range(max_smooth_iter):
-
-            in_name = base_dir + base_name + '_projected_%d.tif' % (iter)
-            out_name = base_dir + base_name +'_projected_%d.tif' % (iter + 1)
-
-            if iter+1 == max_smooth_iter: #last iteration, change output
-                out_name = base_dir + base_name + '_projected.tif'
-
-            subprocess.check_call(['gdalwarp %s %s -overwrite -dstnodata -9999 -r cubicspline -tr %f %f' % (
-                in_name, out_name, abs(pixel_width) / scaling_factor,
-                abs(pixel_height) / scaling_factor)], shell=True)
-
-            scaling_factor *= (iter+1)
+        skey = stage_key(stages, [base_dir + base_name + output_file_name], [scaling_factor, max_smooth_iter])
+        if not stage_current(stages, 'smooth', skey, [base_dir + base_name + '_projected.tif']):
+            smooth_dem(base_dir + base_name, pixel_width, pixel_height, scaling_factor, max_smooth_iter, report)
+            finish_stage(stages, 'smooth', skey)
 
     # now, reopen the file
     src_ds = gdal.Open(base_dir + base_name + '_projected.tif')
@@ -244,222 +319,64 @@ def main():
     xmax = xmin + pixel_width * src_ds.RasterXSize
     ymin = ymax + pixel_height * src_ds.RasterYSize  # pixel_height is negative
 
-    exec_str = 'gdalwarp %s %s -overwrite -dstnodata -9999 -t_srs "%s" -te %f %f %f %f  -tr %f %f -r '
-
-    for key, data in parameter_files.iteritems():
-        if parameter_files[key]['method'] == 'mode':
-            estr = exec_str + 'mode'
-        else:
-            estr = exec_str + 'average'
-
-        #we need to handle a path being passed in
-        output_param_fname = os.path.basename(data['file'])
-        output_param_fname = os.path.splitext(output_param_fname)[0]
-
-        if gdal.Open(data['file']).GetProjection() == '':
-            print "Parameter " + data['file'] + " must have spatial reference information."
-            exit(1)
-
-        # force all the paramter files to have the same extent as the input DEM
-        subprocess.check_call([estr % (
-                data['file'], base_dir + output_param_fname + '_projected.tif', srs_out.ExportToProj4(), xmin, ymin, xmax, ymax, pixel_width,
-                pixel_height)], shell=True)
-
-        parameter_files[key]['filename'] = base_dir + output_param_fname + '_projected.tif'  # save the file name if needed for mesher
-        parameter_files[key]['file'] = gdal.Open(base_dir + output_param_fname + '_projected.tif')
-
-        if parameter_files[key]['file'] is None:
-            print 'Error: Unable to open raster for: %s' % key
-            exit(1)
-
-    for key, data in initial_conditions.iteritems():
-        if initial_conditions[key]['method'] == 'mode':
-            estr = exec_str + 'mode'
-        else:
-            estr = exec_str + 'average'
-
-        #we need to handle a path being passed in
-        output_ic_fname = os.path.basename(data['file'])
-        output_ic_fname = os.path.splitext(output_ic_fname)[0]
+    # force all the paramter and initial condition files to have the same extent as the input DEM
+    # the out of date ones are warped concurrently afterwards
+    extent = (xmin, ymin, xmax, ymax)
+    warps = collections.OrderedDict()
+    for prefix, kind, rasters in (('[param] ', 'Parameter', parameter_files), ('[ic] ', 'IC', initial_conditions)):
+        for key, data in rasters.iteritems():
+            #we need to handle a path being passed in
+            output_fname = os.path.basename(data['file'])
+            output_fname = os.path.splitext(output_fname)[0]
+
+            # rasters that are only sampled here, not by the mesher binary, can stay as warped VRTs
+            if warp_mode == 'gdal' and 'tolerance' not in data:
+                output_fname = base_dir + output_fname + '_projected.vrt'
+            else:
+                output_fname = base_dir + output_fname + '_projected.tif'
+
+            skey = stage_key(stages, [data['file']], [srs_out.ExportToProj4(), extent, pixel_width, pixel_height, data['method'], warp_mode])
+            if not stage_current(stages, 'resample ' + prefix + key, skey, [output_fname]):
+                # the same file used twice is only warped once
+                if output_fname not in warps:
+                    warps[output_fname] = ([], (kind, data['file'], output_fname, data['method'], srs_out.ExportToProj4(), extent,
+                                                pixel_width, pixel_height, warp_mode))
+                warps[output_fname][0].append(('resample ' + prefix + key, skey))
+
+            data['filename'] = output_fname  # save the file name if needed for mesher
+
+    if len(warps) > 0:
+        print 'Resampling %d rasters with %d workers' % (len(warps), min(n_workers, len(warps)))
+        with timed_step(report, 'resample'):
+            results = run_warps([args for names, args in warps.itervalues()], n_workers)
+        errors = [error for error, seconds in results]
+
+        for (names, args), (error, seconds) in zip(warps.itervalues(), results):
+            record_step(report, 'resample ' + args[1], seconds)
+            for name, skey in names:
+                if error is None:
+                    finish_stage(stages, name, skey)
+                else:
+                    print 'Error: %s of %s failed: %s' % (name, args[1], error)
 
-        if gdal.Open(data['file']).GetProjection() == '':
-            print "IC " + data['file'] + " must have spatial reference information."
+        if any(error is not None for error in errors):
             exit(1)
 
-        # force all the initial condition files to have the same extent as the input DEM
-        subprocess.check_call([estr % (
-                data['file'], base_dir + output_ic_fname + '_projected.tif', srs_out.ExportToProj4(), xmin, ymin, xmax, ymax, pixel_width,
-                pixel_height)], shell=True)
-
-        initial_conditions[key]['filename'] = base_dir + output_ic_fname + '_projected.tif'
-        initial_conditions[key]['file'] = gdal.Open(base_dir + output_ic_fname + '_projected.tif')
-
-        if initial_conditions[key]['file'] is None:
+    for key, data in parameter_files.items() + initial_conditions.items():
+        if gdal.Open(data['filename']) is None:
             print 'Error: Unable to open raster for: %s' % key
             exit(1)
 
-    plgs_shp = base_name + '.shp'
-
     dem = src_ds.GetRasterBand(1)
 
-    # Step 1: Create a mask raster that has a uniform value for all cells
-    # read all elevation data. Might be worth changing to the for-loop approach we use below so we don't have to read in all into ram.
-    # some raster
-    Z = dem.ReadAsArray()
-
-    # set all the non-nodata values to our mask value
-    Z[Z != dem.GetNoDataValue()] = 1
-
-    # save to file
-    (x, y) = Z.shape
-    driver = gdal.GetDriverByName("GTiff")
-    dst_datatype = gdal.GDT_Int16  # gdal.GDT_Float32   #<--- this is fine as we don't actually store elevation data.
-    tmp_raster = base_dir + 'mask_' + base_name + '.tif'
-    dst_ds = driver.Create(tmp_raster, y, x, 1, dst_datatype)
-    dst_ds.SetGeoTransform(src_ds.GetGeoTransform())
-    dst_ds.SetProjection(src_ds.GetProjection())
-    dst_ds.GetRasterBand(1).SetNoDataValue(dem.GetNoDataValue())
-    dst_ds.GetRasterBand(1).WriteArray(Z)
-    dst_ds.FlushCache()  # super key to get this to disk
-    dst_ds = None  # close file
-
-    # raster -> polygon
-    subprocess.check_call(['gdal_polygonize.py %s -b 1 -mask %s -f "ESRI Shapefile" %s' % (tmp_raster, tmp_raster,
-                                                                                           base_dir +
-                                                                                           plgs_shp)], shell=True)
-    driver = ogr.GetDriverByName('ESRI Shapefile')
-    dataSource = driver.Open( base_dir + plgs_shp, 1)
-
-    #find the largest polygon and keep it
-    layer = dataSource.GetLayer()
-    max_geom_area = -1
-    max_feature_ID = None
-    for feature in layer:
-        geom = feature.GetGeometryRef()
-        area = geom.GetArea()
-        #print 'FID = ' + str(feature.GetFID()) + ' area = ' + str(area)
-        if area > max_geom_area:
-            max_feature_ID = feature.GetFID()
-            max_geom_area = area
-
-    print 'Using FID = ' + str(max_feature_ID) + " as the largest continous area."
-    feats = np.arange(0,layer.GetFeatureCount())
-    for f in feats:
-        if f != max_feature_ID:
-            layer.DeleteFeature(f)
-    layer.SyncToDisk()
-    dataSource.ExecuteSQL("REPACK " + layer.GetName())
-    dataSource.Destroy()
-
-    # allow us to be able to use this directly in the exec_string below if we dont' simplify
-    outputBufferfn = base_dir + plgs_shp
-    if simplify and not no_simplify_buffer:
-        # buffering code from http://pcjericks.github.io/py-gdalogr-cookbook/vector_layers.html?highlight=buffer
-        inputfn = base_dir + plgs_shp
-        outputBufferfn = base_dir + "buffered_"+plgs_shp
-
-        print 'Simplifying extents by buffer distance = ' + str(bufferDist)
-        inputds = ogr.Open(inputfn)
-        inputlyr = inputds.GetLayer()
-
-        shpdriver = ogr.GetDriverByName('ESRI Shapefile')
-        if os.path.exists(outputBufferfn):
-            shpdriver.DeleteDataSource(outputBufferfn)
-        outputBufferds = shpdriver.CreateDataSource(outputBufferfn)
-        bufferlyr = outputBufferds.CreateLayer(outputBufferfn, srs_out, geom_type=ogr.wkbPolygon)
-        featureDefn = bufferlyr.GetLayerDefn()
-
-        for feature in inputlyr:
-            ingeom = feature.GetGeometryRef()
-            geomBuffer = ingeom.Buffer(bufferDist)
-
-            outFeature = ogr.Feature(featureDefn)
-            outFeature.SetGeometry(geomBuffer)
-            bufferlyr.CreateFeature(outFeature)
-            outFeature = None
-
-        inputds = None
-        outputBufferds = None
-
-    print 'Converting polygon to linestring'
-    exec_string = 'ogr2ogr -overwrite %s %s  -nlt LINESTRING' % (base_dir + 'line_' + plgs_shp, outputBufferfn)
-
-    if simplify:
-        exec_string = exec_string + ' -simplify ' + str(simplify_tol)
-
-    subprocess.check_call(exec_string, shell=True)
-
-    # convert to geoJSON because it's easy to parse
-    poly_plgs = base_name + '.geojson'
-    subprocess.check_call(['ogr2ogr -f GeoJSON %s %s' % (base_dir +
-                                                         poly_plgs, base_dir + 'line_' + plgs_shp)], shell=True)
-
-    with open(base_dir + poly_plgs) as f:
-        plgs = json.load(f)
-
-    # look through all the features and find the biggest
-    idx = -1
-    i = 0
-    cmax = -1
-    l=0
-    for features in plgs['features']:
-        if features['geometry']['type'] == 'LineString':
-            l = len(features['geometry']['coordinates'])
-        elif features['geometry']['type'] == 'MultiLineString':
-            coords = []
-
-            idx_ml = 0
-            len_ml = -1
-            j=0
-            #find the largest of the multi lines, ignore holes!
-            for lines in features['geometry']['coordinates']:
-                l = len(lines)
-                if l > len_ml:
-                    len_ml = l
-                    idx_ml = j
-                j+=1
-
-            for l in features['geometry']['coordinates'][idx_ml]:
-                coords.append(l)
-
-            features['geometry']['type'] = 'LineString'
-            features['geometry']['coordinates'] = coords
-            l = len(coords)
-
-        if l > cmax:
-            cmax = l
-            idx = i
-        i+=1
-
-    # assuming just the biggest feature is what we want. Need to add in more to support rivers and lakes
-    if plgs['features'][idx]['geometry']['type'] != 'LineString':
-        print('Not linestring')
-        exit(1)
-
-    coords = plgs['features'][idx]['geometry']['coordinates']
-
-    # Create the PLGS to constrain the triangulation
+    # Create the PLGS to constrain the triangulation from the largest continuous area of valid data
     poly_file = 'PLGS' + base_name + '.poly'
-    with open(base_dir +
-                      poly_file, 'w') as f:
-        header = '%d 2 0 0\n' % (len(coords))
-        f.write(header)
-        vert = 1
-        for c in coords:
-            f.write('%d %17.11f %17.11f\n' % (vert, c[0], c[1]))
-            vert = vert + 1
-
-        f.write('\n')
-        header = '%d 0\n' % (len(coords))
-        f.write(header)
-
-        for i in range(len(coords)):
-            if i + 1 == len(coords):  # last time has to loop back to start
-                f.write('%d %d %d\n' % (i + 1, i + 1, 1))
-            else:
-                f.write('%d %d %d\n' % (i + 1, i + 1, i + 2))
-
-        f.write('0\n')
+    skey = stage_key(stages, [base_dir + base_name + '_projected.tif'],
+                     [srs_out.ExportToWkt(), simplify, simplify_tol, bufferDist, no_simplify_buffer, debug])
+    if not stage_current(stages, 'PLGS', skey, [base_dir + poly_file]):
+        create_plgs(src_ds, base_dir, base_name, poly_file, simplify, simplify_tol, bufferDist, no_simplify_buffer, debug,
+                    report)
+        finish_stage(stages, 'PLGS', skey)
 
     # create the spatial reference from the raster dataset
     wkt = src_ds.GetProjection()
@@ -468,140 +385,143 @@ def main():
 
     is_geographic = srs.IsGeographic()
 
-    if not reuse_mesh:
-        execstr = '%s --poly-file %s --tolerance %f --raster %s --area %f --min-area %f --error-metric %s --lloyd %d' % \
-                  (triangle_path,
-                   base_dir + poly_file,
-                   max_tolerance,
-                   base_dir + base_name + '_projected.tif',
-                   max_area,
-                   min_area,
-                   errormetric,
-                   lloyd_itr
-                   )
-
-        if is_geographic:
-            execstr += ' --is-geographic true'
-
-        for key, data in parameter_files.iteritems():
-            if 'tolerance'in data:
-                if data['method'] == 'mode':
-                    execstr += ' --category-raster %s --category-frac %f' % (data['filename'], data['tolerance'])
-                else:
-                    execstr += ' --raster %s --tolerance %f' % (data['filename'], data['tolerance'])
-
-        for key, data in initial_conditions.iteritems():
-            if 'tolerance' in data:
-                if data['method'] == 'mode':
-                    execstr += ' --category-raster %s --category-frac %f' % (data['filename'], data['tolerance'])
-                else:
-                    execstr += ' --raster %s --tolerance %f' % (data['filename'], data['tolerance'])
-        print execstr
-        subprocess.check_call(execstr, shell=True)
-
-    # read in the node, ele, and neigh from
-
-    # holds our main mesh structure which we will write out to json to read into CHM
-    mesh = {}
-    mesh['mesh'] = {}
-    mesh['mesh']['vertex'] = []
-
-    read_header = False
-
-    vtu = vtk.vtkUnstructuredGrid()
-
-    output_vtk = base_dir + base_name + '.vtu'
-    vtuwriter = vtk.vtkXMLUnstructuredGridWriter()
-    vtuwriter.SetFileName(output_vtk)
-
-    #check what version of vtk we are using so we can avoid the api conflict
-    #http://www.vtk.org/Wiki/VTK/VTK_6_Migration/Replacement_of_SetInput#Replacement_of_SetInput.28.29_with_SetInputData.28.29_and_SetInputConnection.28.29
-    if vtk.vtkVersion.GetVTKMajorVersion() > 5:
-        vtuwriter.SetInputData(vtu)
-    else:
-        vtuwriter.SetInput(vtu)
+    execstr = '%s --poly-file %s --tolerance %f --raster %s --area %f --min-area %f --error-metric %s --lloyd %d' % \
+              (triangle_path,
+               base_dir + poly_file,
+               max_tolerance,
+               base_dir + base_name + '_projected.tif',
+               max_area,
+               min_area,
+               errormetric,
+               lloyd_itr
+               )
 
+    if is_geographic:
+        execstr += ' --is-geographic true'
 
-    vtu_points = vtk.vtkPoints()
-    vtu_triangles = vtk.vtkCellArray()
+    if binary_mesh:
+        execstr += ' --binary-output true'
 
-    invalid_nodes = []  # any nodes that are outside of the domain AND
-    print 'Reading nodes'
-    with open(base_dir + 'PLGS' + base_name + '.1.node') as f:
-        for line in f:
-            if '#' not in line:
-                if not read_header:
-                    header = re.findall(r"[+-]?\d+(?:\.\d+)?", line)
-                    num_nodes = int(header[0])
-                    read_header = True
-                    mesh['mesh']['nvertex'] = num_nodes
-                else:
-                    items = re.findall(r"[+-]?\d+(?:\.\d+)?", line)
-                    mx = float(items[1])
-                    my = float(items[2])
+    if raster_memory is not None:
+        execstr += ' --raster-memory %f' % raster_memory
 
-                    mz = extract_point(src_ds, mx, my)
+    if mesh_tiles > 1:
+        execstr += ' --tiles %d --threads %d' % (mesh_tiles, n_workers)
 
-                    if mz == dem.GetNoDataValue():
-                        invalid_nodes.append(int(items[0]) - 1)
+    # every file the triangulation depends on
+    tri_inputs = [triangle_path, base_dir + poly_file, base_dir + base_name + '_projected.tif']
 
-                    mesh['mesh']['vertex'].append([mx, my, mz])
-
-
-    print 'Length of invalid nodes = ' + str(len(invalid_nodes))
-
-    # read in the neighbour file
-    print 'Reading in neighbour file'
-    read_header = False
-    mesh['mesh']['neigh'] = []
-    with open(base_dir + 'PLGS' + base_name + '.1.neigh') as elem:
-        for line in elem:
-            if '#' not in line:
-                if not read_header:
-                    read_header = True  # skip header, nothing to do here
-                else:
-                    items = re.findall(r"[+-]?\d+(?:\.\d+)?", line)
-                    v0 = int(items[1]) - 1  # convert to zero indexing
-                    v1 = int(items[2]) - 1
-                    v2 = int(items[3]) - 1
-
-                    mesh['mesh']['neigh'].append([v0, v1, v2])
-
-                # Create the shape file to hold the triangulation. Could do all in memory but it is nice to see this in a GIS
-    # set up the shapefile driver
-    driver = ogr.GetDriverByName("ESRI Shapefile")
-    # create the data source
-    try:
-        os.remove(base_dir +
-                  base_name + '_USM.shp')
-    except OSError:
-        pass
-
-    output_usm = driver.CreateDataSource(base_dir +
-                                         base_name + '_USM.shp')
+    for key, data in parameter_files.iteritems():
+        if 'tolerance'in data:
+            tri_inputs.append(data['filename'])
+            if data['method'] == 'mode':
+                execstr += ' --category-raster %s --category-frac %f' % (data['filename'], data['tolerance'])
+            else:
+                execstr += ' --raster %s --tolerance %f' % (data['filename'], data['tolerance'])
 
+    for key, data in initial_conditions.iteritems():
+        if 'tolerance' in data:
+            tri_inputs.append(data['filename'])
+            if data['method'] == 'mode':
+                execstr += ' --category-raster %s --category-frac %f' % (data['filename'], data['tolerance'])
+            else:
+                execstr += ' --raster %s --tolerance %f' % (data['filename'], data['tolerance'])
 
-    vtu_points.SetNumberOfPoints(len(mesh['mesh']['vertex']))
+    mesh_prefix = base_dir + 'PLGS' + base_name
+    mesh_files = [mesh_prefix + ext for ext in ('.1.node', '.1.ele', '.1.neigh')]
+    if binary_mesh:
+        mesh_files += [f + '.npy' for f in mesh_files]
 
-    # create the layer
-    layer = output_usm.CreateLayer(base_name, srs, ogr.wkbPolygon)
+    skey = stage_key(stages, tri_inputs, [execstr])
+    if reuse_mesh:
+        print 'Reusing the existing mesh'
+    elif not stage_current(stages, 'triangulate', skey, mesh_files):
+        print execstr
+        with timed_step(report, 'triangulate'):
+            subprocess.check_call(execstr, shell=True)
+        finish_stage(stages, 'triangulate', skey)
 
-    layer.CreateField(ogr.FieldDefn("triangle", ogr.OFTInteger))  # holds the triangle id.
-    layer.CreateField(ogr.FieldDefn("area", ogr.OFTReal))
+    # holds our main mesh structure which we will write out to json to read into CHM
+    mesh = {}
+    mesh['mesh'] = {}
 
-    for key, value in parameter_files.iteritems():
-        layer.CreateField(ogr.FieldDefn(key, ogr.OFTReal))
+    print 'Reading mesh'
+    with timed_step(report, 'read mesh'):
+        node_xy, elem, neigh = read_mesh_files(mesh_prefix)
+    nelem = len(elem)
+    mesh['mesh']['nvertex'] = len(node_xy)
+    mesh['mesh']['nelem'] = nelem
+
+    # sample the elevation of every vertex at once from the in-memory DEM
+    # any nodes that are outside of the domain are invalid and need fixing
+    with timed_step(report, 'vertex elevation'):
+        node_z = extract_points(load_raster(src_ds), node_xy[:, 0], node_xy[:, 1])
+    invalid_nodes = node_z == dem.GetNoDataValue()
+
+    print 'Length of invalid nodes = ' + str(np.count_nonzero(invalid_nodes))
+
+    # estimate the invalid nodes' z coord from the nodes they share a triangle with
+    unrepaired = fill_invalid_nodes(node_z, elem, invalid_nodes)
+    if verbose:
+        print 'Replaced %d invalid nodes' % (np.count_nonzero(invalid_nodes) - len(unrepaired))
+
+    # if the simplify_tol is too large, we can end up with a triangle that is entirely outside of the domain
+    if len(unrepaired) > 0:
+        print 'Length of invalid nodes after correction= ' + str(len(unrepaired))
+        print 'This will have occurred if an entire triangle is outside of the domain. There is no way to reconstruct this triangle.'
+        print 'Try reducing simplify_tol.'
+        exit(1)
 
-    for key, value in initial_conditions.iteritems():
-        layer.CreateField(ogr.FieldDefn(key, ogr.OFTReal))
+    vertex = np.column_stack((node_xy, node_z))
+    node_xy = node_z = None
 
-    read_header = False
-    i = 1
+    # get the value under each triangle from each paramter file
+    rasters = []
+    for key, data in parameter_files.iteritems():
+        rasters.append(('[param] ' + key, data['filename'], data['method']))
+    for key, data in initial_conditions.iteritems():
+        rasters.append(('[ic] ' + key, data['filename'], data['method']))
+
+    area_wkt = None
+    if is_geographic:
+        area_wkt = (srs.ExportToWkt(), srs_out.ExportToWkt())
+
+    # the attributes are cached before any classifiers are applied
+    attributes_npz = base_dir + base_name + '_attributes.npz'
+    attribute_inputs = mesh_files + [base_dir + base_name + '_projected.tif'] + [r[1] for r in rasters]
+    attribute_inputs += [data['file'] for data in parameter_files.values() + initial_conditions.values()]  # VRTs only reference these
+    skey = stage_key(stages, attribute_inputs, [rasters, area_wkt])
+    if stage_current(stages, 'attribute', skey, [attributes_npz]):
+        attributes = dict(np.load(attributes_npz))
+    else:
+        print 'Computing parameters and initial conditions'
+        with timed_step(report, 'attribute'):
+            attributes, seconds = compute_attributes_parallel(vertex, elem, rasters, area_wkt, n_workers)
+        for name, s in seconds.iteritems():
+            record_step(report, 'attribute ' + name, s)
+        # a checkpoint, only read back when the stages are kept
+        if stages is not None:
+            write_npz(attributes, attributes_npz)
+        finish_stage(stages, 'attribute', skey)
+
+    outputs = [output_usm, base_dir + base_name + '.vtu']
+    outputs += [user_output_dir + base_name + ext for ext in ('.mesh', '.param', '.ic')]
+    if npz_output:
+        outputs += [user_output_dir + base_name + ext for ext in ('.mesh.npz', '.param.npz', '.ic.npz')]
+
+    classifiers = [(k, code_hash(d['classifier'])) for k, d in sorted(parameter_files.items()) + sorted(initial_conditions.items())
+                   if 'classifier' in d]
+    skey = stage_key(stages, [attributes_npz] + attribute_inputs,
+                     [classifiers, usm_format, vtu_compress, compact_json, npz_output, srs.ExportToWkt(), user_output_dir])
+    if stage_current(stages, 'write', skey, outputs):
+        finish_report(report)
+        print 'Done'
+        return
 
-    print 'Computing parameters and initial conditions'
+    mesh['mesh']['vertex'] = vertex
+    mesh['mesh']['elem'] = elem
+    mesh['mesh']['neigh'] = neigh
 
-    triangles_to_fix = []
-    mesh['mesh']['elem'] = []
     mesh['mesh']['is_geographic'] = is_geographic
 
     #need to save the UTM coordinates so-as to be able to generate lat/long of points if needed later (e.g., CHM)
@@ -620,150 +540,32 @@ def main():
     for key, data in initial_conditions.iteritems():
         ics[key] = []
 
-    vtu_cells  = {}
-    vtu_cells['Elevation'] = vtk.vtkFloatArray()
-    vtu_cells['Elevation'].SetName("Elevation")
-
     for key, data in parameter_files.iteritems():
-        k = '[param] ' + key
-        vtu_cells[k]=vtk.vtkFloatArray()
-        vtu_cells[k].SetName(k)
+        output = attributes['[param] ' + key]
+        if 'classifier' in data:
+            output = np.array([data['classifier'](o) for o in output.tolist()])
+        params[key] = output
 
     for key, data in initial_conditions.iteritems():
-        k = '[ic] ' + key
-        vtu_cells[k]=vtk.vtkFloatArray()
-        vtu_cells[k].SetName(k)
-
-    i = 0
-    with open(base_dir + 'PLGS' + base_name + '.1.ele') as elem:
-        for line in elem:
-            if '#' not in line:
-                if not read_header:
-                    header = re.findall(r"[+-]?\d+(?:\.\d+)?", line)
-                    nelem = int(header[0])
-                    mesh['mesh']['nelem'] = nelem
-                    read_header = True  # skip header
-                else:
-
-                    printProgress(i, nelem)
-
-                    items = re.findall(r"[+-]?\d+(?:\.\d+)?", line)
-                    v0 = int(items[1]) - 1  # convert to zero indexing
-                    v1 = int(items[2]) - 1
-                    v2 = int(items[3]) - 1
-
-                    # estimate an invalid node's z coord from this triangles other nodes' z value
-                    if v0 in invalid_nodes:
-                        z_v1 = mesh['mesh']['vertex'][v1][2]
-                        z_v2 = mesh['mesh']['vertex'][v2][2]
-                        tmp = [x for x in [z_v1, z_v2] if x != dem.GetNoDataValue()]
-                        # print 'found v0'
-                        if len(tmp) != 0:
-                            mesh['mesh']['vertex'][v0][2] = float(np.mean(tmp))
-                            if verbose:
-                                print 'replaced invalid with ' + str(mesh['mesh']['vertex'][v0])
-                            invalid_nodes = [x for x in invalid_nodes if x != v0]  # remove from out invalid nodes list.
-
-                    if v1 in invalid_nodes:
-                        z_v0 = mesh['mesh']['vertex'][v0][2]
-                        z_v2 = mesh['mesh']['vertex'][v2][2]
-                        tmp = [x for x in [z_v0, z_v2] if x != dem.GetNoDataValue()]
-                        # print 'found v1'
-                        if len(tmp) != 0:
-                            mesh['mesh']['vertex'][v1][2] = float(np.mean(tmp))
-                            if verbose:
-                                print 'replaced invalid with ' + str(mesh['mesh']['vertex'][v1])
-                            invalid_nodes = [x for x in invalid_nodes if x != v1]  # remove from out invalid nodes list.
-
-                    if v2 in invalid_nodes:
-                        # print 'found v2'
-                        z_v1 = mesh['mesh']['vertex'][v1][2]
-                        z_v0 = mesh['mesh']['vertex'][v0][2]
-                        tmp = [x for x in [z_v1, z_v0] if x != dem.GetNoDataValue()]
-                        if len(tmp) != 0:
-                            mesh['mesh']['vertex'][v2][2] = float(np.mean(tmp))
-                            if verbose:
-                                print 'replaced invalid with ' + str(mesh['mesh']['vertex'][v2])
-                            invalid_nodes = [x for x in invalid_nodes if x != v2]  # remove from out invalid nodes list.
-                    mesh['mesh']['elem'].append([v0, v1, v2])
-
-                    ring = ogr.Geometry(ogr.wkbLinearRing)
-                    ring.AddPoint(mesh['mesh']['vertex'][v0][0], mesh['mesh']['vertex'][v0][1])
-                    ring.AddPoint(mesh['mesh']['vertex'][v1][0], mesh['mesh']['vertex'][v1][1])
-                    ring.AddPoint(mesh['mesh']['vertex'][v2][0], mesh['mesh']['vertex'][v2][1])
-                    ring.AddPoint(mesh['mesh']['vertex'][v0][0],
-                                  mesh['mesh']['vertex'][v0][1])  # add again to complete the ring.
-
-                    vtu_points.SetPoint(v0, mesh['mesh']['vertex'][v0][0], mesh['mesh']['vertex'][v0][1],
-                                        mesh['mesh']['vertex'][v0][2])
-                    vtu_points.SetPoint(v1, mesh['mesh']['vertex'][v1][0], mesh['mesh']['vertex'][v1][1],
-                                        mesh['mesh']['vertex'][v1][2])
-                    vtu_points.SetPoint(v2, mesh['mesh']['vertex'][v2][0], mesh['mesh']['vertex'][v2][1],
-                                        mesh['mesh']['vertex'][v2][2])
-
-                    triangle = vtk.vtkTriangle()
-                    triangle.GetPointIds().SetId(0, v0)
-                    triangle.GetPointIds().SetId(1, v1)
-                    triangle.GetPointIds().SetId(2, v2)
-
-                    vtu_triangles.InsertNextCell(triangle)
-                    vtu_cells['Elevation'].InsertNextTuple1((mesh['mesh']['vertex'][v0][2] +
-                                                             mesh['mesh']['vertex'][v1][2] +
-                                                             mesh['mesh']['vertex'][v2][2]) / 3.)
-
-
-                    tpoly = ogr.Geometry(ogr.wkbPolygon)
-                    tpoly.AddGeometry(ring)
-
-                    feature = ogr.Feature(layer.GetLayerDefn())
-                    feature.SetField('triangle', int(items[0]) - 1)
-                    feature.SetGeometry(tpoly)
-
-                    if is_geographic:
-                        # wkt_out = "PROJCS[\"North_America_Albers_Equal_Area_Conic\",     GEOGCS[\"GCS_North_American_1983\",         DATUM[\"North_American_Datum_1983\",             SPHEROID[\"GRS_1980\",6378137,298.257222101]],         PRIMEM[\"Greenwich\",0],         UNIT[\"Degree\",0.017453292519943295]],     PROJECTION[\"Albers_Conic_Equal_Area\"],     PARAMETER[\"False_Easting\",0],     PARAMETER[\"False_Northing\",0],     PARAMETER[\"longitude_of_center\",-96],     PARAMETER[\"Standard_Parallel_1\",20],     PARAMETER[\"Standard_Parallel_2\",60],     PARAMETER[\"latitude_of_center\",40],     UNIT[\"Meter\",1],     AUTHORITY[\"EPSG\",\"102008\"]]";
-                        # srs_out =  osr.SpatialReference()
-                        # srs_out.ImportFromWkt(wkt_out)
-
-                        transform = osr.CoordinateTransformation(srs, srs_out)
-                        p = tpoly.Clone()
-                        p.Transform(transform)
-                        area = p.GetArea()
-                        feature.SetField('area', area)
-                        params['area'].append(area)
-
-                    # get the value under each triangle from each paramter file
-                    for key, data in parameter_files.iteritems():
-                        output = rasterize_elem(data, feature, key)
-
-                        if 'classifier' in data:
-                            output = data['classifier'](output)
-                        params[key].append(output)
-
-                        # we want to write actual NaN to vtu for better displaying
-                        if output == -9999:
-                            output = float('nan')
-                        vtu_cells['[param] ' + key].InsertNextTuple1(output)
-
-                    for key, data in initial_conditions.iteritems():
-                        output = rasterize_elem(data, feature, key)
-                        if 'classifier' in data:
-                            output = data['classifier'](output)
-
-                        ics[key].append(output)
-
-                        # we want to write actual NaN to vtu for better displaying
-                        if output == -9999:
-                            output = float('nan')
-                        vtu_cells['[ic] ' + key].InsertNextTuple1(output)
-
-                    layer.CreateFeature(feature)
-                    i = i + 1
-                    # if the simplify_tol is too large, we can end up with a triangle that is entirely outside of the domain
-    if len(invalid_nodes) > 0:
-        print 'Length of invalid nodes after correction= ' + str(len(invalid_nodes))
-        print 'This will have occurred if an entire triangle is outside of the domain. There is no way to reconstruct this triangle.'
-        print 'Try reducing simplify_tol.'
-        raise
+        output = attributes['[ic] ' + key]
+        if 'classifier' in data:
+            output = np.array([data['classifier'](o) for o in output.tolist()])
+        ics[key] = output
+
+    if is_geographic:
+        params['area'] = attributes['area']
+
+    # Create the vector file to hold the triangulation. Could do all in memory but it is nice to see this in a GIS
+    print 'Writing triangulation'
+    usm_fields = collections.OrderedDict()
+    usm_fields['triangle'] = (ogr.OFTInteger, np.arange(nelem))  # holds the triangle id.
+    usm_fields['area'] = (ogr.OFTReal, params['area'] if is_geographic else None)
+    for key, data in parameter_files.iteritems():
+        usm_fields[key] = (ogr.OFTReal, params[key])
+    for key, data in initial_conditions.iteritems():
+        usm_fields[key] = (ogr.OFTReal, ics[key])
+    with timed_step(report, 'write USM'):
+        write_usm(output_usm, usm_format, srs, base_name, vertex, elem, usm_fields)
 
     #optionally smooth the mesh
     #this can likely be removed, but is here is the newly added cubic filtering of the input dem is deemed not enough
@@ -818,24 +620,45 @@ def main():
 
 
 
-    vtu.SetPoints(vtu_points)
-    vtu.SetCells(vtk.VTK_TRIANGLE,vtu_triangles)
-    for p in vtu_cells.itervalues():
-        vtu.GetCellData().AddArray(p)
-    vtuwriter.Write()
+    print 'Writing vtu'
+    vtu_cells = collections.OrderedDict()
+    vtu_cells['Elevation'] = attributes['Elevation']
+    for key, data in parameter_files.iteritems():
+        vtu_cells['[param] ' + key] = params[key]
+    for key, data in initial_conditions.iteritems():
+        vtu_cells['[ic] ' + key] = ics[key]
+    for k, output in vtu_cells.iteritems():
+        # we want to write actual NaN to vtu for better displaying
+        output = np.asarray(output, dtype=np.float64)
+        vtu_cells[k] = np.where(output == -9999, np.nan, output)
+    with timed_step(report, 'write vtu'):
+        write_vtu(base_dir + base_name + '.vtu', vertex, elem, vtu_cells, vtu_compress)
+
+    indent = 4
+    if compact_json:
+        indent = None
 
-    output_usm = None  # close the file
     print 'Saving mesh to file ' + base_name + '.mesh'
-    with open(user_output_dir+base_name + '.mesh', 'w') as outfile:
-        json.dump(mesh, outfile, indent=4)
+    with timed_step(report, 'write mesh json'):
+        write_json(mesh, user_output_dir + base_name + '.mesh', indent)
 
     print 'Saving parameters to file ' + base_name + '.param'
-    with open(user_output_dir+base_name + '.param', 'w') as outfile:
-        json.dump(params, outfile, indent=4)
+    with timed_step(report, 'write param json'):
+        write_json(params, user_output_dir + base_name + '.param', indent)
 
     print 'Saving initial conditions  to file ' + base_name + '.ic'
-    with open(user_output_dir+base_name + '.ic', 'w') as outfile:
-        json.dump(ics, outfile, indent=4)
+    with timed_step(report, 'write ic json'):
+        write_json(ics, user_output_dir + base_name + '.ic', indent)
+
+    if npz_output:
+        print 'Saving binary copies to ' + base_name + '.mesh.npz, .param.npz, .ic.npz'
+        with timed_step(report, 'write npz'):
+            write_npz(mesh['mesh'], user_output_dir + base_name + '.mesh.npz')
+            write_npz(params, user_output_dir + base_name + '.param.npz')
+            write_npz(ics, user_output_dir + base_name + '.ic.npz')
+
+    finish_stage(stages, 'write', skey)
+    finish_report(report)
     print 'Done'
 
 
@@ -859,199 +682,846 @@ def printProgress(iteration, total, prefix='', suffix='', decimals=2, barLength=
         print("\n")
 
 
-# Zonal stats from here https://gist.github.com/perrygeo/5667173
-def bbox_to_pixel_offsets(gt, bbox, rasterXsize, rasterYsize):
-    originX = gt[0]
-    originY = gt[3]
-    pixel_width = gt[1]
-    pixel_height = gt[5]
-    x1 = int((bbox[0] - originX) / pixel_width)
-    x2 = int((bbox[1] - originX) / pixel_width) + 1
+# Pipeline checkpoints. With resume (or reuse_mesh), every stage of main records a hash of its input files and settings in
+# base_dir/stages.json once it completes, and on a rerun the stage is skipped if that hash and its output files are
+# unchanged. The content hash of each file is cached against its size and mtime so large rasters are only re-read when
+# they change. Otherwise stages is None and the functions below do nothing, every stage runs.
+def load_stages(base_dir):
+    stages = {'fname': base_dir + 'stages.json', 'keys': {}, 'files': {}}
+    if os.path.exists(stages['fname']):
+        with open(stages['fname']) as f:
+            saved = json.load(f)
+        stages['keys'] = saved['keys']
+        stages['files'] = saved['files']
+    return stages
 
-    y1 = int((bbox[3] - originY) / pixel_height)
-    y2 = int((bbox[2] - originY) / pixel_height) + 1
 
-    xsize = x2 - x1
-    ysize = y2 - y1
+def save_stages(stages):
+    with open(stages['fname'], 'w') as f:
+        json.dump({'keys': stages['keys'], 'files': stages['files']}, f, indent=4)
 
-    # only apply this correction if we are touching the underlying raster.
-    if x1 < rasterXsize and y1 < rasterYsize:
-        # deal with small out of bounds
-        if x1 < 0:
-            x1 = 0
 
-        if y1 < 0:
-            y1 = 0
+# sha1 of a file's contents, None if the path isn't a file (e.g., a GDAL virtual path or a binary on the PATH)
+def file_hash(stages, path):
+    if not os.path.isfile(path):
+        return None
 
-        if x1 + xsize > rasterXsize:
-            xsize = rasterXsize - x1
+    st = os.stat(path)
+    cached = stages['files'].get(path)
+    if cached is not None and cached[0] == st.st_size and cached[1] == st.st_mtime:
+        return cached[2]
 
-        if y1 + ysize > rasterYsize:
-            ysize = rasterYsize - y1
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
 
-    return (x1, y1, xsize, ysize)
+    stages['files'][path] = [st.st_size, st.st_mtime, h.hexdigest()]
+    return h.hexdigest()
 
 
-def extract_point(raster, mx, my):
-    # Convert from map to pixel coordinates.
-    # Only works for geotransforms with no rotation.
+# Key of a stage over the contents of its input files and its (json serializable) settings
+def stage_key(stages, inputs, settings):
+    if stages is None:
+        return None
 
-    rb = raster.GetRasterBand(1)
-    gt = raster.GetGeoTransform()
+    h = hashlib.sha1()
+    for path in inputs:
+        h.update('%s %s\n' % (path, file_hash(stages, path)))
+    h.update(json.dumps(settings, sort_keys=True))
+    return h.hexdigest()
 
-    px = int((mx - gt[0]) / gt[1])  # x pixel
-    py = int((my - gt[3]) / gt[5])  # y pixel
 
-    # boundary verticies from Triangle can end up outside of the domain by 1 pixel.
-    # if we adjusted back by  1 pixel to get the dz value, it's no problem and still gives a good boundary
-    if px == raster.RasterXSize:
-        px = px - 1
-    if py == raster.RasterYSize:
-        py = py - 1
-    mz = rb.ReadAsArray(px, py, 1, 1)
-    mz = float(mz.flatten()[0])
-
-    if mz == rb.GetNoDataValue():
-        dx = 1
-        dy = 1
+# True if the stage last completed with this key and all of its outputs still exist. Otherwise the stage's checkpoint is
+# dropped so an interrupted rerun can't leave a stale key behind.
+def stage_current(stages, name, key, outputs):
+    if stages is None:
+        return False
+
+    if stages['keys'].get(name) == key and all(os.path.exists(f) for f in outputs):
+        print 'Skipping stage %s, its inputs are unchanged' % name
+        return True
+
+    stages['keys'].pop(name, None)
+    save_stages(stages)
+    return False
+
+
+def finish_stage(stages, name, key):
+    if stages is None:
+        return
+
+    stages['keys'][name] = key
+    save_stages(stages)
 
-        # attempt to pick points from the surrounding 8
-        z1 = rb.ReadAsArray(px - dx if px > 0 else px, py, 1, 1)
-        z1 = z1[0] if z1 is not None else rb.GetNoDataValue()
 
-        z2 = rb.ReadAsArray(px + dx if px < raster.RasterXSize else px, py, 1, 1)
-        z2 = z2[0] if z2 is not None else rb.GetNoDataValue()
+# Hash of a classifier's bytecode so that editing it reruns the write stage. Changes to any globals it uses are not seen.
+def code_hash(func):
+    return hashlib.sha1(marshal.dumps(func.__code__)).hexdigest()
 
-        z3 = rb.ReadAsArray(px, py + dy if py < raster.RasterYSize else py, 1, 1)
-        z3 = z3[0] if z3 is not None else rb.GetNoDataValue()
 
-        z4 = rb.ReadAsArray(px, py - dy if py > 0 else py, 1, 1)[0]
-        z4 = z4[0] if z4 is not None else rb.GetNoDataValue()
+# Run report. Each step of main that runs records its wall time and the peak resident memory, in KB, of this process and
+# of the largest child process waited on (gdalwarp, the mesher binary, ...) as of the end of the step. ru_maxrss only
+# grows, so a step set a new peak if its value is larger than the step before it. Skipped stages are not recorded.
+# finish_report writes prefix.json and, if profile is set, the cProfile stats of the run to prefix_profile.pstats/.txt
+def new_report(prefix, profile=False):
+    report = {'prefix': prefix, 'start': time.time(), 'steps': [], 'profiler': None}
+    if profile:
+        report['profiler'] = cProfile.Profile()
+        report['profiler'].enable()
+    return report
 
-        z5 = rb.ReadAsArray(px - dx if px > 0 else px, py - dy if py > 0 else py, 1, 1)
-        z5 = z5[0] if z5 is not None else rb.GetNoDataValue()
 
-        z6 = rb.ReadAsArray(px + dx if px < raster.RasterXSize else px, py - dy if py > 0 else py, 1, 1)
-        z6 = z6[0] if z6 is not None else rb.GetNoDataValue()
+# Records the step's wall time and the peak memory so far. report may be None
+def record_step(report, name, seconds):
+    if report is None:
+        return
+
+    report['steps'].append({'name': name,
+                            'seconds': seconds,
+                            'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                            'children_maxrss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss})
+
+
+@contextlib.contextmanager
+def timed_step(report, name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        record_step(report, name, time.time() - start)
+
+
+def finish_report(report):
+    with open(report['prefix'] + '.json', 'w') as f:
+        json.dump({'seconds': time.time() - report['start'], 'steps': report['steps']}, f, indent=4)
+
+    profiler = report['profiler']
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(report['prefix'] + '_profile.pstats')
+        with open(report['prefix'] + '_profile.txt', 'w') as f:
+            pstats.Stats(profiler, stream=f).sort_stats('cumulative').print_stats(50)
+
+
+# reproject stage: warps the input DEM into srs_out, filling the nodata with -9999
+def reproject_dem(dem_filename, out_name, srs_out):
+    subprocess.check_call(['gdalwarp %s %s -overwrite -dstnodata -9999 -t_srs \"%s\"' % (
+        dem_filename, out_name, srs_out.ExportToProj4())], shell=True)
+
+
+# smooth stage: resamples prefix_projected_0.tif with cubic splines max_smooth_iter times, the last one is written to
+# prefix_projected.tif
+def smooth_dem(prefix, pixel_width, pixel_height, scaling_factor, max_smooth_iter, report=None):
+    for iter in range(max_smooth_iter):
+        start = time.time()
+
+        in_name = prefix + '_projected_%d.tif' % (iter)
+        out_name = prefix + '_projected_%d.tif' % (iter + 1)
+
+        if iter+1 == max_smooth_iter: #last iteration, change output
+            out_name = prefix + '_projected.tif'
+
+        subprocess.check_call(['gdalwarp %s %s -overwrite -dstnodata -9999 -r cubicspline -tr %f %f' % (
+            in_name, out_name, abs(pixel_width) / scaling_factor,
+            abs(pixel_height) / scaling_factor)], shell=True)
+
+        scaling_factor *= (iter+1)
+        record_step(report, 'smooth iteration %d' % iter, time.time() - start)
+
+
+# resample stage: warps a parameter or initial condition raster onto the extent and resolution of the projected DEM.
+# warp_mode 'subprocess' runs gdalwarp, 'gdal' uses the in-process gdal.Warp with num_threads warper threads, writing
+# a VRT if out_name ends in .vrt. kind is only used in the error message. Raises on failure.
+def resample_raster(kind, fname, out_name, method, proj4, extent, pixel_width, pixel_height, warp_mode='subprocess', num_threads=1):
+    if method == 'mode':
+        resample_alg = 'mode'
+    else:
+        resample_alg = 'average'
+
+    if gdal.Open(fname).GetProjection() == '':
+        raise RuntimeError(kind + " " + fname + " must have spatial reference information.")
+
+    xmin, ymin, xmax, ymax = extent
+
+    if warp_mode == 'gdal':
+        fmt = 'GTiff'
+        if out_name.endswith('.vrt'):
+            fmt = 'VRT'
+        options = gdal.WarpOptions(format=fmt, dstSRS=proj4, dstNodata=-9999, outputBounds=extent,
+                                   xRes=abs(pixel_width), yRes=abs(pixel_height), resampleAlg=resample_alg,
+                                   multithread=num_threads > 1, warpOptions=['NUM_THREADS=%d' % num_threads])
+        if os.path.exists(out_name):
+            os.remove(out_name)
+        if gdal.Warp(out_name, fname, options=options) is None:
+            raise RuntimeError('gdal.Warp could not write ' + out_name)
+    else:
+        exec_str = 'gdalwarp %s %s -overwrite -dstnodata -9999 -t_srs "%s" -te %f %f %f %f  -tr %f %f -r ' + resample_alg
+        subprocess.check_call([exec_str % (
+                fname, out_name, proj4, xmin, ymin, xmax, ymax, pixel_width,
+                pixel_height)], shell=True)
+
+
+# Runs resample_raster for each tuple of arguments in warp_args. The work is done by gdalwarp or GDAL's warper, which
+# don't hold the GIL, so a pool of at most n_workers threads is enough. Returns, in order, (error, seconds) for each
+# raster, the error being None if it was resampled or the message if it failed.
+def run_warps(warp_args, n_workers):
+    n_workers = max(1, min(n_workers, len(warp_args)))
+
+    # share the cores between the concurrent warps
+    num_threads = max(1, multiprocessing.cpu_count() // n_workers)
+
+    pool = multiprocessing.pool.ThreadPool(n_workers)
+    try:
+        return pool.map(warp_one, [args + (num_threads,) for args in warp_args])
+    finally:
+        pool.close()
+        pool.join()
+
+
+def warp_one(args):
+    start = time.time()
+    try:
+        resample_raster(*args)
+    except Exception as e:
+        return str(e), time.time() - start
+    return None, time.time() - start
+
+
+# The largest polygon of valid data of the DEM, and its spatial reference. The nodata mask is built a block of rows at
+# a time in an in-memory Byte raster and polygonized into an in-memory layer. With debug, the mask and the polygon are
+# also written to mask_<base_name>.tif and <base_name>.shp in base_dir.
+def polygonize_dem(src_ds, base_dir, base_name, debug=False, block_rows=1024):
+    dem = src_ds.GetRasterBand(1)
+    nodata = dem.GetNoDataValue()
+    xsize = src_ds.RasterXSize
+    ysize = src_ds.RasterYSize
+
+    mask_ds = gdal.GetDriverByName('MEM').Create('', xsize, ysize, 1, gdal.GDT_Byte)
+    mask_ds.SetGeoTransform(src_ds.GetGeoTransform())
+    mask_ds.SetProjection(src_ds.GetProjection())
+    mask = mask_ds.GetRasterBand(1)
+    mask.SetNoDataValue(0)
+
+    for y in range(0, ysize, block_rows):
+        Z = dem.ReadAsArray(0, y, xsize, min(block_rows, ysize - y))
+        valid = ~np.isnan(Z) if nodata is None else Z != nodata
+        mask.WriteArray(valid.astype(np.uint8), 0, y)
+
+    if debug:
+        gdal.GetDriverByName('GTiff').CreateCopy(base_dir + 'mask_' + base_name + '.tif', mask_ds)
+
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(src_ds.GetProjection())
+
+    # raster -> polygons, the mask band is also its own mask so only the valid areas are polygonized
+    polygons_ds = ogr.GetDriverByName('Memory').CreateDataSource('polygonize')
+    layer = polygons_ds.CreateLayer('polygonize', srs, ogr.wkbPolygon)
+    layer.CreateField(ogr.FieldDefn('DN', ogr.OFTInteger))
+    gdal.Polygonize(mask, mask, layer, 0, [], callback=None)
+
+    #find the largest polygon and keep it
+    max_geom_area = -1
+    max_feature_ID = None
+    geom = None
+    for feature in layer:
+        area = feature.GetGeometryRef().GetArea()
+        if area > max_geom_area:
+            max_feature_ID = feature.GetFID()
+            max_geom_area = area
+            geom = feature.GetGeometryRef().Clone()
+
+    if geom is None:
+        print 'No valid data in the DEM to polygonize'
+        exit(1)
+
+    print 'Using FID = ' + str(max_feature_ID) + " as the largest continous area."
+
+    if debug:
+        write_geometry(base_dir + base_name + '.shp', srs, geom)
+
+    return geom, srs
+
+
+# Writes geom as the only feature of a new shapefile
+def write_geometry(fname, srs, geom):
+    driver = ogr.GetDriverByName('ESRI Shapefile')
+    if os.path.exists(fname):
+        driver.DeleteDataSource(fname)
+
+    ds = driver.CreateDataSource(fname)
+    layer = ds.CreateLayer(os.path.splitext(os.path.basename(fname))[0], srs, geom.GetGeometryType())
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(geom)
+    layer.CreateFeature(feature)
+    ds = None  # close the file
+
+
+# PLGS stage: the outline of the largest polygon of valid data of the DEM, optionally buffered and simplified, written as
+# the Triangle .poly file that constrains the triangulation. This is all done in memory, with debug the intermediate
+# rasters and polygons are also written to base_dir.
+def create_plgs(src_ds, base_dir, base_name, poly_file, simplify, simplify_tol, bufferDist, no_simplify_buffer,
+                debug=False, report=None):
+    with timed_step(report, 'PLGS polygonize'):
+        geom, srs = polygonize_dem(src_ds, base_dir, base_name, debug)
+
+    if simplify and not no_simplify_buffer:
+        print 'Simplifying extents by buffer distance = ' + str(bufferDist)
+        with timed_step(report, 'PLGS buffer'):
+            geom = geom.Buffer(bufferDist)
+        if debug:
+            write_geometry(base_dir + 'buffered_' + base_name + '.shp', srs, geom)
+
+    if simplify:
+        with timed_step(report, 'PLGS simplify'):
+            geom = geom.SimplifyPreserveTopology(simplify_tol)
+        if debug:
+            write_geometry(base_dir + 'simplified_' + base_name + '.shp', srs, geom)
+
+    if geom is None or geom.IsEmpty():
+        print 'The domain is empty after buffering and simplifying. Try reducing simplify_buffer or simplify_tol.'
+        exit(1)
+
+    # a negative buffer can split the domain, use the largest part. Need to add in more to support rivers and lakes,
+    # for now the holes are ignored and only the exterior ring is used
+    if ogr.GT_Flatten(geom.GetGeometryType()) == ogr.wkbMultiPolygon:
+        geom = max([geom.GetGeometryRef(i).Clone() for i in range(geom.GetGeometryCount())], key=lambda g: g.GetArea())
+
+    # closed ring, the first point is repeated at the end
+    coords = geom.GetGeometryRef(0).GetPoints()
+
+    # Create the PLGS to constrain the triangulation
+    start = time.time()
+    with open(base_dir +
+                      poly_file, 'w') as f:
+        header = '%d 2 0 0\n' % (len(coords))
+        f.write(header)
+        vert = 1
+        for c in coords:
+            f.write('%d %17.11f %17.11f\n' % (vert, c[0], c[1]))
+            vert = vert + 1
+
+        f.write('\n')
+        header = '%d 0\n' % (len(coords))
+        f.write(header)
+
+        for i in range(len(coords)):
+            if i + 1 == len(coords):  # last time has to loop back to start
+                f.write('%d %d %d\n' % (i + 1, i + 1, 1))
+            else:
+                f.write('%d %d %d\n' % (i + 1, i + 1, i + 2))
+
+        f.write('0\n')
+
+    record_step(report, 'PLGS write poly', time.time() - start)
+
+
+# Reads the .1.node, .1.ele and .1.neigh files the mesher binary wrote for prefix (e.g., PLGSbow) into arrays:
+# the vertex (x, y) coordinates and the zero-indexed elem and neigh, -1 being no neighbour.
+# The .npy copies written with --binary-output are memory mapped if they are present and up to date,
+# otherwise the text files are parsed.
+def read_mesh_files(prefix):
+    files = [prefix + ext for ext in ('.1.node', '.1.ele', '.1.neigh')]
+
+    if all(os.path.exists(f + '.npy') and os.path.getmtime(f + '.npy') >= os.path.getmtime(f) for f in files):
+        return tuple(np.load(f + '.npy', mmap_mode='r') for f in files)
+
+    vertex = np.loadtxt(files[0], skiprows=1, usecols=(1, 2), ndmin=2)
+    elem = np.loadtxt(files[1], skiprows=1, usecols=(1, 2, 3), dtype=np.int64, ndmin=2) - 1  # convert to zero indexing
+    neigh = np.loadtxt(files[2], skiprows=1, usecols=(1, 2, 3), dtype=np.int64, ndmin=2) - 1
 
-        z7 = rb.ReadAsArray(px - dx if px > 0 else px, py + dy if py < raster.RasterYSize else py, 1, 1)
-        z7 = z7[0] if z7 is not None else rb.GetNoDataValue()
+    return vertex, elem, neigh
 
-        z8 = rb.ReadAsArray(px + dx if px < raster.RasterXSize else px, py - dy if py > 0 else py, 1, 1)
-        z8 = z8[0] if z8 is not None else rb.GetNoDataValue()
 
-        z = [z1, z2, z3, z4, z5, z6, z7, z8]
-        z = [x for x in z if x != rb.GetNoDataValue()]
+# Repairs the z of the nodes flagged in invalid (boolean mask, e.g., nodes on DEM nodata) in place, using the mean
+# z of the valid nodes they share a triangle with. This is repeated until nothing changes, so invalid nodes that only
+# neighbour other invalid nodes are filled from the outside in.
+# Returns the indexes of the nodes that could not be repaired, i.e., those with no valid node connected to them.
+def fill_invalid_nodes(z, elem, invalid):
+    invalid = np.array(invalid, dtype=bool)
+    elem = np.asarray(elem, dtype=np.int64)
 
-        if len(z) == 0:
-            #print 'Warning: The point (%f,%f) and its 8-neighbours lies outside of the DEM domain' % (mx, my)
-            return rb.GetNoDataValue()
+    # each (node, other node of the same triangle) pair, only kept for the invalid nodes
+    node = elem[:, [0, 0, 1, 1, 2, 2]].ravel()
+    other = elem[:, [1, 2, 0, 2, 0, 1]].ravel()
+    keep = invalid[node]
+    pairs = np.unique(node[keep] * len(z) + other[keep])  # an edge is shared by two triangles, only count it once
+    node = pairs // len(z)
+    other = pairs % len(z)
 
+    while len(node) > 0:
+        usable = ~invalid[other]
+        if not usable.any():
+            break
+
+        total = np.bincount(node[usable], weights=z[other[usable]], minlength=len(z))
+        count = np.bincount(node[usable], minlength=len(z))
+
+        fixed = count > 0
+        z[fixed] = total[fixed] / count[fixed]
+        invalid[fixed] = False
+
+        keep = invalid[node]
+        node = node[keep]
+        other = other[keep]
+
+    return np.flatnonzero(invalid)
+
+
+# Reads the first band of a raster into memory once, so points can be sampled from it with NumPy
+# instead of a GDAL round trip per point. window = (xoff, yoff, xsize, ysize) reads only that part of the band; pixel
+# coordinates stay those of the whole raster.
+def load_raster(raster, window=None):
+    rb = raster.GetRasterBand(1)
+    if window is None:
+        window = (0, 0, raster.RasterXSize, raster.RasterYSize)
+    return {'array': rb.ReadAsArray(*window),
+            'gt': raster.GetGeoTransform(),
+            'nodata': rb.GetNoDataValue(),
+            'xoff': window[0],
+            'yoff': window[1],
+            'xsize': raster.RasterXSize,
+            'ysize': raster.RasterYSize}
+
+
+# Vectorized point sampling of a raster from load_raster for arrays of map coordinates mx, my.
+# Only works for geotransforms with no rotation.
+# If a point lands on nodata, the mean of its valid 8-neighbours is used instead. Points with no valid
+# neighbours get the raster's nodata value. With a window, the points and their neighbours must be inside it.
+def extract_points(raster, mx, my):
+    array = raster['array']
+    gt = raster['gt']
+    nodata = raster['nodata']
+    xoff = raster['xoff']
+    yoff = raster['yoff']
+    xsize = raster['xsize']
+    ysize = raster['ysize']
+
+    # Convert from map to pixel coordinates.
+    px = ((np.asarray(mx, dtype=np.float64) - gt[0]) / gt[1]).astype(np.int64)
+    py = ((np.asarray(my, dtype=np.float64) - gt[3]) / gt[5]).astype(np.int64)
+
+    # boundary verticies from Triangle can end up outside of the domain by 1 pixel.
+    # if we adjusted back by 1 pixel to get the dz value, it's no problem and still gives a good boundary
+    px = np.clip(px, 0, xsize - 1)
+    py = np.clip(py, 0, ysize - 1)
+
+    def is_nodata(z):
+        if nodata is None:
+            return np.isnan(z)
+        return z == nodata
+
+    mz = array[py - yoff, px - xoff].astype(np.float64)
+    missing = np.flatnonzero(is_nodata(mz))
+
+    if len(missing) > 0:
+        px = px[missing]
+        py = py[missing]
+        total = np.zeros(len(missing))
+        count = np.zeros(len(missing))
+
+        # attempt to pick points from the surrounding 8
+        for dx, dy in ((-1, 0), (1, 0), (0, 1), (0, -1), (-1, -1), (1, -1), (-1, 1), (1, 1)):
+            nx = px + dx
+            ny = py + dy
+            valid = (nx >= 0) & (nx < xsize) & (ny >= 0) & (ny < ysize)
+            z = array[np.clip(ny, 0, ysize - 1) - yoff, np.clip(nx, 0, xsize - 1) - xoff].astype(np.float64)
+            valid &= ~is_nodata(z)
+            total[valid] += z[valid]
+            count[valid] += 1
+
+        mz[missing] = np.where(count > 0, total / np.maximum(count, 1), nodata if nodata is not None else np.nan)
 
-        mz = float(np.mean(z))
     return mz
 
 
-def rasterize_elem(data, feature, key):
+# Enumerate every raster cell touched by each triangle, matching gdal.RasterizeLayer with ALL_TOUCHED=TRUE.
+# Each triangle is scan converted row by row: the x extent of the triangle clipped to the row's strip gives
+# a contiguous run of touched columns. Cells are half-open in pixel space, so an edge lying exactly on a grid
+# line touches the cell to its right/below, as GDAL does. GDAL burns each edge from its left end up to, but not
+# including, its right end, so a cell touched only by the rightmost vertex, where two sloped edges end, is left out.
+# Yields (tri, row, col) index arrays in chunks of whole triangles so memory stays bounded for large meshes.
+# A cell touched by several triangles is reported once for each of them.
+def triangle_cells(gt, rasterXsize, rasterYsize, vertex, elem, max_cells=4000000):
+    vertex = np.asarray(vertex, dtype=np.float64)
+    elem = np.asarray(elem, dtype=np.int64)
+
+    # triangle vertices in pixel space, shape (nelem, 3)
+    px = (vertex[elem, 0] - gt[0]) / gt[1]
+    py = (vertex[elem, 1] - gt[3]) / gt[5]
+
+    # bounding box in cells, clipped to the raster
+    r0 = np.maximum(np.floor(py.min(axis=1)), 0).astype(np.int64)
+    r1 = np.minimum(np.floor(py.max(axis=1)), rasterYsize - 1).astype(np.int64)
+    c0 = np.maximum(np.floor(px.min(axis=1)), 0).astype(np.int64)
+    c1 = np.minimum(np.floor(px.max(axis=1)), rasterXsize - 1).astype(np.int64)
+
+    nrows = np.maximum(r1 - r0 + 1, 0)
+    ncols = np.maximum(c1 - c0 + 1, 0)
+
+    # row of the cell touched only by the rightmost vertex, -1 if there is none: the vertex is on a column line, or on a
+    # row line with the rest of the triangle above it. GDAL burns an edge within one row or column, or within .01 pixel
+    # of horizontal or vertical, end to end, so both edges to the vertex have to cross a row and a column line
+    idx = np.arange(len(elem))
+    k = px.argmax(axis=1)
+    tip_x = px[idx, k][:, np.newaxis]
+    tip_y = py[idx, k][:, np.newaxis]
+    other_x = np.column_stack((px[idx, (k + 1) % 3], px[idx, (k + 2) % 3]))
+    other_y = np.column_stack((py[idx, (k + 1) % 3], py[idx, (k + 2) % 3]))
+    sloped = (np.floor(other_x) != np.floor(tip_x)) & (np.floor(other_y) != np.floor(tip_y))
+    sloped &= (np.abs(tip_x - other_x) >= .01) & (np.abs(tip_y - other_y) >= .01)
+    tip = (other_x < tip_x).all(axis=1) & sloped.all(axis=1)
+    tip &= (tip_x == np.floor(tip_x))[:, 0] | ((tip_y == np.floor(tip_y))[:, 0] & (other_y < tip_y).all(axis=1))
+    tip_row = np.where(tip, np.floor(tip_y[:, 0]), -1).astype(np.int64)
+
+    # split on the bounding box cell count so a chunk never materializes much more than max_cells pairs
+    est = np.cumsum(nrows * ncols)
+    splits = np.searchsorted(est, np.arange(max_cells, est[-1] if len(est) else 0, max_cells))
+    bounds = np.unique(np.r_[0, splits, len(elem)])
+
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        tri = np.arange(start, end)
+
+        # one entry per (triangle, row)
+        n = nrows[tri]
+        tri = np.repeat(tri, n)
+        if len(tri) == 0:
+            continue
+        row = r0[tri] + np.arange(len(tri)) - np.repeat(np.cumsum(n) - n, n)
+
+        x = px[tri]
+        y = py[tri]
+        ylo = row.astype(np.float64)[:, np.newaxis]
+        yhi = ylo + 1.
+
+        # candidate x coordinates: vertices inside the strip...
+        inside = (y >= ylo) & (y < yhi)
+        xmin = np.where(inside | (y == yhi), x, np.inf).min(axis=1)
+        xmax = np.where(inside, x, -np.inf).max(axis=1)
+
+        # the strip's bottom line belongs to the next row, if the triangle only reaches its furthest x there the
+        # strip gets arbitrarily close to it, but doesn't touch a cell starting at it
+        xlim = np.where(y == yhi, x, -np.inf).max(axis=1)
+
+        # ... and each edge's crossing of the strip's top and bottom lines
+        for a, b in ((0, 1), (1, 2), (2, 0)):
+            xa, ya = x[:, a:a + 1], y[:, a:a + 1]
+            xb, yb = x[:, b:b + 1], y[:, b:b + 1]
+            dy = yb - ya
+            with np.errstate(divide='ignore', invalid='ignore'):
+                for yl in (ylo, yhi):
+                    cross = (dy != 0) & (yl >= np.minimum(ya, yb)) & (yl <= np.maximum(ya, yb))
+                    xc = (xa + (yl - ya) * (xb - xa) / dy)[:, 0]
+                    cross = cross[:, 0]
+                    xmin = np.where(cross, np.minimum(xmin, xc), xmin)
+                    if yl is ylo:
+                        xmax = np.where(cross, np.maximum(xmax, xc), xmax)
+                    else:
+                        xlim = np.where(cross, np.maximum(xlim, xc), xlim)
+
+        xmax = np.where(xlim > xmax, np.ceil(xlim) - 1, np.floor(xmax)) - (row == tip_row[tri])
+        col0 = np.maximum(np.floor(xmin), c0[tri]).astype(np.int64)
+        col1 = np.minimum(xmax, c1[tri]).astype(np.int64)
+        m = np.maximum(col1 - col0 + 1, 0)
+
+        # one entry per (triangle, row, column)
+        offset = np.arange(m.sum()) - np.repeat(np.cumsum(m) - m, m)
+        yield np.repeat(tri, m), np.repeat(row, m), np.repeat(col0, m) + offset
+
+
+# Zonal statistics of a raster under every triangle of the mesh in one pass over the raster.
+# Supports the 'mean' and 'mode' aggregations, triangles with no valid cells get the raster's nodata value.
+# For 'mode' that replaces scipy.stats.mstats.mode of an all masked array, which has no defined value.
+# Gives the same per-triangle values as rasterizing each triangle on its own with ALL_TOUCHED=TRUE.
+# Only the window of the raster covered by the triangles is read.
+def zonal_stats(data, vertex, elem):
     raster = data['file']
-    wkt = raster.GetProjection()
-    srs = osr.SpatialReference()
-    srs.ImportFromWkt(wkt)
-    gt = raster.GetGeoTransform()
     rb = raster.GetRasterBand(1)
-    geom = feature.geometry()
-    src_offset = bbox_to_pixel_offsets(gt, geom.GetEnvelope(), raster.RasterXSize, raster.RasterYSize)
-    src_array = rb.ReadAsArray(*src_offset)
-    # calculate new geotransform of the feature subset
-    new_gt = (
-        (gt[0] + (src_offset[0] * gt[1])),
-        gt[1],
-        0.0,
-        (gt[3] + (src_offset[1] * gt[5])),
-        0.0,
-        gt[5]
-    )
-
-    # Create a temporary vector layer in memory
-    mem_drv = ogr.GetDriverByName('Memory')
-    mem_ds = mem_drv.CreateDataSource('out')
-    mem_layer = mem_ds.CreateLayer('poly', srs, ogr.wkbPolygon)
-    mem_layer.CreateFeature(feature.Clone())
-
-    # Rasterize it
-    driver = gdal.GetDriverByName('MEM')
-    rvds = driver.Create('', src_offset[2], src_offset[3], 1, gdal.GDT_Byte)
-    rvds.SetGeoTransform(new_gt)
-    rvds.SetProjection(wkt)
-    err = gdal.RasterizeLayer(rvds, [1], mem_layer, burn_values=[1], options=['ALL_TOUCHED=TRUE'])
-    if err != 0:
-        raise Exception("error rasterizing layer: %s" % err)
-
-    rv_array = rvds.ReadAsArray()  # holds a mask of where the triangle is on the raster
-    # Mask the source data array with our current feature
-    # we take the logical_not to flip 0<->1 to get the correct mask effect
-    # we also mask out nodata values explictly
-    masked = np.ma.MaskedArray(
-        src_array,
-        mask=np.logical_or(
-            src_array == rb.GetNoDataValue(),
-            np.logical_not(rv_array)
-        )
-    )
-    # feature_stats = {
-    #     'min': float(masked.min()),
-    #     'mean': float(masked.mean()),
-    #     'max': float(masked.max()),
-    #     'std': float(masked.std()),
-    #     'sum': float(masked.sum()),
-    #     'count': int(masked.count()),
-    #     'fid': int(feat.GetFID())
-    # }
-    output = rb.GetNoDataValue()
-    # we have a triangle that only touches a no-value. So give up and use surrounding values.
-    # if masked.count() == 0:
-    #     masked = np.ma.masked_where(
-    #         src_array == rb.GetNoDataValue(), src_array)
-    if data['method'] == 'mode':
-        output = sp.mode(masked.flatten())[0][0]
-    elif data['method'] == 'mean':
-        if masked.count() > 0:
-            output = float(
-                masked.mean())  # if it's entirely masked, then we get nan and a warning printed to stdout. would like to avoid showing this warning.
+    gt = raster.GetGeoTransform()
+    nodata = rb.GetNoDataValue()
+
+    method = data['method']
+    if method not in ('mean', 'mode'):
+        print 'Error: unknown data aggregation method %s' % method
+        exit(1)
+
+    vertex = np.asarray(vertex, dtype=np.float64)
+    elem = np.asarray(elem, dtype=np.int64).reshape(-1, 3)
+
+    nelem = len(elem)
+    output = np.empty(nelem)
+    output.fill(nodata if nodata is not None else np.nan)
+    if nelem == 0:
+        return output
+
+    # window of the raster under these triangles. Computed the same way as triangle_cells does
+    # so the cell indices it returns are identical whatever subset of the mesh we are given
+    used = vertex[np.unique(elem)]
+    px = np.floor((used[:, 0] - gt[0]) / gt[1])
+    py = np.floor((used[:, 1] - gt[3]) / gt[5])
+    xoff = int(min(max(px.min(), 0), raster.RasterXSize - 1))
+    yoff = int(min(max(py.min(), 0), raster.RasterYSize - 1))
+    xsize = int(min(max(px.max(), 0), raster.RasterXSize - 1)) - xoff + 1
+    ysize = int(min(max(py.max(), 0), raster.RasterYSize - 1)) - yoff + 1
+    src_array = rb.ReadAsArray(xoff, yoff, xsize, ysize)
+
+    sums = np.zeros(nelem)
+    counts = np.zeros(nelem)
+
+    for tri, row, col in triangle_cells(gt, raster.RasterXSize, raster.RasterYSize, vertex, elem):
+        value = src_array[row - yoff, col - xoff].astype(np.float64)
+
+        valid = ~np.isnan(value)
+        if nodata is not None:
+            valid &= value != nodata
+        tri = tri[valid]
+        value = value[valid]
+
+        if method == 'mean':
+            sums += np.bincount(tri, weights=value, minlength=nelem)
+            counts += np.bincount(tri, minlength=nelem)
+        else:
+            # every triangle lives entirely in one chunk, so the mode can be resolved here.
+            # Sort by (triangle, value) and run-length encode; the mode is the longest run,
+            # with ties going to the smallest value as scipy.stats.mstats.mode does.
+            order = np.lexsort((value, tri))
+            tri = tri[order]
+            value = value[order]
+
+            run_start = np.flatnonzero(np.r_[True, (tri[1:] != tri[:-1]) | (value[1:] != value[:-1])])
+            run_len = np.diff(np.r_[run_start, len(value)])
+            run_tri = tri[run_start]
+            run_value = value[run_start]
+
+            order = np.lexsort((run_value, -run_len, run_tri))
+            run_tri = run_tri[order]
+            first = np.r_[True, run_tri[1:] != run_tri[:-1]]
+            output[run_tri[first]] = run_value[order][first]
+
+    if method == 'mean':
+        has_data = counts > 0
+        output[has_data] = sums[has_data] / counts[has_data]
+
+    return output
+
+
+# Planar area of every triangle (shoelace formula), the same as ogr.Geometry.GetArea on the triangle.
+def triangle_area(vertex, elem):
+    vertex = np.asarray(vertex, dtype=np.float64)
+    x = vertex[elem, 0]
+    y = vertex[elem, 1]
+    return 0.5 * np.abs((x[:, 1] - x[:, 0]) * (y[:, 2] - y[:, 0]) - (x[:, 2] - x[:, 0]) * (y[:, 1] - y[:, 0]))
+
+
+# Computes every per-triangle attribute for the given triangles:
+#   - one array per raster in rasters, a list of (name, filename, method). The rasters are opened here
+#     so this can run in a worker process with its own GDAL handles
+#   - 'area' if area_wkt = (src_wkt, dst_wkt) is given; the triangles are projected to dst_wkt first (geographic meshes)
+#   - 'Elevation', the mean vertex elevation used for the vtu
+# Returns the attributes and the seconds spent on each raster
+def compute_attributes(args):
+    vertex, elem, rasters, area_wkt = args
+
+    attributes = {}
+    seconds = {}
+    for name, filename, method in rasters:
+        start = time.time()
+        attributes[name] = zonal_stats({'file': gdal.Open(filename), 'method': method}, vertex, elem)
+        seconds[name] = time.time() - start
+
+    if area_wkt is not None:
+        src = osr.SpatialReference()
+        src.ImportFromWkt(area_wkt[0])
+        dst = osr.SpatialReference()
+        dst.ImportFromWkt(area_wkt[1])
+        transform = osr.CoordinateTransformation(src, dst)
+        projected = np.array(transform.TransformPoints(vertex[:, 0:2].tolist())).reshape(-1, 3)
+        attributes['area'] = triangle_area(projected, elem)
+
+    z = vertex[elem, 2]
+    attributes['Elevation'] = (z[:, 0] + z[:, 1] + z[:, 2]) / 3.
+
+    return attributes, seconds
+
+
+# Runs compute_attributes over n_workers processes. The elements are split into contiguous chunks,
+# each worker only receives the vertices its chunk uses, and the results are merged back in triangle order
+# so the output is identical to a serial run. The seconds of each raster are summed over the workers.
+def compute_attributes_parallel(vertex, elem, rasters, area_wkt, n_workers):
+    vertex = np.asarray(vertex, dtype=np.float64)
+    elem = np.asarray(elem, dtype=np.int64).reshape(-1, 3)
+
+    if n_workers <= 1 or len(elem) < n_workers:
+        return compute_attributes((vertex, elem, rasters, area_wkt))
+
+    chunks = []
+    for e in np.array_split(elem, n_workers):
+        ids, local = np.unique(e, return_inverse=True)
+        chunks.append((vertex[ids], local.reshape(-1, 3), rasters, area_wkt))
+
+    pool = multiprocessing.Pool(n_workers)
+    try:
+        results = pool.map(compute_attributes, chunks)
+    finally:
+        pool.close()
+        pool.join()
+
+    attributes = dict((key, np.concatenate([r[0][key] for r in results])) for key in results[0][0])
+    seconds = dict((key, sum(r[1][key] for r in results)) for key in results[0][1])
+    return attributes, seconds
+
+
+# Writes obj (nested dicts of scalars, lists and NumPy arrays) to fname as JSON, the same as json.dump would.
+# Arrays are streamed out a block of rows at a time rather than first being turned into nested Python lists,
+# which keeps peak memory down for large meshes. In the indented layout each array row is written on its own line;
+# indent=None writes compact JSON with no whitespace at all.
+def write_json(obj, fname, indent=4, block_size=100000):
+    if indent is None:
+        separators = (',', ':')
     else:
-        print 'Error: unknown data aggregation method %s' % data['method']
+        separators = (', ', ': ')
+
+    def newline(level):
+        if indent is None:
+            return ''
+        return '\n' + ' ' * (indent * level)
+
+    def write(f, value, level):
+        if isinstance(value, dict):
+            f.write('{')
+            for n, (key, item) in enumerate(value.iteritems()):
+                if n > 0:
+                    f.write(',')
+                f.write(newline(level + 1) + json.dumps(key) + separators[1])
+                write(f, item, level + 1)
+            f.write(newline(level) + '}')
+        elif isinstance(value, np.ndarray) and value.ndim > 0:
+            row_sep = ',' + newline(level + 1)
+            f.write('[')
+            if len(value) > 0:
+                f.write(newline(level + 1))
+            for start in xrange(0, len(value), block_size):
+                if start > 0:
+                    f.write(row_sep)
+                block = value[start:start + block_size].tolist()
+                if value.ndim == 1:
+                    block = json.dumps(block, separators=(',', ':'))[1:-1].replace(',', row_sep)
+                else:
+                    block = json.dumps(block, separators=separators)[1:-1].replace('],' + separators[0][1:] + '[', ']' + row_sep + '[')
+                f.write(block)
+            if len(value) > 0:
+                f.write(newline(level))
+            f.write(']')
+        else:
+            if isinstance(value, np.generic) or isinstance(value, np.ndarray):
+                value = value.tolist()
+            text = json.dumps(value, indent=indent, separators=(separators[0].rstrip(), separators[1]))
+            if indent is not None:
+                text = text.replace('\n', newline(level))
+            f.write(text)
 
-    feature.SetField(key, output)
+    with open(fname, 'w') as f:
+        write(f, obj, 0)
 
-#testing code
-    # if output < 0:
-    #     print "Found < 0"
-    #
-    #     # testing code
-    #     tri_id = str(feature.GetField('triangle'))
-    #     print "Tri ID = " + tri_id
-    #
-    #     print masked
-    #
-    #     mem_drv = ogr.GetDriverByName('ESRI Shapefile')
-    #     mem_ds = mem_drv.CreateDataSource(tri_id+'.shp')
-    #     mem_layer = mem_ds.CreateLayer('poly', srs, ogr.wkbPolygon)
-    #     mem_layer.CreateFeature(feature.Clone())
-    #
-    #     driver = gdal.GetDriverByName('GTiff')
-    #     rvds = driver.Create(tri_id+'.tiff', src_offset[2], src_offset[3], 1, gdal.GDT_Float32)
-    #     rvds.SetGeoTransform(new_gt)
-    #     rvds.SetProjection(wkt)
-    #     outband = rvds.GetRasterBand(1)
-    #     outband.WriteArray(src_array)
-    #     # gdal.RasterizeLayer(rvds, [1], mem_layer, burn_values=[1], options=['ALL_TOUCHED=TRUE'])
-    #
-    #     rvds = None
-    #     mem_layer = None
-    #     exit(1)
 
+# Saves the arrays and scalars in a (flat) dict as an uncompressed NumPy .npz, a binary sidecar to the JSON files that can be
+# loaded with np.load without any parsing.
+def write_npz(obj, fname):
+    np.savez(fname, **dict((key, np.asarray(value)) for key, value in obj.iteritems()))
 
-    return output
+
+# Polygon WKB of a triangle: byte order, geometry type, one ring of four points (the first point repeated to close it)
+wkb_triangle = np.dtype([('order', 'u1'), ('type', '<u4'), ('nrings', '<u4'), ('npoints', '<u4'), ('xy', '<f8', (8,))])
+
+# Writes the triangulation to an OGR layer in bulk. fields maps the field names to (ogr field type, per triangle values),
+# values of None leave that field unset. The geometries are built as one WKB buffer from the vertex and elem arrays and the
+# features are created inside transactions of batch_size triangles.
+def write_usm(fname, fmt, srs, layer_name, vertex, elem, fields, batch_size=50000):
+    driver = ogr.GetDriverByName(fmt)
+    if driver is None:
+        print 'The OGR driver %s is not available in this version of GDAL' % fmt
+        exit(1)
+
+    # gdal won't overwrite an existing file
+    if os.path.exists(fname):
+        driver.DeleteDataSource(fname)
+
+    ds = driver.CreateDataSource(fname)
+    layer = ds.CreateLayer(layer_name, srs, ogr.wkbPolygon)
+    for name, (field_type, values) in fields.iteritems():
+        layer.CreateField(ogr.FieldDefn(name, field_type))
+
+    defn = layer.GetLayerDefn()
+    field_idx = [(defn.GetFieldIndex(name), values) for name, (field_type, values) in fields.iteritems() if values is not None]
+
+    nelem = len(elem)
+    for start in xrange(0, nelem, batch_size):
+        printProgress(start, nelem)
+
+        tri = elem[start:start + batch_size]
+        wkb = np.empty(len(tri), dtype=wkb_triangle)
+        wkb['order'] = 1  # little endian
+        wkb['type'] = ogr.wkbPolygon
+        wkb['nrings'] = 1
+        wkb['npoints'] = 4
+        wkb['xy'][:, 0:6:2] = vertex[tri, 0]
+        wkb['xy'][:, 1:6:2] = vertex[tri, 1]
+        wkb['xy'][:, 6:8] = wkb['xy'][:, 0:2]
+        wkb = wkb.tostring()
+
+        values = [(idx, v[start:start + batch_size].tolist()) for idx, v in field_idx]
+
+        layer.StartTransaction()
+        for i in xrange(len(tri)):
+            feature = ogr.Feature(defn)
+            feature.SetGeometryDirectly(ogr.CreateGeometryFromWkb(wkb[i * wkb_triangle.itemsize:(i + 1) * wkb_triangle.itemsize]))
+            for idx, v in values:
+                feature.SetField(idx, v[i])
+            layer.CreateFeature(feature)
+        layer.CommitTransaction()
+
+    ds = None  # close the file
+
+# Writes the triangulation as a .vtu in one shot from the vertex (n,3) and elem (m,3) arrays. cell_data maps array names
+# to per triangle values. The points, connectivity and cell arrays are handed to vtk as whole arrays via numpy_support,
+# and the data is written as raw appended binary, optionally zlib compressed.
+def write_vtu(fname, vertex, elem, cell_data, compress=True):
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(np.ascontiguousarray(vertex, dtype=np.float64), deep=True))
+
+    # legacy cell array layout: 3 v0 v1 v2 for every triangle
+    cells = np.empty((len(elem), 4), dtype=numpy_support.ID_TYPE_CODE)
+    cells[:, 0] = 3
+    cells[:, 1:] = elem
+    triangles = vtk.vtkCellArray()
+    triangles.SetCells(len(elem), numpy_support.numpy_to_vtkIdTypeArray(cells.ravel(), deep=True))
+
+    vtu = vtk.vtkUnstructuredGrid()
+    vtu.SetPoints(points)
+    vtu.SetCells(vtk.VTK_TRIANGLE, triangles)
+
+    for name, values in cell_data.iteritems():
+        arr = numpy_support.numpy_to_vtk(np.ascontiguousarray(values, dtype=np.float32), deep=True)
+        arr.SetName(name)
+        vtu.GetCellData().AddArray(arr)
+
+    vtuwriter = vtk.vtkXMLUnstructuredGridWriter()
+    vtuwriter.SetFileName(fname)
+
+    #check what version of vtk we are using so we can avoid the api conflict
+    #http://www.vtk.org/Wiki/VTK/VTK_6_Migration/Replacement_of_SetInput#Replacement_of_SetInput.28.29_with_SetInputData.28.29_and_SetInputConnection.28.29
+    if vtk.vtkVersion.GetVTKMajorVersion() > 5:
+        vtuwriter.SetInputData(vtu)
+    else:
+        vtuwriter.SetInput(vtu)
+
+    vtuwriter.SetDataModeToAppended()
+    vtuwriter.EncodeAppendedDataOff()
+    if compress:
+        vtuwriter.SetCompressor(vtk.vtkZLibDataCompressor())
+    else:
+        vtuwriter.SetCompressor(None)
+    vtuwriter.Write()
 
 if __name__ == "__main__":
     main()
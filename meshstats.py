@@ -1,20 +1,37 @@
-#Given a mesh in a .shp file and a set of raster, this computes various error metrics of the mesh to the raster
+#Given a mesh from mesher (.1.node/.1.ele, .mesh or the _USM .shp) and a raster, this computes various error metrics of the mesh to the raster
 
-from osgeo import gdal,ogr,osr
+from osgeo import gdal,ogr
 import os
 import numpy as np
 # import matplotlib.pyplot as plt
-import math
 import sys
 import csv
+import json
+import argparse
+import itertools
+import collections
+import multiprocessing
+import tempfile
+import shutil
 
-def main():
-    if len(sys.argv) == 1:
-        print('ERROR: meshstats requires one argument, the directory of the output from a mesher run (e.g.,  mesher.py Bow)')
-        return
+from mesher import triangle_cells, load_raster, extract_points
 
-    # Get name of configuration file/module
-    mesher_output_dir = sys.argv[-1]
+def main():
+    parser = argparse.ArgumentParser(description='Computes the area, angles, and the RMSE and max difference to the DEM '
+                                                 'of every triangle of a mesher run')
+    parser.add_argument('mesher_output_dir', help='The directory of the output from a mesher run (e.g., Bow)')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes [default 1]')
+    parser.add_argument('--chunk-size', type=int, default=100000, help='Triangles per spatial chunk [default 100000]')
+    parser.add_argument('--write-shp', action='store_true',
+                        help='Also write the statistics to the fields of the _USM triangulation')
+    parser.add_argument('--error-raster', action='store_true',
+                        help='Also write the DEM minus mesh residual of every cell as a GeoTIFF, and a csv of the errors '
+                             'per tile of the DEM')
+    parser.add_argument('--tile-size', type=int, default=1000,
+                        help='Size in DEM cells of the square tiles of the --error-raster csv [default 1000]')
+    args = parser.parse_args()
+
+    mesher_output_dir = args.mesher_output_dir
 
     print 'Reading in files'
 
@@ -24,6 +41,12 @@ def main():
     raster_file = os.path.normpath(mesher_output_dir)+'/'+base_name+'_projected.tif'
     shp_file = os.path.normpath(mesher_output_dir)+'/'+base_name+'_USM.shp'
 
+    # the triangulation may have been written as a GeoPackage or FlatGeobuf instead of a shapefile
+    for ext in ['.shp', '.gpkg', '.fgb']:
+        if os.path.exists(os.path.normpath(mesher_output_dir)+'/'+base_name+'_USM'+ext):
+            shp_file = os.path.normpath(mesher_output_dir)+'/'+base_name+'_USM'+ext
+            break
+
     base_name =os.path.basename(os.path.normpath(raster_file))
     base_shp_name =os.path.basename(os.path.normpath(shp_file))
 
@@ -32,15 +55,7 @@ def main():
         print 'Could not open %s' % (raster_ds)
         exit(1)
 
-
-    rb = raster_ds.GetRasterBand(1)
-    src_array = rb.ReadAsArray(0,0,raster_ds.RasterXSize-1,raster_ds.RasterYSize-1)
-    masked = np.ma.masked_where(src_array == rb.GetNoDataValue(),src_array )
-    c = masked.count()
-
-    src_array = None
-    masked = None
-    rb = None
+    c = count_valid_cells(raster_ds.GetRasterBand(1), raster_ds.RasterXSize-1, raster_ds.RasterYSize-1)
     if c == 0:
         print "Only no data present in raster"
         exit(1)
@@ -49,377 +64,565 @@ def main():
     print "Number of raster cells = " + str(c)
 
 
-    # driver = ogr.GetDriverByName('ESRI Shapefile')
-    mesh = ogr.Open(shp_file, update=True)
-    if mesh is None:
-        print 'Could not open %s' % (mesh)
-        exit(1)
+    vertex, elem = read_mesh(mesher_output_dir, os.path.basename(os.path.normpath(mesher_output_dir)))
+
+    # the shapefile is only opened to write the statistics back, or if there is no mesh to read them from
+    mesh = None
+    index_field = 'triangle'
+    if args.write_shp or vertex is None:
+        # driver = ogr.GetDriverByName('ESRI Shapefile')
+        mesh = ogr.Open(shp_file, update=args.write_shp)
+        if mesh is None:
+            print 'Could not open %s' % (shp_file)
+            exit(1)
 
+        layer = mesh.GetLayer()
 
-    layer = mesh.GetLayer()
-    num_elem = layer.GetFeatureCount()
+        if vertex is None:
+            print 'No .1.node/.1.ele or .mesh found, reading the triangles from ' + base_shp_name
+            vertex, elem = read_triangles(layer)
+            index_field = None  # the triangles are in feature order
+        elif layer.GetFeatureCount() != len(elem):
+            print '%s has %d features but the mesh has %d triangles' % (base_shp_name, layer.GetFeatureCount(), len(elem))
+            exit(1)
+
+        if args.write_shp:
+            layerDefinition = layer.GetLayerDefn()
+            field_names = []
+            for i in range(layerDefinition.GetFieldCount()):
+                field_names.append(layerDefinition.GetFieldDefn(i).GetName())
+
+            for name in ['area', 'min_angle', 'max_angle', 'rmse', 'max_diff']:
+                if name not in field_names:
+                    layer.CreateField(ogr.FieldDefn(name, ogr.OFTReal))
+
+    num_elem = len(elem)
     print "Number of triangles = %d" % (num_elem)
 
     print "# triangles v. raster = " + str( num_elem / float(c) * 100.) + '%'
 
-    area = []
-    angles = []
-    rmse_value = []
-
-    layerDefinition = layer.GetLayerDefn()
-    field_names = []
-    for i in range(layerDefinition.GetFieldCount()):
-        field_names.append(layerDefinition.GetFieldDefn(i).GetName())
-
-    if 'area' not in field_names:
-        layer.CreateField(ogr.FieldDefn('area', ogr.OFTReal))
-    if 'min_angle' not in field_names:
-        layer.CreateField(ogr.FieldDefn('min_angle', ogr.OFTReal))
-    if 'max_angle' not in field_names:
-        layer.CreateField(ogr.FieldDefn('max_angle', ogr.OFTReal))
-    if 'rmse' not in field_names:
-        layer.CreateField(ogr.FieldDefn('rmse', ogr.OFTReal))
-
-    i=0
-    for feature in layer:
-        printProgress(i,num_elem)
+    # per triangle statistics are only kept for the write back
+    tri_fields = None
+    if args.write_shp:
+        tri_fields = collections.OrderedDict((name, np.full(num_elem, np.nan))
+                                             for name in ['area', 'min_angle', 'max_angle', 'rmse', 'max_diff'])
+
+    chunks = spatial_chunks(vertex, elem, args.chunk_size)
+    print 'Computing triangle statistics in %d chunks with %d workers' % (len(chunks), args.workers)
+
+    # each worker only gets its chunk's vertices
+    jobs = ((raster_file, vertex[elem[idx]].reshape(-1, 2), np.arange(3 * len(idx)).reshape(-1, 3), args.error_raster)
+            for idx in chunks)
+
+    pool = None
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers)
+        results = pool.imap(chunk_stats, jobs)
+    else:
+        results = itertools.imap(chunk_stats, jobs)
+
+    summary = collections.OrderedDict()
+    summary['area'] = new_accumulator(np.power(10., np.arange(-2., 12.001, 0.01)))
+    summary['angle'] = new_accumulator(np.arange(0., 180.001, 0.1))
+    summary['rmse'] = new_accumulator(np.power(10., np.arange(-4., 6.001, 0.01)))
+    summary['max_diff'] = new_accumulator(np.power(10., np.arange(-4., 6.001, 0.01)))
+
+    # the csv columns are streamed to disk and zipped together at the end
+    tmp_dir = tempfile.mkdtemp()
+    columns = collections.OrderedDict((name, os.path.join(tmp_dir, name)) for name in ['rmse', 'area', 'angle'])
+    column_files = dict((name, open(fname, 'wb')) for name, fname in columns.iteritems())
+
+    # the residuals of the whole DEM are summed on disk, as the DEM may not fit in memory
+    residual = None
+    tiles = None
+    if args.error_raster:
+        shape = (raster_ds.RasterYSize, raster_ds.RasterXSize)
+        residual = {'sum': np.memmap(os.path.join(tmp_dir, 'residual_sum'), dtype=np.float64, mode='w+', shape=shape),
+                    'count': np.memmap(os.path.join(tmp_dir, 'residual_count'), dtype=np.int32, mode='w+', shape=shape)}
+        tiles = new_tiles(raster_ds, args.tile_size)
+
+    try:
+        done = 0
+        for idx, stats in itertools.izip(chunks, results):
+            printProgress(done, num_elem)
+
+            if tri_fields is not None:
+                tri_fields['area'][idx] = stats['area']
+                tri_fields['min_angle'][idx] = stats['angles'].min(axis=1)
+                tri_fields['max_angle'][idx] = stats['angles'].max(axis=1)
+                tri_fields['rmse'][idx] = stats['rmse']
+                tri_fields['max_diff'][idx] = stats['max_diff']
+
+            if residual is not None:
+                xoff, yoff, window = stats['residual']['xoff'], stats['residual']['yoff'], stats['residual']['sum'].shape
+                residual['sum'][yoff:yoff + window[0], xoff:xoff + window[1]] += stats['residual']['sum']
+                residual['count'][yoff:yoff + window[0], xoff:xoff + window[1]] += stats['residual']['count']
+                accumulate_tiles(tiles, vertex[elem[idx]].mean(axis=1), stats)
+
+            #if the angles come back nan, we've hit an edge case where the triangle slightly sits outside of the domain.
+            #this would have been fixed in the output mesh from mesher, but just ignore it here
+            angles = stats['angles'][~np.isnan(stats['angles'][:, 0])].ravel()
+            rmse = stats['rmse'][~np.isnan(stats['rmse'])]
+            max_diff = stats['max_diff'][~np.isnan(stats['max_diff'])]
+
+            accumulate(summary['area'], stats['area'])
+            accumulate(summary['angle'], angles)
+            accumulate(summary['rmse'], rmse)
+            accumulate(summary['max_diff'], max_diff)
+
+            rmse.tofile(column_files['rmse'])
+            stats['area'].tofile(column_files['area'])
+            angles.tofile(column_files['angle'])
+
+            done += len(idx)
+        printProgress(num_elem, num_elem)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        for f in column_files.values():
+            f.close()
+
+    if tri_fields is not None:
+        print 'Writing the statistics to ' + base_shp_name
+        write_stats(layer, tri_fields, index_field)
+    mesh= None
 
-        geom = feature.GetGeometryRef()
-        ring = geom.GetGeometryRef(0)
+    with open(base_shp_name + '_summary.json', 'w') as f:
+        json.dump(collections.OrderedDict((name, summarize(acc)) for name, acc in summary.iteritems()), f, indent=4)
 
-        # tri_id = feature.GetField('triangle')
+    write_stats_csv(base_shp_name + '_stats.csv', columns)
 
-        geom_area = geom.GetArea()
-        area.append(geom_area)
-        feature.SetField('area', geom_area)
+    if residual is not None:
+        print 'Writing the error raster to ' + base_shp_name + '_error.tif'
+        write_error_raster(base_shp_name + '_error.tif', raster_ds, residual, tiles)
+        write_tiles_csv(base_shp_name + '_tiles.csv', tiles)
+        residual = None
 
-        angle = tri_angles(raster_ds, ring)
-        #if angles comes back none, we've hit an edge case where the triangle slightly sits outside of the domain.
-        #this would have been fixed in the output mesh from mesher, but just ignore it here
+    shutil.rmtree(tmp_dir, ignore_errors=True)
 
-        triangle=[] #this triangles angles
-        if angle is not None:
-            for a in angle:
-                angles.append(a)
-                triangle.append(a)
 
-            feature.SetField('min_angle',min(triangle))
-            feature.SetField('max_angle',max(triangle))
+# Number of valid cells in the first xsize x ysize cells of the band, read a block of rows at a time
+def count_valid_cells(rb, xsize, ysize, block_rows=1024):
+    nodata = rb.GetNoDataValue()
+    count = 0
+    for y in range(0, ysize, block_rows):
+        block = rb.ReadAsArray(0, y, xsize, min(block_rows, ysize - y))
+        count += np.count_nonzero(block != nodata)
+    return count
 
-        rmse = tri_rmse(raster_ds, feature)
-        if rmse is not None:
-            rmse_value.append(rmse)
-            feature.SetField('rmse',rmse)
 
-        layer.SetFeature(feature)
-        i+=1
+# Splits the triangles into spatially compact chunks of about chunk_size triangles. The centroids are binned into a
+# grid with about one chunk per cell, the cells are walked column by column (alternating direction, so consecutive
+# cells are neighbours) and the triangles in that order are cut into chunks. Returns the triangle indexes of each chunk.
+def spatial_chunks(vertex, elem, chunk_size):
+    n = len(elem)
+    nchunks = max(1, int(np.ceil(n / float(chunk_size))))
+    if nchunks == 1:
+        return [np.arange(n)]
 
-    mesh= None
+    cx = vertex[elem, 0].mean(axis=1)
+    cy = vertex[elem, 1].mean(axis=1)
 
-    #
-    with open(base_shp_name+'_stats.csv','w') as f:
-        writer = csv.writer(f)
-        writer.writerow(["rmse", "area", "angle"])
-        max_len = max(len(rmse_value), len(area), len(angles))
-        for i in range(max_len):
-            try:
-                cur_rmse_value = rmse_value[i]
-            except IndexError:
-                cur_rmse_value = None
-            try:
-                cur_area = area[i]
-            except IndexError:
-                cur_area = None
-
-            try:
-                cur_angle = angles[i]
-            except IndexError:
-                cur_angle = None
-
-            writer.writerow([cur_rmse_value, cur_area, cur_angle])
-
-def tri_angles(raster_ds, ring):
-    x1, y1, z = ring.GetPoint(0)  # this z is 0,
-    z1 = extract_point(raster_ds, x1, y1);
-    x2, y2, z = ring.GetPoint(1)
-    z2 = extract_point(raster_ds, x2, y2);
-    x3, y3, z = ring.GetPoint(2)
-    z3 = extract_point(raster_ds, x3, y3);
-
-    rb = raster_ds.GetRasterBand(1)
-    if z1 == rb.GetNoDataValue() or z2 == rb.GetNoDataValue() or z3 == rb.GetNoDataValue():
-        return None
-
-    # vector length
-    def vl(v):
-        return math.sqrt(v[0] ** 2 + v[1] ** 2)
-
-    # dot product
-    def dp(u, v):
-        return u[0] * v[0] + u[1] * v[1]
-
-    u = (y3 - y1, x3 - x1)
-    v = (y2 - y1, x2 - x1)
-    angle32 = math.acos(dp(u, v) / (vl(u) * vl(v))) * 180. / math.pi
-    u = (y1 - y3, x1 - x3)
-    v = (y2 - y3, x2 - x3)
-    angle12 = math.acos(dp(u, v) / (vl(u) * vl(v))) * 180. / math.pi
-    u = (y1 - y2, x1 - x2)
-    v = (y3 - y2, x3 - x2)
-    angle13 = math.acos(dp(u, v) / (vl(u) * vl(v))) * 180. / math.pi
-
-    return(angle32,angle12,angle13)
-
-
-def tri_rmse(raster_ds,feature):
-    geom = feature.GetGeometryRef()
-    ring = geom.GetGeometryRef(0)
-
-    new_gt, rtri,xsize,ysize = rasterize_elem(raster_ds, feature, '')
-
-    #get triangle verticies
-    x1, y1, z = ring.GetPoint(0)  # this z is 0,
-    z1 = extract_point(raster_ds, x1, y1)
-    x1, y1 = xyToPixel(new_gt,x1,y1,xsize,ysize)
-
-    x2, y2, z = ring.GetPoint(1)
-    z2 = extract_point(raster_ds, x2, y2)
-    x2, y2 = xyToPixel(new_gt,x2,y2,xsize,ysize)
-
-    x3, y3, z = ring.GetPoint(2)
-    z3 = extract_point(raster_ds, x3, y3)
-    x3, y3 = xyToPixel(new_gt,x3,y3,xsize,ysize)
-
-    rb = raster_ds.GetRasterBand(1)
-    if z1 == rb.GetNoDataValue() or z2 == rb.GetNoDataValue() or z3 == rb.GetNoDataValue():
-        return None
-
-    u1 = x2 - x1
-    u2 = y2 - y1
-    u3 = z2 - z1
-
-    v1 = x3 - x1
-    v2 = y3 - y1
-    v3 = z3 - z1
+    side = int(np.ceil(np.sqrt(nchunks)))
+    gx = np.minimum(((cx - cx.min()) / max(np.ptp(cx), 1e-12) * side).astype(np.int64), side - 1)
+    gy = np.minimum(((cy - cy.min()) / max(np.ptp(cy), 1e-12) * side).astype(np.int64), side - 1)
+    gy = np.where(gx % 2 == 1, side - 1 - gy, gy)
 
-    a = u2 * v3 - v2 * u3
-    b = v1 * u3 - u1 * v3
-    c = u1 * v2 - v1 * u2
-
-    d =a*x1 + b*y1 + c*z1
-
-    rmse = 0
-    n = 0
-    if c == 0:    #collinear
-        return None
-
-    max_diff = -9999;
-    for y in xrange(rtri.shape[0]):
-        for x in xrange(rtri.shape[1]):
-            if not np.ma.is_masked(rtri[y,x]):
-                pred = -(a*x+b*y-d)/c #plane eqn solved for z. allows us to predict z values via x,y coords
-                value = rtri[y,x]
-                diff = value - pred
-                rmse += diff ** 2
-                n+=1
-                if abs(diff) > max_diff:
-                    max_diff = abs(diff)
-
-    if n==0:
-        return None
-    rmse /= n
-    rmse = math.sqrt(rmse)
-
-    # return max_diff
-    # rmse = ((z1+z2+z3)/3)-float(rtri.mean())
-    return abs(rmse)
-
-#Zonal stats from here https://gist.github.com/perrygeo/5667173
-def bbox_to_pixel_offsets(gt, bbox, rasterXsize, rasterYsize):
-    originX = gt[0]
-    originY = gt[3]
-    pixel_width = gt[1]
-    pixel_height = gt[5]
-    x1 = int((bbox[0] - originX) / pixel_width)
-    x2 = int((bbox[1] - originX) / pixel_width) + 1
-
-    y1 = int((bbox[3] - originY) / pixel_height)
-    y2 = int((bbox[2] - originY) / pixel_height) + 1
+    order = np.lexsort((gy, gx))
+    return np.array_split(order, nchunks)
+
+
+# Worker: tri_stats of one chunk. Only the window of the DEM under the chunk is read, with a cell of margin for the
+# nodata fill of the vertex elevations, so the results are the same as with the whole DEM. With residuals, the per cell
+# residuals of the window are also returned, in stats['residual'].
+def chunk_stats(args):
+    raster_file, vertex, elem, residuals = args
 
+    raster_ds = gdal.Open(raster_file)
+    gt = raster_ds.GetGeoTransform()
+    px = (vertex[:, 0] - gt[0]) / gt[1]
+    py = (vertex[:, 1] - gt[3]) / gt[5]
+
+    c0 = int(np.clip(np.floor(px.min()) - 1, 0, raster_ds.RasterXSize - 1))
+    c1 = int(np.clip(np.floor(px.max()) + 1, 0, raster_ds.RasterXSize - 1))
+    r0 = int(np.clip(np.floor(py.min()) - 1, 0, raster_ds.RasterYSize - 1))
+    r1 = int(np.clip(np.floor(py.max()) + 1, 0, raster_ds.RasterYSize - 1))
+
+    dem = load_raster(raster_ds, (c0, r0, c1 - c0 + 1, r1 - r0 + 1))
+
+    residual = None
+    if residuals:
+        residual = {'sum': np.zeros(dem['array'].shape), 'count': np.zeros(dem['array'].shape, dtype=np.int32),
+                    'xoff': dem['xoff'], 'yoff': dem['yoff']}
+
+    stats = tri_stats(dem, vertex, elem, residual)
+    if residual is not None:
+        stats['residual'] = residual
+    return stats
+
+
+# Writes the per triangle statistics in fields (name -> array) to the features of the layer in one sequential pass,
+# committing every batch_size features. The triangle of a feature is the value of its index_field, or, if None, its
+# position in the layer. nan values leave the field unset.
+def write_stats(layer, fields, index_field=None, batch_size=50000):
+    defn = layer.GetLayerDefn()
+    field_idx = [(defn.GetFieldIndex(name), values.tolist()) for name, values in fields.iteritems()]
+    tri_idx = defn.GetFieldIndex(index_field) if index_field is not None else -1
+
+    layer.ResetReading()
+    layer.StartTransaction()
+    for i, feature in enumerate(layer):
+        tri = feature.GetFieldAsInteger(tri_idx) if tri_idx >= 0 else i
+        for idx, values in field_idx:
+            if values[tri] == values[tri]:  # not nan
+                feature.SetField(idx, values[tri])
+        layer.SetFeature(feature)
+
+        if (i + 1) % batch_size == 0:
+            layer.CommitTransaction()
+            layer.StartTransaction()
+    layer.CommitTransaction()
+    layer.ResetReading()
+
+
+# Per tile totals of the triangles and of the residuals, for tiles of tile_size x tile_size cells of the DEM.
+# The triangles are counted in the tile their centroid is in.
+def new_tiles(raster_ds, tile_size):
+    ny = int(np.ceil(raster_ds.RasterYSize / float(tile_size)))
+    nx = int(np.ceil(raster_ds.RasterXSize / float(tile_size)))
+    tiles = {'size': tile_size, 'nx': nx, 'ny': ny, 'gt': raster_ds.GetGeoTransform(),
+             'xsize': raster_ds.RasterXSize, 'ysize': raster_ds.RasterYSize}
+    for name in ['triangles', 'area', 'rmse_count', 'rmse_sum', 'valid_cells', 'error_cells', 'error_sum', 'error_sumsq']:
+        tiles[name] = np.zeros(nx * ny)
+    for name in ['rmse_max', 'error_max']:
+        tiles[name] = np.full(nx * ny, -np.inf)
+    return tiles
+
+
+def accumulate_tiles(tiles, centroid, stats):
+    gt = tiles['gt']
+    col = np.clip(((centroid[:, 0] - gt[0]) / gt[1]).astype(np.int64), 0, tiles['xsize'] - 1) // tiles['size']
+    row = np.clip(((centroid[:, 1] - gt[3]) / gt[5]).astype(np.int64), 0, tiles['ysize'] - 1) // tiles['size']
+    tile = row * tiles['nx'] + col
+    n = len(tiles['triangles'])
+
+    tiles['triangles'] += np.bincount(tile, minlength=n)
+    tiles['area'] += np.bincount(tile, weights=stats['area'], minlength=n)
+
+    valid = ~np.isnan(stats['rmse'])
+    tiles['rmse_count'] += np.bincount(tile[valid], minlength=n)
+    tiles['rmse_sum'] += np.bincount(tile[valid], weights=stats['rmse'][valid], minlength=n)
+    np.maximum.at(tiles['rmse_max'], tile[valid], stats['rmse'][valid])
+
+
+# Writes the mean residual of every cell, the DEM minus the mesh averaged over the triangles touching the cell, as a float32
+# GeoTIFF on the DEM's grid. Cells without a residual are nodata. The GeoTIFF is written a tile at a time, and the
+# residual and DEM totals of each tile are added to tiles.
+def write_error_raster(fname, raster_ds, residual, tiles, nodata=-9999.):
+    driver = gdal.GetDriverByName('GTiff')
+    out = driver.Create(fname, raster_ds.RasterXSize, raster_ds.RasterYSize, 1, gdal.GDT_Float32,
+                        ['TILED=YES', 'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER'])
+    out.SetGeoTransform(raster_ds.GetGeoTransform())
+    out.SetProjection(raster_ds.GetProjection())
+    band = out.GetRasterBand(1)
+    band.SetNoDataValue(nodata)
+
+    dem_band = raster_ds.GetRasterBand(1)
+    dem_nodata = dem_band.GetNoDataValue()
+    size = tiles['size']
+
+    for ty in range(tiles['ny']):
+        for tx in range(tiles['nx']):
+            printProgress(ty * tiles['nx'] + tx, tiles['nx'] * tiles['ny'])
+
+            x0, y0 = tx * size, ty * size
+            x1, y1 = min(x0 + size, raster_ds.RasterXSize), min(y0 + size, raster_ds.RasterYSize)
+            total = np.asarray(residual['sum'][y0:y1, x0:x1])
+            count = np.asarray(residual['count'][y0:y1, x0:x1])
+
+            has_error = count > 0
+            error = np.full(total.shape, nodata)
+            error[has_error] = total[has_error] / count[has_error]
+            band.WriteArray(error.astype(np.float32), x0, y0)
+
+            dem = dem_band.ReadAsArray(x0, y0, x1 - x0, y1 - y0)
+            missing = np.isnan(dem) if dem_nodata is None else dem == dem_nodata
+            i = ty * tiles['nx'] + tx
+            values = error[has_error]
+            tiles['valid_cells'][i] = np.count_nonzero(~missing)
+            tiles['error_cells'][i] = len(values)
+            if len(values) > 0:
+                tiles['error_sum'][i] = values.sum()
+                tiles['error_sumsq'][i] = (values ** 2).sum()
+                tiles['error_max'][i] = np.abs(values).max()
+    printProgress(1, 1)
+
+    band.ComputeStatistics(False)
+    out = None  # close the file
+
+
+# Writes a row per tile with any valid DEM cells or triangles: its extent, the number of triangles and their mean area,
+# RMSE and largest RMSE, and the mean, RMSE and largest absolute value of the cells' residuals.
+def write_tiles_csv(fname, tiles):
+    gt = tiles['gt']
+    size = tiles['size']
+    with open(fname, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['tile_row', 'tile_col', 'xmin', 'ymin', 'xmax', 'ymax', 'valid_cells', 'triangles',
+                         'triangles_per_cell', 'mean_area', 'mean_rmse', 'max_rmse', 'error_cells', 'mean_error',
+                         'rmse_error', 'max_abs_error'])
+
+        for i in np.flatnonzero((tiles['valid_cells'] > 0) | (tiles['triangles'] > 0)):
+            ty, tx = divmod(int(i), tiles['nx'])
+            x0, x1 = gt[0] + tx * size * gt[1], gt[0] + min((tx + 1) * size, tiles['xsize']) * gt[1]
+            y0, y1 = gt[3] + ty * size * gt[5], gt[3] + min((ty + 1) * size, tiles['ysize']) * gt[5]
+
+            def mean(total, count):
+                return total / count if count > 0 else ''
+
+            def maximum(value):
+                return value if np.isfinite(value) else ''
+
+            error_cells = tiles['error_cells'][i]
+            rmse_error = np.sqrt(tiles['error_sumsq'][i] / error_cells) if error_cells > 0 else ''
+            writer.writerow([ty, tx, min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1),
+                             int(tiles['valid_cells'][i]), int(tiles['triangles'][i]),
+                             mean(tiles['triangles'][i], tiles['valid_cells'][i]),
+                             mean(tiles['area'][i], tiles['triangles'][i]),
+                             mean(tiles['rmse_sum'][i], tiles['rmse_count'][i]), maximum(tiles['rmse_max'][i]),
+                             int(error_cells), mean(tiles['error_sum'][i], error_cells), rmse_error,
+                             maximum(tiles['error_max'][i])])
+
+
+# Mergeable summary of a stream of values: exact count, min, max, mean and standard deviation, and a histogram over
+# the bin edges that the percentiles are interpolated from. Values outside the edges count in the first or last bin.
+def new_accumulator(edges):
+    return {'edges': edges, 'counts': np.zeros(len(edges) - 1, dtype=np.int64),
+            'n': 0, 'sum': 0., 'sumsq': 0., 'min': np.inf, 'max': -np.inf}
+
+
+def accumulate(acc, values):
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return
+
+    bins = np.clip(np.searchsorted(acc['edges'], values, side='right') - 1, 0, len(acc['counts']) - 1)
+    acc['counts'] += np.bincount(bins, minlength=len(acc['counts']))
+    acc['n'] += len(values)
+    acc['sum'] += values.sum()
+    acc['sumsq'] += (values ** 2).sum()
+    acc['min'] = min(acc['min'], values.min())
+    acc['max'] = max(acc['max'], values.max())
+
+
+def summarize(acc, percentiles=(1, 5, 25, 50, 75, 95, 99)):
+    out = collections.OrderedDict()
+    out['count'] = acc['n']
+    if acc['n'] == 0:
+        return out
+
+    mean = acc['sum'] / acc['n']
+    out['min'] = acc['min']
+    out['max'] = acc['max']
+    out['mean'] = mean
+    out['std'] = np.sqrt(max(acc['sumsq'] / acc['n'] - mean ** 2, 0.))
+
+    cum = np.cumsum(acc['counts'])
+    edges = acc['edges']
+    out['percentiles'] = collections.OrderedDict()
+    for q in percentiles:
+        target = q / 100. * acc['n']
+        b = min(int(np.searchsorted(cum, target)), len(cum) - 1)
+        below = cum[b - 1] if b > 0 else 0
+        frac = (target - below) / float(max(acc['counts'][b], 1))
+        value = edges[b] + frac * (edges[b + 1] - edges[b])
+        out['percentiles'][str(q)] = float(np.clip(value, acc['min'], acc['max']))
+
+    nonzero = np.flatnonzero(acc['counts'])
+    out['histogram'] = {'edges': edges[nonzero[0]:nonzero[-1] + 2].tolist(),
+                        'counts': acc['counts'][nonzero[0]:nonzero[-1] + 1].tolist()}
+    return out
+
+
+# Writes the rmse, area and angle columns streamed to the raw float64 files in columns side by side, a block at a time.
+# The columns are of different lengths, the shorter ones are padded with empty cells.
+def write_stats_csv(fname, columns, block_size=100000):
+    data = collections.OrderedDict()
+    for name, column_fname in columns.iteritems():
+        if os.path.getsize(column_fname) > 0:
+            data[name] = np.memmap(column_fname, dtype=np.float64, mode='r')
+        else:
+            data[name] = np.zeros(0)
+
+    with open(fname, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(data.keys())
+        max_len = max(len(d) for d in data.values())
+        for start in range(0, max_len, block_size):
+            blocks = [d[start:start + block_size].tolist() for d in data.values()]
+            for row in itertools.izip_longest(*blocks):
+                writer.writerow(row)
+
+
+# The x, y coordinates of every triangle of the layer, in feature order, as vertex (3 * n, 2) and elem (n, 3) arrays.
+# Vertices aren't shared between triangles.
+def read_triangles(layer):
+    coords = []
+    layer.ResetReading()
+    for feature in layer:
+        ring = feature.GetGeometryRef().GetGeometryRef(0)
+        coords.append([p[0:2] for p in ring.GetPoints()[0:3]])
+    layer.ResetReading()
+
+    vertex = np.array(coords, dtype=np.float64).reshape(-1, 2)
+    elem = np.arange(len(vertex)).reshape(-1, 3)
+    return vertex, elem
+
+
+# The mesh of a mesher run as vertex (n, 2) x, y and elem (m, 3) zero indexed arrays, the triangles in the same order as
+# the features of the _USM layer. Read from, in order of preference, the .npy copies of the Triangle .1.node/.1.ele files
+# in the output directory, the .mesh.npz next to the output directory, the .1.node/.1.ele files themselves or the .mesh
+# json. Returns None, None if there are none of them.
+def read_mesh(mesher_output_dir, base_name):
+    prefix = os.path.normpath(mesher_output_dir) + '/PLGS' + base_name
+    mesh_file = os.path.join(os.path.dirname(os.path.normpath(mesher_output_dir)), base_name + '.mesh')
+    files = [prefix + ext for ext in ('.1.node', '.1.ele')]
+
+    have_text = all(os.path.exists(f) for f in files)
+    if all(os.path.exists(f + '.npy') and (not have_text or os.path.getmtime(f + '.npy') >= os.path.getmtime(f))
+           for f in files):
+        return np.load(files[0] + '.npy', mmap_mode='r'), np.load(files[1] + '.npy', mmap_mode='r')
+
+    if os.path.exists(mesh_file + '.npz'):
+        mesh = np.load(mesh_file + '.npz')
+        return mesh['vertex'][:, 0:2], mesh['elem'].astype(np.int64)
+
+    if have_text:
+        vertex = np.loadtxt(files[0], skiprows=1, usecols=(1, 2), ndmin=2)
+        elem = np.loadtxt(files[1], skiprows=1, usecols=(1, 2, 3), dtype=np.int64, ndmin=2) - 1  # convert to zero indexing
+        return vertex, elem
+
+    if os.path.exists(mesh_file):
+        with open(mesh_file) as f:
+            mesh = json.load(f)['mesh']
+        return np.array(mesh['vertex'], dtype=np.float64)[:, 0:2], np.array(mesh['elem'], dtype=np.int64)
+
+    return None, None
+
+
+# Statistics of every triangle at once from the vertex (x, y) and elem arrays and a DEM from load_raster:
+#   - 'area'
+#   - 'angles', (n, 3) interior angles in degrees at the first, third and second vertex
+#   - 'rmse' and 'max_diff', the RMSE and the largest absolute difference between the DEM cells the triangle touches and
+#     the plane through its vertices
+# The vertex elevations are sampled from the DEM. The angles are nan if one of them is nodata, and so are rmse and
+# max_diff, which are also nan for a degenerate triangle or one without any valid cells. As in the per feature version,
+# the plane is fit in the pixel space of the window of the DEM covering the triangle, with the vertices truncated to
+# whole pixels, and evaluated at the cells' top left corners.
+# If residual is given, the residuals (DEM minus plane) of the valid triangles are added to its 'sum' and 'count' arrays,
+# which cover the window of the DEM.
+def tri_stats(dem, vertex, elem, residual=None):
+    vertex = np.asarray(vertex, dtype=np.float64)
+    elem = np.asarray(elem, dtype=np.int64).reshape(-1, 3)
+    n = len(elem)
+
+    array = dem['array']
+    gt = dem['gt']
+    nodata = dem['nodata']
+    rasterXsize = dem['xsize']
+    rasterYsize = dem['ysize']
+
+    x = vertex[elem, 0]
+    y = vertex[elem, 1]
+    z = extract_points(dem, x.ravel(), y.ravel()).reshape(-1, 3)
+
+    if nodata is None:
+        bad_z = np.isnan(z).any(axis=1)
+    else:
+        bad_z = (z == nodata).any(axis=1)
+
+    stats = {}
+    stats['area'] = 0.5 * np.abs((x[:, 1] - x[:, 0]) * (y[:, 2] - y[:, 0]) - (x[:, 2] - x[:, 0]) * (y[:, 1] - y[:, 0]))
+
+    # angle at vertex a between the edges to b and c
+    def angle(a, b, c):
+        u = (y[:, c] - y[:, a], x[:, c] - x[:, a])
+        v = (y[:, b] - y[:, a], x[:, b] - x[:, a])
+        cos = (u[0] * v[0] + u[1] * v[1]) / (np.sqrt(u[0] ** 2 + u[1] ** 2) * np.sqrt(v[0] ** 2 + v[1] ** 2))
+        return np.arccos(np.clip(cos, -1., 1.)) * 180. / np.pi
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        angles = np.column_stack((angle(0, 1, 2), angle(2, 1, 0), angle(1, 2, 0)))
+    angles[bad_z] = np.nan
+    stats['angles'] = angles
+
+    # window of the DEM under each triangle's bounding box, as the per feature version read it
+    x1 = ((x.min(axis=1) - gt[0]) / gt[1]).astype(np.int64)
+    x2 = ((x.max(axis=1) - gt[0]) / gt[1]).astype(np.int64) + 1
+    y1 = ((y.max(axis=1) - gt[3]) / gt[5]).astype(np.int64)
+    y2 = ((y.min(axis=1) - gt[3]) / gt[5]).astype(np.int64) + 1
     xsize = x2 - x1
     ysize = y2 - y1
-
-    #only apply this correction if we are touching the underlying raster.
-    # if x1 < rasterXsize and y1 < rasterYsize:
-        #deal with small out of bounds
-    if x1 < 0:
-        x1 = 0
-
-    if y1 < 0:
-        y1 = 0
-
-    if x1 + xsize >= rasterXsize:
-        xsize = rasterXsize-x1
-
-    if y1 + ysize >= rasterYsize:
-        ysize = rasterYsize-y1
-
-    return (x1, y1, xsize, ysize)
-
-def xyToPixel( gt, x,  y,  max_x,  max_y):
-    # adfGeoTransform[0] /* top left x */
-    # adfGeoTransform[1] /* w-e pixel resolution */
-    # adfGeoTransform[2] /* 0 */
-    # adfGeoTransform[3] /* top left y */
-    # adfGeoTransform[4] /* 0 */
-    # adfGeoTransform[5] /* n-s pixel resolution (negative value) */
-
-    px = int((x - gt[0]) / gt[1])  # x pixel
-    py = int((y - gt[3]) / gt[5])  # y pixel
-
-    #out of bound issue when we are off by one
-    if px >= max_x:
-        px = max_x - 1;
-
-    if py >= max_y:
-        py = max_y - 1;
-
-    if py < 0:
-        py = 0;
-
-    if px <0 :
-        px = 0;
-
-    return (px,py)
-
-def rasterize_elem(raster, feature, key):
-
-    wkt = raster.GetProjection()
-    srs = osr.SpatialReference()
-    srs.ImportFromWkt(wkt)
-    gt = raster.GetGeoTransform()
-    rb = raster.GetRasterBand(1)
-    src_offset = bbox_to_pixel_offsets(gt, feature.geometry().GetEnvelope(), raster.RasterXSize, raster.RasterYSize)
-
-    src_array = rb.ReadAsArray(*src_offset)
-    # calculate new geotransform of the feature subset
-    new_gt = (
-        (gt[0] + (src_offset[0] * gt[1])),
-        gt[1],
-        0.0,
-        (gt[3] + (src_offset[1] * gt[5])),
-        0.0,
-        gt[5]
-    )
-
-    # Create a temporary vector layer in memory
-    mem_drv = ogr.GetDriverByName('Memory')
-    mem_ds = mem_drv.CreateDataSource('out')
-    # mem_drv = ogr.GetDriverByName('ESRI Shapefile')
-    # mem_ds = mem_drv.CreateDataSource('rastertri.shp')
-
-    mem_layer = mem_ds.CreateLayer('poly', srs, ogr.wkbPolygon)
-    mem_layer.CreateFeature(feature.Clone())
-
-    # Rasterize it
-    driver = gdal.GetDriverByName('MEM')
-    rvds = driver.Create('', src_offset[2], src_offset[3], 1, gdal.GDT_Byte)
-    # driver = gdal.GetDriverByName('GTiff')
-    # rvds = driver.Create('rasterized.tif', src_offset[2], src_offset[3], 1, gdal.GDT_Byte)
-    rvds.SetGeoTransform(new_gt)
-
-    gdal.RasterizeLayer(rvds, [1], mem_layer, burn_values=[1], options=['ALL_TOUCHED=TRUE'])
-    rv_array = rvds.ReadAsArray()  # holds a mask of where the triangle is on the raster
-
-    # Mask the source data array with our current feature
-    # we take the logical_not to flip 0<->1 to get the correct mask effect
-    # we also mask out nodata values explictly
-    masked = np.ma.MaskedArray(
-        src_array,
-        mask=np.logical_or(
-            src_array == rb.GetNoDataValue(),
-            np.logical_not(rv_array)
-        )
-    )
-    # feature_stats = {
-    #     'min': float(masked.min()),
-    #     'mean': float(masked.mean()),
-    #     'max': float(masked.max()),
-    #     'std': float(masked.std()),
-    #     'sum': float(masked.sum()),
-    #     'count': int(masked.count()),
-    #     'fid': int(feat.GetFID())
-    # }
-    # output = rb.GetNoDataValue()
-    #
-    # if data['method'] == 'mode':
-    #     output = sp.mode(masked.flatten())[0][0]
-    # elif data['method'] == 'mean':
-    #     if masked.count() > 0:
-    #         output = float(
-    #             masked.mean())  # if it's entirely masked, then we get nan and a warning printed to stdout. would like to avoid showing this warning.
-    # else:
-    #     print 'Error: unknown data aggregation method %s' % data['method']
-
-    return new_gt,masked,src_offset[2],src_offset[3]
-def extract_point(raster,mx,my):
-    # Convert from map to pixel coordinates.
-    # Only works for geotransforms with no rotation.
-
-    rb = raster.GetRasterBand(1)
-    gt = raster.GetGeoTransform()
-
-    px = int((mx - gt[0]) / gt[1])  # x pixel
-    py = int((my - gt[3]) / gt[5])  # y pixel
-
-    #boundary verticies from Triangle can end up outside of the domain by 1 pixel.
-    #if we adjusted back by  1 pixel to get the dz value, it's no problem and still gives a good boundary
-    if px == raster.RasterXSize:
-        px = px -1
-    if py == raster.RasterYSize:
-        py = py - 1
-    mz = rb.ReadAsArray(px, py, 1, 1)
-    mz = float(mz.flatten()[0])
-
-    if mz == rb.GetNoDataValue():
-        dx = 1
-        dy = 1
-
-        #attempt to pick points from the surrounding 8
-        z1 = rb.ReadAsArray(px - dx if px > 0 else px, py, 1, 1)
-        z1 = z1[0] if z1 is not None else rb.GetNoDataValue()
-
-        z2 = rb.ReadAsArray(px + dx if px < raster.RasterXSize else px, py, 1, 1)
-        z2 = z2[0] if z2 is not None else rb.GetNoDataValue()
-
-        z3 = rb.ReadAsArray(px, py + dy if py < raster.RasterYSize else py, 1, 1)
-        z3 = z3[0] if z3 is not None else rb.GetNoDataValue()
-
-        z4 = rb.ReadAsArray(px, py - dy if py > 0 else py, 1, 1)[0]
-        z4 = z4[0] if z4 is not None else rb.GetNoDataValue()
-
-        z5 = rb.ReadAsArray(px - dx if px > 0 else px,                  py - dy if py > 0 else py, 1, 1)
-        z5 = z5[0] if z5 is not None else rb.GetNoDataValue()
-
-        z6 = rb.ReadAsArray(px + dx if px < raster.RasterXSize else px, py - dy if py > 0 else py, 1, 1)
-        z6 = z6[0] if z6 is not None else rb.GetNoDataValue()
-
-        z7 = rb.ReadAsArray(px - dx if px > 0 else px,                  py + dy if py < raster.RasterYSize else py, 1, 1)
-        z7 = z7[0] if z7 is not None else rb.GetNoDataValue()
-
-        z8 = rb.ReadAsArray(px + dx if px < raster.RasterXSize else px, py - dy if py > 0 else py, 1, 1)
-        z8 = z8[0] if z8 is not None else rb.GetNoDataValue()
-
-        z=[z1, z2, z3, z4,z5,z6,z7,z8]
-        z = [x for x in z if x != rb.GetNoDataValue()]
-
-        if len(z) == 0:
-            print 'Warning: The point (%f,%f) and its 8-neighbours lies outside of the DEM domain' %(mx,my)
-            return rb.GetNoDataValue()
-            #exit(1)
-
-        mz = float(np.mean(z))
-    return mz
+    x1 = np.maximum(x1, 0)
+    y1 = np.maximum(y1, 0)
+    xsize = np.minimum(xsize, rasterXsize - x1)
+    ysize = np.minimum(ysize, rasterYsize - y1)
+
+    # vertices in the window's pixel space, truncated and clamped to the window
+    wx0 = gt[0] + x1 * gt[1]
+    wy0 = gt[3] + y1 * gt[5]
+    px = np.clip(((x - wx0[:, np.newaxis]) / gt[1]).astype(np.int64), 0, (xsize - 1)[:, np.newaxis])
+    py = np.clip(((y - wy0[:, np.newaxis]) / gt[5]).astype(np.int64), 0, (ysize - 1)[:, np.newaxis])
+
+    # plane through the vertices, a*x + b*y + c*z = d
+    u1, u2, u3 = px[:, 1] - px[:, 0], py[:, 1] - py[:, 0], z[:, 1] - z[:, 0]
+    v1, v2, v3 = px[:, 2] - px[:, 0], py[:, 2] - py[:, 0], z[:, 2] - z[:, 0]
+    a = u2 * v3 - v2 * u3
+    b = v1 * u3 - u1 * v3
+    c = (u1 * v2 - v1 * u2).astype(np.float64)
+    d = a * px[:, 0] + b * py[:, 0] + c * z[:, 0]
+
+    sum_sq = np.zeros(n)
+    count = np.zeros(n)
+    max_diff = np.full(n, -np.inf)
+
+    for tri, row, col in triangle_cells(gt, rasterXsize, rasterYsize, vertex, elem):
+        value = array[row - dem['yoff'], col - dem['xoff']].astype(np.float64)
+        if nodata is not None:
+            valid = value != nodata
+            tri, row, col, value = tri[valid], row[valid], col[valid], value[valid]
+        if len(tri) == 0:
+            continue
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pred = -(a[tri] * (col - x1[tri]) + b[tri] * (row - y1[tri]) - d[tri]) / c[tri]
+        diff = value - pred
+
+        sum_sq += np.bincount(tri, weights=diff ** 2, minlength=n)
+        count += np.bincount(tri, minlength=n)
+
+        # the cells come grouped by triangle
+        starts = np.flatnonzero(np.r_[True, tri[1:] != tri[:-1]])
+        ids = tri[starts]
+        max_diff[ids] = np.maximum(max_diff[ids], np.maximum.reduceat(np.abs(diff), starts))
+
+        if residual is not None:
+            ok = ~bad_z[tri] & (c[tri] != 0)
+            shape = residual['sum'].shape
+            cell = (row[ok] - dem['yoff']) * shape[1] + (col[ok] - dem['xoff'])
+            residual['sum'] += np.bincount(cell, weights=diff[ok], minlength=shape[0] * shape[1]).reshape(shape)
+            residual['count'] += np.bincount(cell, minlength=shape[0] * shape[1]).reshape(shape).astype(np.int32)
+
+    invalid = bad_z | (c == 0) | (count == 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rmse = np.sqrt(sum_sq / count)
+    rmse[invalid] = np.nan
+    max_diff[invalid] = np.nan
+
+    stats['rmse'] = rmse
+    stats['max_diff'] = max_diff
+    return stats
 
 
 # Print iterations progress
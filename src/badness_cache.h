@@ -0,0 +1,127 @@
+// Mesher
+// Copyright (C) 2017 Christopher Marsh
+
+// This program is free software: you can redistribute it and/or modify
+// it under the terms of the GNU General Public License as published by
+// the Free Software Foundation, either version 3 of the License, or
+// (at your option) any later version.
+
+// This program is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+
+// You should have received a copy of the GNU General Public License
+// along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#pragma once
+
+#include <array>
+#include <list>
+#include <unordered_map>
+#include <unordered_set>
+#include <functional>
+#include <algorithm>
+#include <utility>
+
+//LRU cache of face results keyed on the face's vertex coordinates. The three (x,y) are sorted so the same triangle
+//gives the same key whichever vertex CGAL puts first. Holds at most as many entries as fit in max_bytes, evicting the
+//least recently used.
+template<class Value>
+class badness_cache
+{
+public:
+    typedef std::array<double, 6> key_type;
+
+    struct key_hash
+    {
+        size_t operator()(const key_type& key) const
+        {
+            size_t h = 0;
+            std::hash<double> hasher;
+            for (auto v : key)
+                h ^= hasher(v) + 0x9e3779b9 + (h << 6) + (h >> 2);
+            return h;
+        }
+    };
+
+    //a set of face keys, e.g., of the faces known to pass
+    typedef std::unordered_set<key_type, key_hash> key_set;
+
+    //value_heap_bytes is the memory a Value holds outside of itself, e.g., in vectors
+    badness_cache(size_t max_bytes, size_t value_heap_bytes = 0)
+    {
+        //list node + map node + bucket, roughly
+        size_t entry_bytes = sizeof(std::pair<key_type, Value>) + value_heap_bytes +
+                             sizeof(key_type) + sizeof(typename list_type::iterator) + 6 * sizeof(void*);
+        max_entries = std::max<size_t>(1, max_bytes / entry_bytes);
+
+        _hits = 0;
+        _misses = 0;
+        _evictions = 0;
+    }
+
+    static key_type make_key(double x0, double y0, double x1, double y1, double x2, double y2)
+    {
+        std::array<std::pair<double, double>, 3> v = {{std::make_pair(x0, y0),
+                                                       std::make_pair(x1, y1),
+                                                       std::make_pair(x2, y2)}};
+        std::sort(v.begin(), v.end());
+
+        key_type key = {{v[0].first, v[0].second, v[1].first, v[1].second, v[2].first, v[2].second}};
+        return key;
+    }
+
+    //copy the cached value for key into value. Returns false if it isn't cached
+    bool get(const key_type& key, Value& value)
+    {
+        auto itr = index.find(key);
+        if (itr == index.end())
+        {
+            ++_misses;
+            return false;
+        }
+
+        ++_hits;
+        entries.splice(entries.begin(), entries, itr->second);
+        value = itr->second->second;
+        return true;
+    }
+
+    void put(const key_type& key, const Value& value)
+    {
+        auto itr = index.find(key);
+        if (itr != index.end())
+        {
+            itr->second->second = value;
+            entries.splice(entries.begin(), entries, itr->second);
+            return;
+        }
+
+        if (index.size() >= max_entries)
+        {
+            index.erase(entries.back().first);
+            entries.pop_back();
+            ++_evictions;
+        }
+
+        entries.push_front(std::make_pair(key, value));
+        index[key] = entries.begin();
+    }
+
+    size_t hits() const { return _hits; }
+    size_t misses() const { return _misses; }
+    size_t evictions() const { return _evictions; }
+    size_t size() const { return index.size(); }
+    size_t capacity() const { return max_entries; }
+
+private:
+    typedef std::list< std::pair<key_type, Value> > list_type;
+
+    list_type entries;
+    std::unordered_map<key_type, typename list_type::iterator, key_hash> index;
+    size_t max_entries;
+
+    size_t _hits;
+    size_t _misses;
+    size_t _evictions;
+};
@@ -0,0 +1,74 @@
+// Mesher
+// Copyright (C) 2017 Christopher Marsh
+
+// This program is free software: you can redistribute it and/or modify
+// it under the terms of the GNU General Public License as published by
+// the Free Software Foundation, either version 3 of the License, or
+// (at your option) any later version.
+
+// This program is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+
+// You should have received a copy of the GNU General Public License
+// along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#pragma once
+
+#include <iostream>
+#include <cmath>
+#include <boost/shared_ptr.hpp>
+
+#include <gdal_version.h>
+#include <ogr_spatialref.h>
+
+//equal area projection the area of triangles on geographic rasters is computed in
+const char* const equal_area_wkt = "PROJCS[\"North_America_Albers_Equal_Area_Conic\",     GEOGCS[\"GCS_North_American_1983\",         DATUM[\"North_American_Datum_1983\",             SPHEROID[\"GRS_1980\",6378137,298.257222101]],         PRIMEM[\"Greenwich\",0],         UNIT[\"Degree\",0.017453292519943295]],     PROJECTION[\"Albers_Conic_Equal_Area\"],     PARAMETER[\"False_Easting\",0],     PARAMETER[\"False_Northing\",0],     PARAMETER[\"longitude_of_center\",-96],     PARAMETER[\"Standard_Parallel_1\",20],     PARAMETER[\"Standard_Parallel_2\",60],     PARAMETER[\"latitude_of_center\",40],     UNIT[\"Meter\",1],     AUTHORITY[\"EPSG\",\"102008\"]]";
+
+//transform from the src_wkt coordinate system to the equal area one. It is destroyed with the last copy of the pointer
+inline boost::shared_ptr<OGRCoordinateTransformation> make_equal_area_transform(const char* src_wkt)
+{
+    char* wkt = const_cast<char*>(src_wkt);
+    OGRSpatialReference srs;
+    srs.importFromWkt(&wkt);
+
+    char* out_wkt = const_cast<char*>(equal_area_wkt); // omg
+    OGRSpatialReference srs_out;
+    srs_out.importFromWkt(&out_wkt);
+
+#if GDAL_VERSION_MAJOR >= 3
+    //keep x = longitude, y = latitude as the rasters are
+    srs.SetAxisMappingStrategy(OAMS_TRADITIONAL_GIS_ORDER);
+    srs_out.SetAxisMappingStrategy(OAMS_TRADITIONAL_GIS_ORDER);
+#endif
+
+    OGRCoordinateTransformation* trans = OGRCreateCoordinateTransformation(&srs, &srs_out);
+    if(!trans)
+    {
+        std::cout << "Unable to create geographic transform" << std::endl;
+        exit(1);
+    }
+
+    return boost::shared_ptr<OGRCoordinateTransformation>(trans, OCTDestroyCoordinateTransformation);
+}
+
+inline double shoelace_area(const double x[3], const double y[3])
+{
+    return 0.5 * fabs((x[1] - x[0]) * (y[2] - y[0]) - (x[2] - x[0]) * (y[1] - y[0]));
+}
+
+//area of the triangle x,y in the equal area projection. The 3 vertexes are transformed and the area is the shoelace
+//formula, the same as transforming the triangle as a polygon and calling get_Area. If the transform fails the
+//untransformed area is returned, which is what the polygon would have been left with
+inline double equal_area(OGRCoordinateTransformation* trans, const double x[3], const double y[3])
+{
+    double px[3] = {x[0], x[1], x[2]};
+    double py[3] = {y[0], y[1], y[2]};
+
+    if(!trans->Transform(3, px, py))
+    {
+        return shoelace_area(x, y);
+    }
+
+    return shoelace_area(px, py);
+}
@@ -26,7 +26,14 @@
 #include <boost/bind.hpp>
 #include <vector>
 #include <cmath>
+
+#include <ogr_spatialref.h>
+#include <ogr_geometry.h>
+
 #include "triangle.h"
+#include "geographic_area.h"
+#include "badness_cache.h"
+#include "profile.h"
 
     template<class CDT>
     class mesh_2_criterion_area
@@ -42,7 +49,21 @@
         const std::string& error_metric;
         const bool is_geographic;
 
-        OGRCoordinateTransformation* prj_trans;
+        //geographic -> equal area transform, built once and shared with every Is_bad
+        boost::shared_ptr<OGRCoordinateTransformation> prj_trans;
+
+    public:
+        class Quality;
+
+        //results of faces already tested, shared with every Is_bad (and copy of this criteria)
+        typedef badness_cache< std::pair<Quality, CGAL::Mesh_2::Face_badness> > Cache;
+
+        //faces the filter rejects only have their area and angle tested, not their error to the rasters
+        typedef boost::function<bool(const typename CDT::Face_handle&)> Face_filter;
+
+    protected:
+        boost::shared_ptr<Cache> cache;
+        Face_filter raster_filter;
     public:
 
         mesh_2_criterion_area(const double aspect_bound = 0.125,
@@ -52,6 +73,7 @@
                               const std::vector< std::pair< boost::shared_ptr<raster>,double> >& category_rasters = std::vector< std::pair< boost::shared_ptr<raster>,double>>(),
                               const std::string& error_metric = std::string(),
                               const bool is_geographic = false,
+                              const size_t badness_cache_bytes = 0,
                               const Geom_traits &traits = Geom_traits())
         : r(rasters),category_rasters(category_rasters),error_metric(error_metric),is_geographic(is_geographic)
 
@@ -60,30 +82,28 @@
             this->min_area = min_area;
             B = aspect_bound;
             this->traits=traits;
-            prj_trans = nullptr;
 
             if(is_geographic)
             {
-                char* wkt = const_cast<char*>(r.at(0).first->getDs()->GetProjectionRef());
-                OGRSpatialReference srs;
-                srs.importFromWkt(&wkt);
-
-                const char* out_wkt = "PROJCS[\"North_America_Albers_Equal_Area_Conic\",     GEOGCS[\"GCS_North_American_1983\",         DATUM[\"North_American_Datum_1983\",             SPHEROID[\"GRS_1980\",6378137,298.257222101]],         PRIMEM[\"Greenwich\",0],         UNIT[\"Degree\",0.017453292519943295]],     PROJECTION[\"Albers_Conic_Equal_Area\"],     PARAMETER[\"False_Easting\",0],     PARAMETER[\"False_Northing\",0],     PARAMETER[\"longitude_of_center\",-96],     PARAMETER[\"Standard_Parallel_1\",20],     PARAMETER[\"Standard_Parallel_2\",60],     PARAMETER[\"latitude_of_center\",40],     UNIT[\"Meter\",1],     AUTHORITY[\"EPSG\",\"102008\"]]";
-                char* out_wkt2 = const_cast<char*>(out_wkt); // omg
-                OGRSpatialReference  srs_out;
-                srs_out.importFromWkt(&out_wkt2);
-
-                prj_trans = OGRCreateCoordinateTransformation( &srs,
-                                                               &srs_out );
+                prj_trans = make_equal_area_transform(r.at(0).first->getDs()->GetProjectionRef());
+            }
 
-                if(!prj_trans)
-                {
-                    std::cout << "Unable to create geographic transform" << std::endl;
-                    exit(1);
-                }
+            if(badness_cache_bytes > 0)
+            {
+                size_t heap_bytes = (r.size() + category_rasters.size()) * sizeof(std::pair<double,double>);
+                cache = boost::make_shared<Cache>(badness_cache_bytes, heap_bytes);
             }
         }
 
+        //null if the cache is off
+        const boost::shared_ptr<Cache>& badness() const
+        { return cache; }
+
+        //e.g., to only retest the faces about the seams of a tiled refinement, the others having passed in their tile
+        inline
+        void set_raster_filter(const Face_filter& filter)
+        { raster_filter = filter; }
+
         inline
         double maxarea() const
         { return max_area; }
@@ -184,10 +204,15 @@
             const std::vector< std::pair< boost::shared_ptr<raster>,double> >& category_rasters;
             const std::string& error_metric;
             const bool is_geographic;
-            OGRCoordinateTransformation* prj_trans;
+            boost::shared_ptr<OGRCoordinateTransformation> prj_trans;
+            boost::shared_ptr<Cache> cache;
+            Face_filter raster_filter;
             const Geom_traits &traits;
 
-            boost::function<double(const typename CDT::Face_handle&, const raster&)> error_fn;
+            boost::function<double(const typename CDT::Face_handle&, const raster&, double)> error_fn;
+
+            //--profile counter of the error metric
+            profile_counter* metric_counter;
         public:
 
             typedef typename CDT::Point Point_2;
@@ -199,10 +224,13 @@
                    const std::vector< std::pair< boost::shared_ptr<raster>,double> >& category_rasters,
                    const std::string& error_metric,
                    const bool is_geographic=false,
-                   OGRCoordinateTransformation* prj_trans=nullptr,
+                   boost::shared_ptr<OGRCoordinateTransformation> prj_trans=boost::shared_ptr<OGRCoordinateTransformation>(),
+                   boost::shared_ptr<Cache> cache=boost::shared_ptr<Cache>(),
+                   Face_filter raster_filter=Face_filter(),
                    const Geom_traits &traits = Geom_traits() )
                     : B(aspect_bound), max_area(area_bound), min_area(min_area),
-                      r(r), category_rasters(category_rasters),error_metric(error_metric),is_geographic(is_geographic),traits(traits)
+                      r(r), category_rasters(category_rasters),error_metric(error_metric),is_geographic(is_geographic),
+                      cache(cache),raster_filter(raster_filter),traits(traits)
             {
                 this->prj_trans = prj_trans;
                 if(!prj_trans && is_geographic)
@@ -211,11 +239,20 @@
                     exit(1);
                 }
                 if(error_metric == "rmse" || error_metric == "")
-                    error_fn = boost::bind(&Is_bad::rmse_tolerance,this,_1,_2);
+                {
+                    error_fn = boost::bind(&Is_bad::rmse_tolerance,this,_1,_2,_3);
+                    metric_counter = &mesher_profile.rmse;
+                }
                 else if(error_metric == "mean_tol")
-                    error_fn = boost::bind(&Is_bad::mean_tolerance,this,_1,_2);
+                {
+                    error_fn = boost::bind(&Is_bad::mean_tolerance,this,_1,_2,_3);
+                    metric_counter = &mesher_profile.mean_tol;
+                }
                 else if(error_metric == "max_tol")
-                    error_fn = boost::bind(&Is_bad::max_diff,this,_1,_2);
+                {
+                    error_fn = boost::bind(&Is_bad::max_diff,this,_1,_2,_3);
+                    metric_counter = &mesher_profile.max_tol;
+                }
                 else
                 {
                     std::cout << "Unknown error function selected" << std::endl;
@@ -223,7 +260,7 @@
                 }
             }
 
-            double rmse_tolerance(const typename CDT::Face_handle &fh, const raster &r) const
+            double rmse_tolerance(const typename CDT::Face_handle &fh, const raster &r, double tol) const
             {
                 triangle t;
                 vertex _v0;
@@ -239,20 +276,21 @@
                 _v2[0] = fh->vertex(2)->point().x();
                 _v2[1] = fh->vertex(2)->point().y();
 
-                t.make_rasterized(_v0, _v1, _v2, r);
+                //with the pyramid the cells are only read if its bounds can't decide the triangle
+                t.make_rasterized(_v0, _v1, _v2, r, !r.has_pyramid());
                 if(t.is_nan)
                     return 0; //bail
 
-                auto pxpy = t.rasterized_triangle->xy_to_pxpy(t.v0[0],t.v0[1]);
+                auto pxpy = t.xy_to_pxpy(t.v0[0],t.v0[1]);
                 t.v0[0] = pxpy.first;
                 t.v0[1] = pxpy.second;
 
-                pxpy = t.rasterized_triangle->xy_to_pxpy(t.v1[0],t.v1[1]);
+                pxpy = t.xy_to_pxpy(t.v1[0],t.v1[1]);
                 t.v1[0] = pxpy.first;
                 t.v1[1] = pxpy.second;
 
 
-                pxpy = t.rasterized_triangle->xy_to_pxpy(t.v2[0],t.v2[1]);
+                pxpy = t.xy_to_pxpy(t.v2[0],t.v2[1]);
                 t.v2[0] = pxpy.first;
                 t.v2[1] = pxpy.second;
 
@@ -300,14 +338,25 @@
                 //solve for d
                 double d =a*o1 + b*o2 + c*o3;
 
+                //rmse <= the max deviation, so if the pyramid's upper bound on that is within tolerance so is the rmse.
+                //Not worth it for small triangles
+                if (r.has_pyramid() && c != 0 && t.xsize * t.ysize > 64)
+                {
+                    double upper, lower;
+                    t.plane_bounds(a, b, c, d, upper, lower);
+                    if (upper <= tol)
+                        return upper;
+                }
+                t.read_values();
+
                 double rmse = 0;
                 double n = 0;
 
-                for (int y = 0; y < t.rasterized_triangle->getDs()->GetRasterYSize(); y++)
+                for (int y = 0; y < t.ysize; y++)
                 {
-                    for (int x = 0; x < t.rasterized_triangle->getDs()->GetRasterXSize(); x++)
+                    for (int x = t.spans[y].first; x <= t.spans[y].second; x++)
                     {
-                        double value = t.rasterized_triangle->getpXpY(x, y);
+                        double value = t.getpXpY(x, y);
                         if (!std::isnan(value))
                         {
                             double z = -(a*x+b*y-d)/c; //plane eqn solved for z. allows us to predict z values via x,y coords
@@ -346,7 +395,8 @@
                 _v2[0] = fh->vertex(2)->point().x();
                 _v2[1] = fh->vertex(2)->point().y();
 
-                t.make_rasterized(_v0, _v1, _v2, r);
+                //with the per class counts only the spans are needed
+                t.make_rasterized(_v0, _v1, _v2, r, !r.has_class_counts());
 
 
                 if(t.is_nan)
@@ -359,11 +409,30 @@
 
                 double n=0;//total tri
                 std::map<int,int> lc; //holds the count of each category (e.g., landcover type)
-                for (int y = 0; y < t.rasterized_triangle->getDs()->GetRasterYSize(); y++)
+
+                if (r.has_class_counts())
+                {
+                    std::vector<double> counts(r.n_classes(), 0);
+                    for (int y = 0; y < t.ysize; y++)
+                    {
+                        if (t.spans[y].first <= t.spans[y].second)
+                            r.span_class_counts(t.y_off + y, t.x_off + t.spans[y].first, t.x_off + t.spans[y].second, counts);
+                    }
+
+                    for (auto& c : counts)
+                        n += c;
+
+                    if (n == 0)
+                        return true; //bail
+
+                    return *std::max_element(counts.begin(), counts.end()) / n; // the most dominate landcover
+                }
+
+                for (int y = 0; y < t.ysize; y++)
                 {
-                    for (int x = 0; x < t.rasterized_triangle->getDs()->GetRasterXSize(); x++)
+                    for (int x = t.spans[y].first; x <= t.spans[y].second; x++)
                     {
-                        double value = t.rasterized_triangle->getpXpY(x, y);
+                        double value = t.getpXpY(x, y);
                         if (!std::isnan(value))
                         {
                             int key = (int)value;
@@ -392,7 +461,7 @@
                 return *std::max_element(percents.begin(),percents.end()); // the most dominate landcover
 
             }
-            double mean_tolerance(const typename CDT::Face_handle &fh, const raster &r) const
+            double mean_tolerance(const typename CDT::Face_handle &fh, const raster &r, double tol) const
             {
                 triangle t;
                 vertex v0;
@@ -408,7 +477,8 @@
                 v2[0] = fh->vertex(2)->point().x();
                 v2[1] = fh->vertex(2)->point().y();
 
-                t.make_rasterized(v0, v1, v2, r);
+                //with the row sums only the spans are needed
+                t.make_rasterized(v0, v1, v2, r, !r.has_row_sums());
                 if(t.is_nan)
                     return 0; //bail
 
@@ -448,11 +518,19 @@
                 double sum = 0;
                 double count = 0;
 
-                for (int i = 0; i < t.rasterized_triangle->getDs()->GetRasterYSize(); i++)
+                for (int i = 0; i < t.ysize; i++)
                 {
-                    for (int j = 0; j < t.rasterized_triangle->getDs()->GetRasterXSize(); j++)
+                    if (r.has_row_sums())
+                    {
+                        //one lookup per row
+                        if (t.spans[i].first <= t.spans[i].second)
+                            r.span_sum(t.y_off + i, t.x_off + t.spans[i].first, t.x_off + t.spans[i].second, sum, count);
+                        continue;
+                    }
+
+                    for (int j = t.spans[i].first; j <= t.spans[i].second; j++)
                     {
-                        double value = t.rasterized_triangle->getpXpY(j, i);
+                        double value = t.getpXpY(j, i);
                         if (!std::isnan(value))
                         {
                             sum += value;
@@ -474,7 +552,7 @@
                 return diff;
 
             }
-            double max_diff(const typename CDT::Face_handle &fh, const raster & r) const
+            double max_diff(const typename CDT::Face_handle &fh, const raster & r, double tol) const
             {
                 triangle t;
                 vertex _v0;
@@ -490,20 +568,21 @@
                 _v2[0] = fh->vertex(2)->point().x();
                 _v2[1] = fh->vertex(2)->point().y();
 
-                t.make_rasterized(_v0, _v1, _v2, r);
+                //with the pyramid the cells are only read if its bounds can't decide the triangle
+                t.make_rasterized(_v0, _v1, _v2, r, !r.has_pyramid());
                 if(t.is_nan)
                     return 0; //bail
 
-                auto pxpy = t.rasterized_triangle->xy_to_pxpy(t.v0[0],t.v0[1]);
+                auto pxpy = t.xy_to_pxpy(t.v0[0],t.v0[1]);
                 t.v0[0] = pxpy.first;
                 t.v0[1] = pxpy.second;
 
-                pxpy = t.rasterized_triangle->xy_to_pxpy(t.v1[0],t.v1[1]);
+                pxpy = t.xy_to_pxpy(t.v1[0],t.v1[1]);
                 t.v1[0] = pxpy.first;
                 t.v1[1] = pxpy.second;
 
 
-                pxpy = t.rasterized_triangle->xy_to_pxpy(t.v2[0],t.v2[1]);
+                pxpy = t.xy_to_pxpy(t.v2[0],t.v2[1]);
                 t.v2[0] = pxpy.first;
                 t.v2[1] = pxpy.second;
 
@@ -551,15 +630,28 @@
                 //solve for d
                 double d =a*o1 + b*o2 + c*o3;
 
+                //the pyramid's bounds decide the triangle without a scan if they're both on the same side of the tolerance.
+                //Not worth it for small triangles
+                if (r.has_pyramid() && c != 0 && t.xsize * t.ysize > 64)
+                {
+                    double upper, lower;
+                    t.plane_bounds(a, b, c, d, upper, lower);
+                    if (upper <= tol)
+                        return upper;
+                    if (lower > tol)
+                        return lower;
+                }
+                t.read_values();
+
                 double max_diff = -1;
                 double n = 0;
 
 
-                for (int y = 0; y < t.rasterized_triangle->getDs()->GetRasterYSize(); y++)
+                for (int y = 0; y < t.ysize; y++)
                 {
-                    for (int x = 0; x < t.rasterized_triangle->getDs()->GetRasterXSize(); x++)
+                    for (int x = t.spans[y].first; x <= t.spans[y].second; x++)
                     {
-                        double value = t.rasterized_triangle->getpXpY(x, y);
+                        double value = t.getpXpY(x, y);
                         if (!std::isnan(value))
                         {
                             double z = -(a*x+b*y-d)/c; //plane eqn solved for z. allows us to predict z values via x,y coords
@@ -611,8 +703,33 @@
                 return CGAL::Mesh_2::NOT_BAD;
             }
 
+            //CGAL tests a face again each time it is requeued, so the result of a vertex triple is cached when enabled
             CGAL::Mesh_2::Face_badness operator()(const typename CDT::Face_handle &fh,
                                                   Quality &q) const
+            {
+                profile_scope scope(mesher_profile.is_bad);
+
+                if(!cache)
+                    return compute_badness(fh, q);
+
+                auto key = Cache::make_key(CGAL::to_double(fh->vertex(0)->point().x()), CGAL::to_double(fh->vertex(0)->point().y()),
+                                           CGAL::to_double(fh->vertex(1)->point().x()), CGAL::to_double(fh->vertex(1)->point().y()),
+                                           CGAL::to_double(fh->vertex(2)->point().x()), CGAL::to_double(fh->vertex(2)->point().y()));
+
+                std::pair<Quality, CGAL::Mesh_2::Face_badness> result;
+                if(cache->get(key, result))
+                {
+                    q = result.first;
+                    return result.second;
+                }
+
+                auto badness = compute_badness(fh, q);
+                cache->put(key, std::make_pair(q, badness));
+                return badness;
+            }
+
+            CGAL::Mesh_2::Face_badness compute_badness(const typename CDT::Face_handle &fh,
+                                                       Quality &q) const
             {
                 typedef typename CDT::Geom_traits Geom_traits;
                 typedef typename Geom_traits::Compute_area_2 Compute_area_2;
@@ -636,82 +753,11 @@
                 double area = 0;
                 if(is_geographic)
                 {
-                    const char* wkt = r.at(0).first->getDs()->GetProjectionRef();
-                    char* srs_wkt = const_cast<char*>(wkt);
-                    OGRSpatialReference srs;
-                    srs.importFromWkt(&srs_wkt);
-
-
-                    //memory shape file
-//                    auto driver = GetGDALDriverManager()->GetDriverByName("Memory");
-//                    auto shp = driver->Create("",0,0,0,GDT_Unknown,NULL);
-
-//                    auto driver = GetGDALDriverManager()->GetDriverByName("ESRI Shapefile");
-//                    auto shp = driver->Create("tri.shp",0,0,0,GDT_Unknown,NULL);
-
-
-//                    auto layer = shp->CreateLayer("poly",&srs,wkbPolygon,NULL);
-
-                    vertex v0;
-                    vertex v1;
-                    vertex v2;
-
-                    v0[0] = fh->vertex(0)->point().x();
-                    v0[1] = fh->vertex(0)->point().y();
-
-                    v1[0] = fh->vertex(1)->point().x();
-                    v1[1] = fh->vertex(1)->point().y();
-
-                    v2[0] = fh->vertex(2)->point().x();
-                    v2[1] = fh->vertex(2)->point().y();
-
-                    OGRLinearRing ring;
-                    ring.addPoint(v0[0],v0[1]);
-                    ring.addPoint(v1[0],v1[1]);
-                    ring.addPoint(v2[0],v2[1]);
-                    ring.addPoint(v0[0],v0[1]); //close it
-
-                    OGRPolygon poly;
-                    poly.addRing(&ring);
-
-//                    auto feature = OGRFeature::CreateFeature( layer->GetLayerDefn());
-//                    feature->SetGeometry(&poly);
-//                    layer->CreateFeature(feature);
-
-
-                    const char* wkt_out = "PROJCS[\"North_America_Albers_Equal_Area_Conic\", "
-                    "    GEOGCS[\"GCS_North_American_1983\",      "
-                    "   DATUM[\"North_American_Datum_1983\",           "
-                    "  SPHEROID[\"GRS_1980\",6378137,298.257222101]],      "
-                    "   PRIMEM[\"Greenwich\",0],        "
-                    " UNIT[\"Degree\",0.017453292519943295]], "
-                    "    PROJECTION[\"Albers_Conic_Equal_Area\"],  "
-                    "   PARAMETER[\"False_Easting\",0],     "
-                    "PARAMETER[\"False_Northing\",0],  "
-                    "   PARAMETER[\"longitude_of_center\",-96],  "
-                    "   PARAMETER[\"Standard_Parallel_1\",20],   "
-                    "  PARAMETER[\"Standard_Parallel_2\",60],   "
-                    "  PARAMETER[\"latitude_of_center\",40],    "
-                    " UNIT[\"Meter\",1],  "
-                    "   AUTHORITY[\"EPSG\",\"102008\"]]";
-                    char* out_wkt = const_cast<char*>(wkt_out);
-
-                    OGRSpatialReference  srs_out;
-                    srs_out.importFromWkt(&out_wkt);
-
-                    auto poCT = OGRCreateCoordinateTransformation( &srs,
-                                                                   &srs_out );
-
-
-//                    auto poly_prj = poly.clone();
-
-//                    poly.transform(prj_trans);
-                    poly.transform(poCT);
-
-                    area = poly.get_Area();
-
-//                    GDALClose( shp );
+                    double x[3] = {CGAL::to_double(pa.x()), CGAL::to_double(pb.x()), CGAL::to_double(pc.x())};
+                    double y[3] = {CGAL::to_double(pa.y()), CGAL::to_double(pb.y()), CGAL::to_double(pc.y())};
 
+                    profile_scope scope(mesher_profile.geographic_area);
+                    area = equal_area(prj_trans.get(), x, y);
                 }
                 else
                 {
@@ -742,15 +788,23 @@
                 if (current_badness != CGAL::Mesh_2::NOT_BAD)
                     return current_badness;
 
-
+                if (raster_filter && !raster_filter(fh))
+                    return current_badness;
 
                 //do numeric rasters
-                for(auto& itr : r)
+                for(size_t i = 0; i < r.size(); i++)
                 {
+                    auto& itr = r[i];
+
                     //if tolerance == -1, skip the tolerance tests because we want to make a uniform mesh.
                     if(itr.second != -1)
                     {
-                        auto t = error_fn(fh,*(itr.first));
+                        profile_scope raster_scope(mesher_profile.raster(i));
+                        profile_scope metric_scope(*metric_counter);
+                        auto t = error_fn(fh,*(itr.first),itr.second);
+                        metric_scope.stop();
+                        raster_scope.stop();
+
                         q._tolerance.push_back(std::make_pair(t,itr.second));
 
                         current_badness = operator()(q);
@@ -765,9 +819,16 @@
 
                 }
 
-                for(auto& itr : category_rasters)
+                for(size_t i = 0; i < category_rasters.size(); i++)
                 {
+                    auto& itr = category_rasters[i];
+
+                    profile_scope raster_scope(mesher_profile.category_raster(i));
+                    profile_scope metric_scope(mesher_profile.category);
                     auto t = categoryraster_isok(fh,*(itr.first));
+                    metric_scope.stop();
+                    raster_scope.stop();
+
                     q._category_tol.push_back(std::make_pair(t,itr.second));
 
                     current_badness = operator()(q);
@@ -782,6 +843,6 @@
 
         Is_bad is_bad_object() const
         {
-            return Is_bad(this->bound(), max_area, min_area, r, category_rasters, error_metric, is_geographic, prj_trans,this->traits);
+            return Is_bad(this->bound(), max_area, min_area, r, category_rasters, error_metric, is_geographic, prj_trans, cache, raster_filter, this->traits);
         }
     };
@@ -19,6 +19,9 @@
 #include <vector>
 #include <utility>
 #include <fstream>
+#include <thread>
+#include <algorithm>
+#include <cmath>
 
 #include "mesh.h"
 #include "version.h"
@@ -28,6 +31,9 @@
 #include "ogrsf_frmts.h"
 
 #include "raster.h"
+#include "npy.h"
+#include "partition.h"
+#include "profile.h"
 
 #include <boost/program_options.hpp>
 #include <boost/tokenizer.hpp>
@@ -45,7 +51,14 @@ int main(int argc, char *argv[])
     double max_area = 0;
     double min_area = 1;
     bool is_geographic = false;
+    bool binary_output = false;
+    double raster_memory = 2048; //MB
+    double badness_cache = 256; //MB
+    size_t category_max_classes = 64;
     size_t lloyd_itr = 0;
+    std::string profile_file;
+    size_t tiles = 1;
+    size_t threads = std::max(1u, std::thread::hardware_concurrency());
     std::string error_metric = "rmse"; //default of RMSE
     //holds all rasters we perform tolerance checking on
     std::vector< std::pair< boost::shared_ptr<raster>,double> > rasters;
@@ -72,6 +85,20 @@ int main(int argc, char *argv[])
             ("area,a", po::value<double>(&max_area), "Maximum area a triangle can be. Square unit.")
             ("min-area,m", po::value<double>(&min_area), "Minimum area a triangle can be. Square unit.")
             ("lloyd,l", po::value<size_t>(&lloyd_itr), "Number of Llyod iterations.")
+            ("tiles", po::value<size_t>(&tiles), "Split the domain into tiles x tiles tiles that are refined in parallel and then "
+                    "stitched into one triangulation with a final refinement pass about the seams. 1 refines the whole domain at once [default 1].")
+            ("threads", po::value<size_t>(&threads), "Number of threads used to refine the tiles [default number of cores].")
+            ("binary-output,B", po::value<bool>(&binary_output), "Set to true to also write the .node, .ele, and .neigh files as "
+                    "NumPy .npy arrays (e.g., .1.node.npy) that can be memory mapped. Indexes are zero based, -1 is no neighbour.")
+            ("raster-memory", po::value<double>(&raster_memory), "Memory budget in MB for holding the rasters in RAM during refinement [default 2048]. "
+                    "Rasters are loaded whole, in the order given, while they fit; the rest are read from disk a triangle at a time.")
+            ("badness-cache", po::value<double>(&badness_cache), "Memory in MB for caching the result of each triangle tested, "
+                    "so triangles CGAL tests again are not resampled. Least recently used triangles are dropped. Split between the threads when tiled. 0 turns it off [default 256].")
+            ("category-max-classes", po::value<size_t>(&category_max_classes), "Category rasters with at most this many classes get per class "
+                    "count tables (within the raster memory budget) so the fraction under a triangle is found per row instead of per cell [default 64].")
+            ("profile", po::value<std::string>(&profile_file), "Count and time each phase, each error metric, each raster, "
+                    "the triangle rasterization and the geographic area, and write the report to this json file on exit. "
+                    "Per triangle times are summed over threads.")
             ("error-metric,M", po::value<std::string>(&error_metric), "Error metric. One of: rmse, mean_tol, max_tol."
                                                          "mean_tol compares the mean triangle vertex value to the mean raster value. "
                                                         "max_tol mimics the ArcGIS TIN tolerance, and is the maximum difference between the triangle and any single raster cell.");
@@ -112,12 +139,34 @@ int main(int argc, char *argv[])
         exit(1);
     }
 
+    //converted to a size_t byte count, a negative budget would wrap around to no limit at all
+    if(raster_memory < 0)
+    {
+        std::cout << "Raster memory must not be negative" << std::endl;
+        exit(1);
+    }
+
+    if(badness_cache < 0)
+    {
+        std::cout << "Badness cache must not be negative" << std::endl;
+        exit(1);
+    }
+
     if(min_area <= 0 )
     {
         std::cout << "Min area must be greater than zero" << std::endl;
         exit(1);
     }
 
+    if(tiles < 1 || threads < 1)
+    {
+        std::cout << "Tiles and threads must be at least 1" << std::endl;
+        exit(1);
+    }
+
+
+    mesher_profile.enabled = !profile_file.empty();
+    std::vector<std::string> raster_files, category_files;
 
     if( vm.count("raster") && vm.count("tolerance"))
     {
@@ -134,6 +183,7 @@ int main(int argc, char *argv[])
             auto r = boost::make_shared<raster>();
             r->open(files.at(i));
             rasters.push_back(std::make_pair( r,tols.at(i) ));
+            raster_files.push_back(files.at(i));
         }
     }
 
@@ -158,12 +208,37 @@ int main(int argc, char *argv[])
                 exit(1);
             }
             category_rasters.push_back(std::make_pair( r,tols.at(i) ));
+            category_files.push_back(files.at(i));
         }
     }
 
-    CDT cdt;
+    //hold as many of the rasters in memory as the budget allows, so the per-triangle reads are just copies
+    size_t memory_budget = raster_memory * 1024 * 1024;
+    for(auto& itr : rasters)
+        memory_budget -= itr.first->load(memory_budget);
+    for(auto& itr : category_rasters)
+        memory_budget -= itr.first->load(memory_budget);
 
+    //then the tables that make the mean_tol and category queries a lookup per row of the triangle,
+    //or the pyramid that bounds the rmse and max_tol errors
+    if(error_metric == "mean_tol")
+    {
+        for(auto& itr : rasters)
+            memory_budget -= itr.first->build_row_sums(memory_budget);
+    }
+    else
+    {
+        for(auto& itr : rasters)
+            memory_budget -= itr.first->build_pyramid(memory_budget);
+    }
+    for(auto& itr : category_rasters)
+        memory_budget -= itr.first->build_class_counts(category_max_classes, memory_budget);
+
+    mesher_profile.set_rasters(raster_files, category_files);
 
+    CDT cdt;
+
+    profile_scope read_scope(mesher_profile.read_plgs);
     std::ifstream infile(poly_file);
     if(!infile)
     {
@@ -182,6 +257,7 @@ int main(int argc, char *argv[])
     iss >> row >> col;
     std::cout << std::setprecision(20);
     std::vector<Vertex_handle> vertex;
+    std::vector<Point> plgs;
     if (col != 2)
     {
         std::cout << "Wrong number of columns" <<std::endl;
@@ -201,6 +277,7 @@ int main(int argc, char *argv[])
         Vertex_handle vh = cdt.insert(Point(x,y));
         vh->info()=i;
         vertex.push_back(vh);
+        plgs.push_back(Point(x,y));
     }
 
     //skip last line of vertexes. this is a duplicate, so don't need it (Triangle does though)
@@ -215,6 +292,11 @@ int main(int argc, char *argv[])
     double special;
     header2 >> row >> special;
 
+    read_scope.stop();
+
+    //reading the segments is counted with their insertion
+    profile_scope constraint_scope(mesher_profile.insert_constraints);
+
     //ignoring the last 2 items as they are for Triangle, but we aren't using it here
     for(int i=0;i<row-2; i++)
     {
@@ -242,10 +324,31 @@ int main(int argc, char *argv[])
     v0 = vertex.at(row-2);
     v1 = vertex.at(0);
     cdt.insert_constraint(v0,v1);
+    constraint_scope.stop();
 
     std::cout << "Number of input PLGS vertices: " << cdt.number_of_vertices() << std::endl;
     std::cout << "Meshing the triangulation..." << std::endl;
-    CGAL::refine_Delaunay_mesh_2(cdt, Criteria(0.125,max_area,min_area,rasters,category_rasters,error_metric,is_geographic));
+    size_t cache_bytes = badness_cache * 1024 * 1024;
+    auto make_criteria = [&](size_t bytes)
+    {
+        return Criteria(0.125,max_area,min_area,rasters,category_rasters,error_metric,is_geographic,bytes);
+    };
+
+    profile_scope refine_scope(mesher_profile.refine);
+    if(tiles > 1)
+    {
+        //a small fraction of a DEM cell, well above the rounding error of the clipped tile edges
+        double* gt = rasters.at(0).first->getGt();
+        double seam_tolerance = 1e-3 * std::min(std::fabs(gt[1]), std::fabs(gt[5]));
+        refine_partitioned(cdt, plgs, tiles, threads, seam_tolerance, cache_bytes, make_criteria);
+    }
+    else
+    {
+        auto criteria = make_criteria(cache_bytes);
+        CGAL::refine_Delaunay_mesh_2(cdt, criteria);
+        print_cache_stats("Badness cache", criteria.badness());
+    }
+    refine_scope.stop();
 
     //run lloyd optimizations if required.
     //if run, 100 is a good pick
@@ -253,10 +356,12 @@ int main(int argc, char *argv[])
     if(lloyd_itr > 0)
     {
         std::cout << "Running " << lloyd_itr << " Lloyd iterations...";
+        profile_scope lloyd_scope(mesher_profile.lloyd);
         CGAL::lloyd_optimize_mesh_2(cdt, CGAL::parameters::max_iteration_number = lloyd_itr);
         std::cout << " done." << std::endl;
     }
 
+    profile_scope output_scope(mesher_profile.output);
     auto nodefilepath = path; //eg PLGSwolf_lidar1.1.node
     nodefilepath /= p.filename().replace_extension(".1.node");
     std::ofstream nodefile( nodefilepath.string());
@@ -267,6 +372,10 @@ int main(int argc, char *argv[])
 
     size_t mesh_vertex_i=1;
 
+    std::vector<double> node_npy;
+    if(binary_output)
+        node_npy.reserve(2 * cdt.number_of_vertices());
+
     for(auto itr = cdt.finite_vertices_begin(); itr != cdt.finite_vertices_end(); ++itr)
     {
 
@@ -274,6 +383,12 @@ int main(int argc, char *argv[])
 
         nodefile << mesh_vertex_i << "   " << itr->point().x() << "   " << itr->point().y() << "   0" << std::endl;
         ++mesh_vertex_i;
+
+        if(binary_output)
+        {
+            node_npy.push_back(itr->point().x());
+            node_npy.push_back(itr->point().y());
+        }
     }
 
 
@@ -311,6 +426,14 @@ int main(int argc, char *argv[])
 
     int i=1;
 
+    std::vector<int32_t> elem_npy;
+    std::vector<int32_t> neigh_npy;
+    if(binary_output)
+    {
+        elem_npy.reserve(3 * (elem_i - 1));
+        neigh_npy.reserve(3 * (elem_i - 1));
+    }
+
     for(auto itr = cdt.finite_faces_begin(); itr != cdt.finite_faces_end(); itr++ )
     {
         if(itr->is_in_domain())
@@ -327,12 +450,36 @@ int main(int argc, char *argv[])
 
             neighfile << i <<  "  " << n0->id << "  " << n1->id  <<"  "<< n2->id << std::endl;
           ++i;
+
+            if(binary_output)
+            {
+                //convert to zero indexing. Faces outside of the domain have id 0, so become -1
+                elem_npy.push_back(v0 - 1);
+                elem_npy.push_back(v1 - 1);
+                elem_npy.push_back(v2 - 1);
+
+                neigh_npy.push_back(n0->id - 1);
+                neigh_npy.push_back(n1->id - 1);
+                neigh_npy.push_back(n2->id - 1);
+            }
         }
 
     }
 
     elemfile.close();
     neighfile.close();
+
+    if(binary_output)
+    {
+        write_npy(nodefilepath.string() + ".npy", node_npy, node_npy.size() / 2, 2);
+        write_npy(elefilepath.string() + ".npy", elem_npy, elem_npy.size() / 3, 3);
+        write_npy(neighfilepath.string() + ".npy", neigh_npy, neigh_npy.size() / 3, 3);
+    }
+    output_scope.stop();
+
+    if(mesher_profile.enabled)
+        mesher_profile.write(profile_file, version);
+
     return 0;
 }
 
@@ -0,0 +1,67 @@
+// Mesher
+// Copyright (C) 2017 Christopher Marsh
+
+// This program is free software: you can redistribute it and/or modify
+// it under the terms of the GNU General Public License as published by
+// the Free Software Foundation, either version 3 of the License, or
+// (at your option) any later version.
+
+// This program is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+
+// You should have received a copy of the GNU General Public License
+// along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#pragma once
+
+#include <cstdint>
+#include <fstream>
+#include <iostream>
+#include <sstream>
+#include <string>
+#include <vector>
+
+//NumPy dtype string for the types we write
+template<typename T> inline const char* npy_type();
+template<> inline const char* npy_type<double>()  { return "f8"; }
+template<> inline const char* npy_type<int32_t>() { return "i4"; }
+
+// Writes a C-ordered rows x cols array to a NumPy .npy (format 1.0) file so that it can be np.load'ed, or
+// memory mapped, without any parsing.
+// https://numpy.org/doc/stable/reference/generated/numpy.lib.format.html
+template<typename T>
+void write_npy(const std::string& path, const std::vector<T>& data, size_t rows, size_t cols)
+{
+    const uint16_t one = 1;
+    bool little_endian = *reinterpret_cast<const char*>(&one) == 1;
+
+    std::ostringstream header;
+    header << "{'descr': '" << (little_endian ? '<' : '>') << npy_type<T>() << "', "
+           << "'fortran_order': False, "
+           << "'shape': (" << rows << ", " << cols << "), }";
+
+    //magic (6) + version (2) + header length (2) + header has to be a multiple of 64 bytes, terminated by a newline
+    std::string h = header.str();
+    size_t total = 10 + h.size() + 1;
+    h.append((64 - total % 64) % 64, ' ');
+    h.push_back('\n');
+
+    std::ofstream out(path, std::ios::binary);
+    if(!out)
+    {
+        std::cout << "Failed to open " << path << " for writing" << std::endl;
+        exit(1);
+    }
+
+    out.write("\x93NUMPY", 6);
+    out.put(1); //major version
+    out.put(0); //minor version
+
+    uint16_t len = h.size();
+    out.put(len & 0xff); //header length is always little endian
+    out.put(len >> 8);
+    out.write(h.data(), h.size());
+
+    out.write(reinterpret_cast<const char*>(data.data()), data.size() * sizeof(T));
+}
@@ -0,0 +1,254 @@
+// Mesher
+// Copyright (C) 2017 Christopher Marsh
+
+// This program is free software: you can redistribute it and/or modify
+// it under the terms of the GNU General Public License as published by
+// the Free Software Foundation, either version 3 of the License, or
+// (at your option) any later version.
+
+// This program is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+
+// You should have received a copy of the GNU General Public License
+// along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#include "partition.h"
+#include "profile.h"
+
+#include <iostream>
+#include <atomic>
+#include <mutex>
+#include <thread>
+#include <memory>
+#include <algorithm>
+#include <chrono>
+#include <cmath>
+#include <set>
+#include <unordered_set>
+
+#include <ogr_geometry.h>
+
+//insert the exterior ring of every polygon in geom as a closed loop of constraints. The PLGS is a single ring, so
+//the clipped pieces have no holes; line and point pieces where the PLGS just touches the tile are ignored
+static void insert_rings(CDT& cdt, const OGRGeometry* geom)
+{
+    auto type = wkbFlatten(geom->getGeometryType());
+
+    if (type == wkbPolygon)
+    {
+        auto ring = static_cast<const OGRPolygon*>(geom)->getExteriorRing();
+        if (!ring)
+            return;
+
+        //last point closes the ring
+        int n = ring->getNumPoints() - 1;
+        if (n < 3)
+            return;
+
+        std::vector<Vertex_handle> vertex;
+        for (int i = 0; i < n; i++)
+            vertex.push_back(cdt.insert(Point(ring->getX(i), ring->getY(i))));
+
+        for (int i = 0; i < n; i++)
+        {
+            if (vertex[i] != vertex[(i + 1) % n])
+                cdt.insert_constraint(vertex[i], vertex[(i + 1) % n]);
+        }
+    }
+    else if (type == wkbMultiPolygon || type == wkbGeometryCollection)
+    {
+        auto collection = static_cast<const OGRGeometryCollection*>(geom);
+        for (int i = 0; i < collection->getNumGeometries(); i++)
+            insert_rings(cdt, collection->getGeometryRef(i));
+    }
+}
+
+//the badness cache key of a face
+static Criteria::Cache::key_type face_key(const CDT::Face_handle& fh)
+{
+    return Criteria::Cache::make_key(CGAL::to_double(fh->vertex(0)->point().x()), CGAL::to_double(fh->vertex(0)->point().y()),
+                                     CGAL::to_double(fh->vertex(1)->point().x()), CGAL::to_double(fh->vertex(1)->point().y()),
+                                     CGAL::to_double(fh->vertex(2)->point().x()), CGAL::to_double(fh->vertex(2)->point().y()));
+}
+
+void print_cache_stats(const std::string& label, const boost::shared_ptr<Criteria::Cache>& cache)
+{
+    if (!cache)
+        return;
+
+    size_t tests = cache->hits() + cache->misses();
+    std::cout << label << ": " << cache->hits() << " hits, " << cache->misses() << " misses ("
+              << (tests ? 100.0 * cache->hits() / tests : 0) << "% of " << tests << " triangle tests saved), "
+              << cache->evictions() << " evictions" << std::endl;
+}
+
+void refine_partitioned(CDT& cdt,
+                        const std::vector<Point>& plgs,
+                        size_t tiles,
+                        size_t threads,
+                        double seam_tolerance,
+                        size_t cache_bytes,
+                        boost::function<Criteria(size_t)> make_criteria)
+{
+    OGRLinearRing ring;
+    for (auto& p : plgs)
+        ring.addPoint(p.x(), p.y());
+    ring.closeRings();
+
+    OGRPolygon domain;
+    domain.addRing(&ring);
+
+    OGREnvelope env;
+    domain.getEnvelope(&env);
+
+    //the seams, computed once so the tiles and the seam test below agree exactly
+    std::vector<double> seam_x(tiles + 1), seam_y(tiles + 1);
+    for (size_t i = 0; i <= tiles; i++)
+    {
+        seam_x[i] = env.MinX + (env.MaxX - env.MinX) * i / tiles;
+        seam_y[i] = env.MinY + (env.MaxY - env.MinY) * i / tiles;
+    }
+    seam_x[tiles] = env.MaxX;
+    seam_y[tiles] = env.MaxY;
+
+    //clip up front, the tile meshes only need the pieces
+    std::vector< std::unique_ptr<OGRGeometry> > pieces;
+    for (size_t ty = 0; ty < tiles; ty++)
+    {
+        for (size_t tx = 0; tx < tiles; tx++)
+        {
+            OGRLinearRing box_ring;
+            box_ring.addPoint(seam_x[tx], seam_y[ty]);
+            box_ring.addPoint(seam_x[tx + 1], seam_y[ty]);
+            box_ring.addPoint(seam_x[tx + 1], seam_y[ty + 1]);
+            box_ring.addPoint(seam_x[tx], seam_y[ty + 1]);
+            box_ring.closeRings();
+
+            OGRPolygon box;
+            box.addRing(&box_ring);
+
+            std::unique_ptr<OGRGeometry> piece(domain.Intersection(&box));
+            if (!piece)
+            {
+                std::cout << "Failed to clip the PLGS to tile " << tx << "," << ty << std::endl;
+                exit(1);
+            }
+            if (!piece->IsEmpty())
+                pieces.push_back(std::move(piece));
+        }
+    }
+
+    //within seam_tolerance of an interior seam
+    auto near_seam = [&](double x, double y)
+    {
+        for (size_t i = 1; i < tiles; i++)
+        {
+            if (std::fabs(x - seam_x[i]) <= seam_tolerance || std::fabs(y - seam_y[i]) <= seam_tolerance)
+                return true;
+        }
+        return false;
+    };
+
+    std::set< std::pair<double, double> > plgs_vertex;
+    for (auto& p : plgs)
+        plgs_vertex.insert(std::make_pair(CGAL::to_double(p.x()), CGAL::to_double(p.y())));
+
+    size_t workers = std::max<size_t>(1, std::min(threads, pieces.size()));
+    std::cout << "Meshing " << pieces.size() << " tiles with " << workers << " threads..." << std::endl;
+
+    std::vector< std::vector<Point> > tile_points(pieces.size());
+    std::vector< std::vector<Criteria::Cache::key_type> > tile_faces(pieces.size());
+    std::atomic<size_t> next(0);
+    std::mutex print_mutex;
+
+    auto worker = [&]()
+    {
+        size_t t;
+        while ((t = next++) < pieces.size())
+        {
+            CDT tile;
+            insert_rings(tile, pieces[t].get());
+            if (tile.number_of_vertices() < 3)
+                continue;
+
+            //each worker's tiles share its part of the cache budget
+            auto criteria = make_criteria(cache_bytes / workers);
+            CGAL::refine_Delaunay_mesh_2(tile, criteria);
+
+            for (auto itr = tile.finite_vertices_begin(); itr != tile.finite_vertices_end(); ++itr)
+            {
+                const Point& p = itr->point();
+                double x = CGAL::to_double(p.x());
+                double y = CGAL::to_double(p.y());
+
+                //Steiner points on the interior seams are left for the final pass, as the tiles either side split them
+                //independently. The clipping puts them up to a rounding error off the seam
+                if (near_seam(x, y) && !plgs_vertex.count(std::make_pair(x, y)))
+                    continue;
+
+                tile_points[t].push_back(p);
+            }
+
+            //every face of the domain passed the criteria once the refinement is done
+            for (auto itr = tile.finite_faces_begin(); itr != tile.finite_faces_end(); ++itr)
+            {
+                if (itr->is_in_domain())
+                    tile_faces[t].push_back(face_key(itr));
+            }
+
+            std::lock_guard<std::mutex> lock(print_mutex);
+            std::cout << "Tile " << t + 1 << "/" << pieces.size() << ": " << tile.number_of_vertices() << " vertices" << std::endl;
+            print_cache_stats("Tile " + std::to_string(t + 1) + " badness cache", criteria.badness());
+        }
+    };
+
+    auto start = std::chrono::steady_clock::now();
+    profile_scope tiles_scope(mesher_profile.refine_tiles);
+    std::vector<std::thread> pool;
+    for (size_t i = 0; i < workers; i++)
+        pool.push_back(std::thread(worker));
+    for (auto& th : pool)
+        th.join();
+    tiles_scope.stop();
+    std::chrono::duration<double> tiles_time = std::chrono::steady_clock::now() - start;
+    std::cout << "Refined the tiles in " << tiles_time.count() << " s" << std::endl;
+
+    start = std::chrono::steady_clock::now();
+    profile_scope stitch_scope(mesher_profile.stitch);
+
+    std::cout << "Stitching the tiles..." << std::endl;
+    for (auto& points : tile_points)
+        cdt.insert(points.begin(), points.end());
+
+    //The faces that are the same three vertexes as a face of a tile mesh have already passed the rasters. Any other face,
+    //about the seams or made by the final pass, is tested again
+    Criteria::Cache::key_set passed;
+    for (auto& faces : tile_faces)
+    {
+        passed.insert(faces.begin(), faces.end());
+        std::vector<Criteria::Cache::key_type>().swap(faces);
+    }
+
+    Criteria::Cache::key_set tested;
+    auto not_passed = [&](const CDT::Face_handle& fh)
+    {
+        auto key = face_key(fh);
+        if (passed.count(key))
+            return false;
+
+        tested.insert(key);
+        return true;
+    };
+
+    //the final pass runs alone, so it gets the whole cache budget
+    auto criteria = make_criteria(cache_bytes);
+    criteria.set_raster_filter(not_passed);
+    CGAL::refine_Delaunay_mesh_2(cdt, criteria);
+    stitch_scope.stop();
+
+    std::chrono::duration<double> stitch_time = std::chrono::steady_clock::now() - start;
+    std::cout << "Stitched the tiles in " << stitch_time.count() << " s, " << tested.size()
+              << " faces not in a tile mesh tested against the rasters" << std::endl;
+    print_cache_stats("Stitch badness cache", criteria.badness());
+}
@@ -0,0 +1,40 @@
+// Mesher
+// Copyright (C) 2017 Christopher Marsh
+
+// This program is free software: you can redistribute it and/or modify
+// it under the terms of the GNU General Public License as published by
+// the Free Software Foundation, either version 3 of the License, or
+// (at your option) any later version.
+
+// This program is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+
+// You should have received a copy of the GNU General Public License
+// along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#pragma once
+
+#include <vector>
+#include <string>
+#include <boost/function.hpp>
+
+#include "mesh.h"
+
+//print the hits and misses of a criteria's badness cache, if it has one
+void print_cache_stats(const std::string& label, const boost::shared_ptr<Criteria::Cache>& cache);
+
+//Refines cdt by splitting the PLGS into tiles x tiles tiles along the bounding box and refining each tile
+//independently, threads at a time. Each tile is the PLGS clipped to the tile, with the tile edges as constrained seams,
+//and gets its own criteria from make_criteria with its thread's share of cache_bytes for the badness cache. The tile
+//vertexes, less the Steiner points within seam_tolerance of the interior seams, are then inserted into cdt, which must
+//already hold the PLGS constraints. A final refinement pass, with the whole cache_bytes, fixes up the triangles about
+//the seams; faces that are also faces of a tile mesh only have their area and angle checked. The result is one
+//conforming triangulation.
+void refine_partitioned(CDT& cdt,
+                        const std::vector<Point>& plgs,
+                        size_t tiles,
+                        size_t threads,
+                        double seam_tolerance,
+                        size_t cache_bytes,
+                        boost::function<Criteria(size_t)> make_criteria);
@@ -0,0 +1,124 @@
+// Mesher
+// Copyright (C) 2017 Christopher Marsh
+
+// This program is free software: you can redistribute it and/or modify
+// it under the terms of the GNU General Public License as published by
+// the Free Software Foundation, either version 3 of the License, or
+// (at your option) any later version.
+
+// This program is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+
+// You should have received a copy of the GNU General Public License
+// along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#include "profile.h"
+
+#include <iostream>
+#include <fstream>
+#include <iomanip>
+
+profiler mesher_profile;
+
+profiler::profiler()
+{
+    enabled = false;
+}
+
+void profiler::set_rasters(const std::vector<std::string>& files, const std::vector<std::string>& category_files)
+{
+    raster_files = files;
+    this->category_files = category_files;
+
+    rasters = std::vector<profile_counter>(files.size());
+    category_rasters = std::vector<profile_counter>(category_files.size());
+}
+
+profile_counter& profiler::raster(size_t i)
+{
+    return i < rasters.size() ? rasters[i] : unused;
+}
+
+profile_counter& profiler::category_raster(size_t i)
+{
+    return i < category_rasters.size() ? category_rasters[i] : unused;
+}
+
+//escape the few characters a file path could have that json doesn't allow
+static std::string json_string(const std::string& s)
+{
+    std::string out = "\"";
+    for (auto c : s)
+    {
+        if (c == '"' || c == '\\')
+            out += '\\';
+        out += c;
+    }
+    return out + "\"";
+}
+
+static void write_counter(std::ostream& out, const std::string& name, const profile_counter& c, bool last = false)
+{
+    out << "    " << json_string(name) << ": {\"calls\": " << c.calls << ", \"seconds\": " << c.ns / 1e9 << "}"
+        << (last ? "" : ",") << std::endl;
+}
+
+static void write_rasters(std::ostream& out, const std::vector<std::string>& files, const std::vector<profile_counter>& counters)
+{
+    out << "[" << std::endl;
+    for (size_t i = 0; i < files.size(); i++)
+    {
+        out << "    {\"file\": " << json_string(files[i]) << ", \"calls\": " << counters[i].calls
+            << ", \"seconds\": " << counters[i].ns / 1e9 << "}" << (i + 1 == files.size() ? "" : ",") << std::endl;
+    }
+    out << "  ]";
+}
+
+void profiler::write(const std::string& fname, const std::string& version) const
+{
+    std::ofstream out(fname);
+    if (!out)
+    {
+        std::cout << "Failed to open profile file " << fname << std::endl;
+        exit(1);
+    }
+
+    out << std::setprecision(9);
+    out << "{" << std::endl;
+    out << "  \"version\": " << json_string(version) << "," << std::endl;
+
+    out << "  \"phases\": {" << std::endl;
+    write_counter(out, "read_plgs", read_plgs);
+    write_counter(out, "insert_constraints", insert_constraints);
+    write_counter(out, "refine", refine);
+    write_counter(out, "refine_tiles", refine_tiles);
+    write_counter(out, "stitch", stitch);
+    write_counter(out, "lloyd", lloyd);
+    write_counter(out, "output", output, true);
+    out << "  }," << std::endl;
+
+    //summed over threads
+    out << "  \"triangles\": {" << std::endl;
+    write_counter(out, "is_bad", is_bad);
+    write_counter(out, "make_rasterized", make_rasterized);
+    write_counter(out, "geographic_area", geographic_area, true);
+    out << "  }," << std::endl;
+
+    out << "  \"metrics\": {" << std::endl;
+    write_counter(out, "rmse", rmse);
+    write_counter(out, "mean_tol", mean_tol);
+    write_counter(out, "max_tol", max_tol);
+    write_counter(out, "category", category, true);
+    out << "  }," << std::endl;
+
+    out << "  \"rasters\": ";
+    write_rasters(out, raster_files, rasters);
+    out << "," << std::endl;
+
+    out << "  \"category_rasters\": ";
+    write_rasters(out, category_files, category_rasters);
+    out << std::endl;
+
+    out << "}" << std::endl;
+}
@@ -0,0 +1,113 @@
+// Mesher
+// Copyright (C) 2017 Christopher Marsh
+
+// This program is free software: you can redistribute it and/or modify
+// it under the terms of the GNU General Public License as published by
+// the Free Software Foundation, either version 3 of the License, or
+// (at your option) any later version.
+
+// This program is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+
+// You should have received a copy of the GNU General Public License
+// along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#pragma once
+
+#include <atomic>
+#include <chrono>
+#include <cstdint>
+#include <string>
+#include <vector>
+
+//number of calls and cumulative time of one piece of the mesher. Threads add to it concurrently, so the time of the
+//per triangle counters is summed over threads
+struct profile_counter
+{
+    std::atomic<uint64_t> calls;
+    std::atomic<uint64_t> ns;
+
+    profile_counter() : calls(0), ns(0) {}
+};
+
+//the counters reported by --profile
+class profiler
+{
+public:
+    profiler();
+
+    //set up the per raster counters, before any refinement starts
+    void set_rasters(const std::vector<std::string>& files, const std::vector<std::string>& category_files);
+
+    //the counter of the i-th tolerance (category) raster
+    profile_counter& raster(size_t i);
+    profile_counter& category_raster(size_t i);
+
+    //write the report as json
+    void write(const std::string& fname, const std::string& version) const;
+
+    bool enabled;
+
+    //phases
+    profile_counter read_plgs;
+    profile_counter insert_constraints;
+    profile_counter refine;
+    profile_counter refine_tiles;
+    profile_counter stitch;
+    profile_counter lloyd;
+    profile_counter output;
+
+    //per triangle
+    profile_counter is_bad;
+    profile_counter rmse;
+    profile_counter mean_tol;
+    profile_counter max_tol;
+    profile_counter category;
+    profile_counter make_rasterized;
+    profile_counter geographic_area;
+
+private:
+    std::vector<profile_counter> rasters;
+    std::vector<profile_counter> category_rasters;
+    std::vector<std::string> raster_files;
+    std::vector<std::string> category_files;
+
+    //out of range rasters count here
+    profile_counter unused;
+};
+
+extern profiler mesher_profile;
+
+//times its scope into counter when profiling is on
+class profile_scope
+{
+public:
+    profile_scope(profile_counter& counter)
+    {
+        c = mesher_profile.enabled ? &counter : nullptr;
+        if (c)
+            start = std::chrono::steady_clock::now();
+    }
+
+    ~profile_scope()
+    {
+        stop();
+    }
+
+    //stop timing before the end of the scope
+    void stop()
+    {
+        if (c)
+        {
+            auto ns = std::chrono::duration_cast<std::chrono::nanoseconds>(std::chrono::steady_clock::now() - start).count();
+            c->calls += 1;
+            c->ns += ns;
+            c = nullptr;
+        }
+    }
+
+private:
+    profile_counter* c;
+    std::chrono::steady_clock::time_point start;
+};
@@ -16,6 +16,9 @@
 
 #include "raster.h"
 
+#include <algorithm>
+#include <limits>
+
 void raster::open(std::string path)
 {
     ds = nullptr;
@@ -30,24 +33,307 @@ void raster::open(std::string path)
     GDALGetGeoTransform( ds, gt );
 
     band = ds->GetRasterBand( 1 );
+    nodata = band->GetNoDataValue(NULL);
+
+}
+
+size_t raster::load(size_t max_bytes)
+{
+    size_t xsize = ds->GetRasterXSize();
+    size_t ysize = ds->GetRasterYSize();
+    size_t bytes = xsize * ysize * sizeof(float);
+
+    if (bytes > max_bytes)
+        return 0;
+
+    std::vector<float> band_data(xsize * ysize);
+    auto err = band->RasterIO(GF_Read, 0, 0, xsize, ysize,
+                              &band_data[0], xsize, ysize, GDT_Float32,
+                              0, 0);
+    if (err != CE_None)
+    {
+        std::cout << "Error reading raster band into memory. GDAL CPLE error = " << err << std::endl;
+        exit(1);
+    }
+
+    //normalize the nodata once here so lookups only need to check for nan
+    for (auto& value : band_data)
+    {
+        if (value == nodata)
+            value = nanf("");
+    }
+
+    data.swap(band_data);
+    return bytes;
+}
+
+bool raster::is_loaded() const
+{
+    return !data.empty();
+}
+
+size_t raster::build_row_sums(size_t max_bytes)
+{
+    if (!is_loaded())
+        return 0;
+
+    size_t xsize = ds->GetRasterXSize();
+    size_t ysize = ds->GetRasterYSize();
+    size_t bytes = (xsize + 1) * ysize * (sizeof(double) + sizeof(int32_t));
+
+    if (bytes > max_bytes)
+        return 0;
+
+    row_sum.assign((xsize + 1) * ysize, 0);
+    row_count.assign((xsize + 1) * ysize, 0);
+
+    for (size_t y = 0; y < ysize; y++)
+    {
+        const float* row = &data[y * xsize];
+        double* sum = &row_sum[y * (xsize + 1)];
+        int32_t* count = &row_count[y * (xsize + 1)];
+
+        for (size_t x = 0; x < xsize; x++)
+        {
+            bool valid = !std::isnan(row[x]);
+            sum[x + 1] = sum[x] + (valid ? row[x] : 0);
+            count[x + 1] = count[x] + valid;
+        }
+    }
+
+    return bytes;
+}
+
+bool raster::has_row_sums() const
+{
+    return !row_sum.empty();
+}
+
+void raster::span_sum(int py, int c0, int c1, double& sum, double& count) const
+{
+    size_t idx = py * (size_t)(ds->GetRasterXSize() + 1);
+    sum += row_sum[idx + c1 + 1] - row_sum[idx + c0];
+    count += row_count[idx + c1 + 1] - row_count[idx + c0];
+}
+
+size_t raster::build_class_counts(size_t max_classes, size_t max_bytes)
+{
+    if (!is_loaded())
+        return 0;
+
+    size_t xsize = ds->GetRasterXSize();
+    size_t ysize = ds->GetRasterYSize();
+
+    //index of each class
+    std::map<int,size_t> classes;
+    for (auto& value : data)
+    {
+        if (!std::isnan(value) && classes.find((int) value) == classes.end())
+        {
+            if (classes.size() == max_classes)
+                return 0;
+
+            size_t idx = classes.size();
+            classes[(int) value] = idx;
+        }
+    }
+
+    size_t bytes = classes.size() * (xsize + 1) * ysize * sizeof(int32_t);
+    if (bytes > max_bytes)
+        return 0;
+
+    nclasses = classes.size();
+    class_count.assign(nclasses * (xsize + 1) * ysize, 0);
+
+    for (size_t y = 0; y < ysize; y++)
+    {
+        const float* row = &data[y * xsize];
+        for (size_t x = 0; x < xsize; x++)
+        {
+            int cls = std::isnan(row[x]) ? -1 : (int) classes[(int) row[x]];
+            for (size_t k = 0; k < nclasses; k++)
+            {
+                int32_t* count = &class_count[(y * nclasses + k) * (xsize + 1)];
+                count[x + 1] = count[x] + (cls == (int) k);
+            }
+        }
+    }
+
+    return bytes;
+}
+
+bool raster::has_class_counts() const
+{
+    return !class_count.empty();
+}
+
+size_t raster::n_classes() const
+{
+    return nclasses;
+}
+
+void raster::span_class_counts(int py, int c0, int c1, std::vector<double>& counts) const
+{
+    size_t xsize = ds->GetRasterXSize();
+    for (size_t k = 0; k < nclasses; k++)
+    {
+        const int32_t* count = &class_count[(py * nclasses + k) * (xsize + 1)];
+        counts[k] += count[c1 + 1] - count[c0];
+    }
+}
+
+size_t raster::build_pyramid(size_t max_bytes)
+{
+    if (!is_loaded())
+        return 0;
+
+    int xsize = ds->GetRasterXSize();
+    int ysize = ds->GetRasterYSize();
+
+    //size it first
+    size_t bytes = 0;
+    for (int size = 4; ; size *= 2)
+    {
+        size_t nx = (xsize + size - 1) / size;
+        size_t ny = (ysize + size - 1) / size;
+        bytes += nx * ny * sizeof(block);
+        if (nx == 1 && ny == 1)
+            break;
+    }
+
+    if (bytes > max_bytes)
+        return 0;
+
+    block empty;
+    empty.min = std::numeric_limits<float>::infinity();
+    empty.max = -std::numeric_limits<float>::infinity();
+    empty.count = 0;
+
+    //level 0 from the cells
+    int nx = (xsize + 3) / 4;
+    int ny = (ysize + 3) / 4;
+    std::vector<block> level(nx * ny, empty);
+    for (int y = 0; y < ysize; y++)
+    {
+        for (int x = 0; x < xsize; x++)
+        {
+            float value = data[x + y * (size_t)xsize];
+            if (std::isnan(value))
+                continue;
+
+            block& b = level[x / 4 + (y / 4) * nx];
+            b.min = std::min(b.min, value);
+            b.max = std::max(b.max, value);
+            b.count++;
+        }
+    }
+
+    pyramid.push_back(level);
+    pyramid_x.push_back(nx);
+    pyramid_y.push_back(ny);
+
+    //each coarser level from the 2x2 blocks below it
+    while (nx > 1 || ny > 1)
+    {
+        int cnx = nx;
+        nx = (nx + 1) / 2;
+        ny = (ny + 1) / 2;
+
+        const std::vector<block>& children = pyramid.back();
+        std::vector<block> parents(nx * ny, empty);
+        for (size_t i = 0; i < children.size(); i++)
+        {
+            const block& c = children[i];
+            block& b = parents[(i % cnx) / 2 + ((i / cnx) / 2) * nx];
+            b.min = std::min(b.min, c.min);
+            b.max = std::max(b.max, c.max);
+            b.count += c.count;
+        }
+
+        pyramid.push_back(parents);
+        pyramid_x.push_back(nx);
+        pyramid_y.push_back(ny);
+    }
+
+    return bytes;
+}
 
+bool raster::has_pyramid() const
+{
+    return !pyramid.empty();
+}
+
+int raster::pyramid_levels() const
+{
+    return pyramid.size();
+}
+
+int raster::pyramid_block_size(int level) const
+{
+    return 4 << level;
+}
+
+int raster::pyramid_nx(int level) const
+{
+    return pyramid_x[level];
+}
+
+int raster::pyramid_ny(int level) const
+{
+    return pyramid_y[level];
+}
+
+const raster::block& raster::pyramid_block(int level, int bx, int by) const
+{
+    return pyramid[level][bx + by * pyramid_x[level]];
+}
+
+void raster::read_window(int x_off, int y_off, int xsize, int ysize, float* out) const
+{
+    if (is_loaded())
+    {
+        size_t width = ds->GetRasterXSize();
+        for (int y = 0; y < ysize; y++)
+        {
+            const float* row = &data[x_off + (y_off + y) * width];
+            std::copy(row, row + xsize, out + y * xsize);
+        }
+        return;
+    }
+
+    CPLErr err;
+    {
+        std::lock_guard<std::mutex> lock(io_mutex);
+        err = band->RasterIO(GF_Read, x_off, y_off, xsize, ysize,
+                             out, xsize, ysize, GDT_Float32,
+                             0, 0);
+    }
+    if (err != CE_None)
+    {
+        std::cout << "Error reading raster window. GDAL CPLE error = " << err << std::endl;
+        exit(1);
+    }
+
+    for (int i = 0; i < xsize * ysize; i++)
+    {
+        if (out[i] == nodata)
+            out[i] = nanf("");
+    }
 }
 
 raster::raster()
 {
-    mask = nullptr;
-    data = nullptr;
     ds = nullptr;
     band = nullptr;
     gt = nullptr;
+    nodata = nan("");
+    nclasses = 0;
 }
 
 raster::~raster()
 {
     if(gt) delete[] gt;
-    if(mask) delete[] mask;
     if(ds) GDALClose(ds);
-    if(data) delete[] data;
 
 }
 
@@ -118,53 +404,21 @@ void raster::setDs(GDALDataset* ds)
     GDALGetGeoTransform( this->ds, gt );
 
     band = this->ds->GetRasterBand( 1 );
+    nodata = band->GetNoDataValue(NULL);
+    data.clear();
+    row_sum.clear();
+    row_count.clear();
+    class_count.clear();
+    nclasses = 0;
+    pyramid.clear();
+    pyramid_x.clear();
+    pyramid_y.clear();
 }
 
-void raster::setMask(float *mask)
+double raster::getpXpY(int px, int py) const
 {
-    raster::mask = mask;
-}
-
-double raster::getpXpY(int px, int py)
-{
-    float pafScanline; //needs to be float because GDT_Float32
-
-//    GDALRasterIO(band, GF_Read, px, py, 1, 1,
-//                 &pafScanline, 1, 1, GDT_Float32,
-//                 0, 0);
+    float value; //needs to be float because GDT_Float32
+    read_window(px, py, 1, 1, &value);
 
-    int width = ds->GetRasterXSize();
-    auto idx = px + py * width;
-    pafScanline = data[idx];
-
-    double value = pafScanline; //cast up
-    if(mask)
-    {
-        //col + NCOLS * row
-        int idx = px+ds->GetRasterXSize()*py;
-        if (mask[idx] == 0) // 0 = no triangle touching this cell
-        {
-            value = nan("");
-        }
-    }
-
-    value = value == band->GetNoDataValue(NULL) ? nan("") : value;
-    return value;
+    return value; //cast up
 }
-
-
-
-
-void raster::setBand(float *data, int xsize, int ysize)
-{
-    auto err = band->RasterIO( GF_Write, 0, 0, xsize, ysize,
-                      data, xsize, ysize, GDT_Float32, 0, 0 );
-    if (err != CE_None )
-    {
-        std::cout << "Error when updating raster band. GDAL CPLE error = "<<err<<std::endl;
-        exit(1);
-    }
-
-    this->data = data;
-}
-
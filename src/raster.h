@@ -20,6 +20,10 @@
 #include <iostream>
 #include <string>
 #include <utility>
+#include <vector>
+#include <map>
+#include <cstdint>
+#include <mutex>
 
 #include <boost/shared_ptr.hpp>
 #include <boost/make_shared.hpp>
@@ -32,25 +36,82 @@ public:
     virtual ~raster();
 
     void open(std::string path);
+
+    //read the whole band into memory if it needs at most max_bytes. Returns the bytes used, 0 if it stays on disk
+    size_t load(size_t max_bytes);
+    bool is_loaded() const;
+
+    //copy a window of the band into out (xsize*ysize, row major). Nodata is nan
+    void read_window(int x_off, int y_off, int xsize, int ysize, float* out) const;
+
+    //per row prefix sums and counts of the valid cells of a loaded raster, so the sum over a run of a row is two lookups.
+    //Returns the bytes used, 0 if they don't fit in max_bytes
+    size_t build_row_sums(size_t max_bytes);
+    bool has_row_sums() const;
+
+    //add the sum and count of the valid cells in columns c0..c1 of row py
+    void span_sum(int py, int c0, int c1, double& sum, double& count) const;
+
+    //per row, per class prefix counts of a loaded category raster (classes are the cell values cast to int).
+    //Returns the bytes used, 0 if there are more than max_classes classes or they don't fit in max_bytes
+    size_t build_class_counts(size_t max_classes, size_t max_bytes);
+    bool has_class_counts() const;
+    size_t n_classes() const;
+
+    //add the count of each class in columns c0..c1 of row py to counts (n_classes long)
+    void span_class_counts(int py, int c0, int c1, std::vector<double>& counts) const;
+
+    //min, max and number of valid cells of a block of the raster
+    struct block
+    {
+        float min;
+        float max;
+        int32_t count;
+    };
+
+    //min/max pyramid of a loaded raster. Level 0 blocks are 4x4 cells and each level doubles the block size up to a
+    //single block. Returns the bytes used, 0 if it doesn't fit in max_bytes
+    size_t build_pyramid(size_t max_bytes);
+    bool has_pyramid() const;
+    int pyramid_levels() const;
+    int pyramid_block_size(int level) const;
+    int pyramid_nx(int level) const;
+    int pyramid_ny(int level) const;
+    const block& pyramid_block(int level, int bx, int by) const;
     void create_memory_raster(double xsize, double ysize, GDALDataType type);
 
     double getXY(double X, double Y);
-    double getpXpY(int px, int py);
+    double getpXpY(int px, int py) const;
     GDALRasterBand *getBand() const;
 
     GDALDataset *getDs() const;
     void setDs(GDALDataset* ds);
     std::pair<int,int> xy_to_pxpy(double pX, double pY);
-    void setMask(float *mask);
-    void setBand(float *data, int xsize, int ysize);
     double *getGt() const;
 
 private:
     double* gt;
     GDALDataset* ds;
     GDALRasterBand* band;
-    float* mask;
-    float* data;
+    double nodata;
+
+    //the whole band when loaded, nodata already replaced by nan
+    std::vector<float> data;
+
+    //(xsize + 1) prefix entries per row
+    std::vector<double> row_sum;
+    std::vector<int32_t> row_count;
+
+    //(xsize + 1) prefix entries per class per row
+    std::vector<int32_t> class_count;
+    size_t nclasses;
+
+    std::vector< std::vector<block> > pyramid;
+    std::vector<int> pyramid_x;
+    std::vector<int> pyramid_y;
+
+    //GDAL datasets can't be read from several threads at once, so reads of rasters left on disk are serialized
+    mutable std::mutex io_mutex;
 
 
 
@@ -13,20 +13,21 @@
 
 // You should have received a copy of the GNU General Public License
 // along with this program.  If not, see <http://www.gnu.org/licenses/>.
-#include <csetjmp>
-#include <csignal>
-jmp_buf env;
-void on_sigabrt (int signum)
-{
-    longjmp (env, 1);
-}
-
 #include "triangle.h"
+#include "profile.h"
+
+#include <algorithm>
+#include <limits>
 
 triangle::triangle()
 {
 
     is_nan = false;
+    x_off = 0;
+    y_off = 0;
+    xsize = 0;
+    ysize = 0;
+    r = nullptr;
 }
 
 triangle::~triangle()
@@ -34,160 +35,115 @@ triangle::~triangle()
 
 }
 
-void triangle::make_rasterized(vertex v0_in, vertex v1_in, vertex v2_in, const raster& r)
+// Reads the window of the raster under the triangle and scan converts the triangle into it, with the same cells as
+// GDALRasterizeGeometries with ALL_TOUCHED=TRUE. Each row of the window is a strip one cell high, and the x extent of the
+// triangle clipped to that strip (the vertexes inside it and the edges' crossings of its top and bottom) gives the
+// contiguous run of touched columns. Cells are half-open, so an edge lying exactly on a grid line touches the cell
+// to its right/below as GDAL does.
+void triangle::make_rasterized(vertex v0_in, vertex v1_in, vertex v2_in, const raster& r, bool read_values)
 {
-    auto gt = r.getGt();
-    auto wkt = r.getDs()->GetProjectionRef();
-    auto srs = OGRSpatialReference(wkt);
-
-    OGRLinearRing ring;
-    ring.addPoint(v0_in[0],v0_in[1]);
-    ring.addPoint(v1_in[0],v1_in[1]);
-    ring.addPoint(v2_in[0],v2_in[1]);
-    ring.addPoint(v0_in[0],v0_in[1]); //close it
-
-    OGRPolygon poly;
-    poly.addRing(&ring);
+    profile_scope scope(mesher_profile.make_rasterized);
 
-    //memory shape file
-//    auto driver = GetGDALDriverManager()->GetDriverByName("Memory");
-//    auto shp = driver->Create("",0,0,0,GDT_Unknown,NULL);
-//    auto layer = shp->CreateLayer("poly",&srs,wkbPolygon,NULL);
+    this->r = &r;
 
-//    auto feature = OGRFeature::CreateFeature( layer->GetLayerDefn());
-//    feature->SetGeometry(&poly);
-//    layer->CreateFeature(feature);
+    auto rgt = r.getGt();
 
-    //we need to rasterize our triangle into a small raster
+    double originX = rgt[0];
+    double originY = rgt[3];
 
-    double originX = gt[0];
-    double originY = gt[3];
+    double pixel_width = rgt[1];
+    double pixel_height = rgt[5];
 
-    double pixel_width = gt[1];
-    double pixel_height = gt[5];
-
-    OGREnvelope bbox;
-    poly.getEnvelope(&bbox);
+    double minX = std::min(v0_in[0], std::min(v1_in[0], v2_in[0]));
+    double maxX = std::max(v0_in[0], std::max(v1_in[0], v2_in[0]));
+    double minY = std::min(v0_in[1], std::min(v1_in[1], v2_in[1]));
+    double maxY = std::max(v0_in[1], std::max(v1_in[1], v2_in[1]));
 
     //extents of the rasterized triangle
-    double new_gt[6];
-
-    int x1 = (int) ((bbox.MinX - originX) / pixel_width);
-    int x2 = (int) ((bbox.MaxX - originX) / pixel_width) + 1;
-    int y1 = (int) ((bbox.MaxY - originY) / pixel_height);
-    int y2 = (int) ((bbox.MinY - originY) / pixel_height) + 1;
-
-    int xsize = x2 - x1;
-    int ysize = y2 - y1;
-
-    //make a window into the main extent
-    new_gt[0] = gt[0] + (x1 * gt[1]);
-    new_gt[1] = gt[1];
-    new_gt[2] = 0.0;
-    new_gt[3] = gt[3] + (y1 * gt[5]);
-    new_gt[4] = 0.0;
-    new_gt[5] = gt[5];
+    int x1 = (int) ((minX - originX) / pixel_width);
+    int x2 = (int) ((maxX - originX) / pixel_width) + 1;
+    int y1 = (int) ((maxY - originY) / pixel_height);
+    int y2 = (int) ((minY - originY) / pixel_height) + 1;
 
     int y_raster_size = r.getDs()->GetRasterYSize();
     int x_raster_size = r.getDs()->GetRasterXSize();
-    if (y1 + ysize >= y_raster_size)
-    {
-        ysize = y_raster_size - y1;
-    }
-    if (x1 + xsize >=x_raster_size)
-    {
-        xsize = x_raster_size - x1;
-    }
 
-//    auto mem_drv = GetGDALDriverManager()->GetDriverByName("GTiff");
-//    auto rvds = mem_drv->Create("rtri.tiff",xsize,ysize,1,GDT_Float32,NULL);
+    x_off = std::max(x1, 0);
+    y_off = std::max(y1, 0);
+    xsize = std::min(x2, x_raster_size) - x_off;
+    ysize = std::min(y2, y_raster_size) - y_off;
 
-    auto mem_drv = GetGDALDriverManager()->GetDriverByName("MEM");
-    auto rvds = mem_drv->Create("",xsize,ysize,1,GDT_Float32,NULL);
-
-    if(!rvds)
+    //the triangle is entirely outside of the raster
+    if (xsize <= 0 || ysize <= 0)
     {
-        std::cout << "Yikes!" << std::endl;
-    }
-    rvds->SetGeoTransform(new_gt);
-
-
-    rvds->SetProjection(wkt);
-
-    std::vector<int> bandlist;
-    bandlist.push_back(1);
-
-    double burnValue = 1;
-
-    std::vector<OGRPolygon*> geoms;
-    geoms.push_back(&poly);
-
-    char **options = nullptr;
-    options = CSLSetNameValue(options, "ALL_TOUCHED", "TRUE");
-
-    //in som very rare, and still not totally sure why cases, this will fail with SIGABRT. So catch it, mark the triangle as isnan, and try to continue
-    if (setjmp (env) == 0) {
-        signal(SIGABRT, &on_sigabrt);
-        CPLErr err = GDALRasterizeGeometries(rvds, 1, &bandlist[0], 1, (OGRGeometryH*)&geoms[0], NULL, NULL, &burnValue, options, NULL, NULL);
-    }
-    else {
-        //all kinds of problems at this point, bail out
-        this->is_nan = true;
-        //        std::cout << "disaster!" << std::endl;
-        exit(1);
+        xsize = 0;
+        ysize = 0;
+        is_nan = true;
         return;
-
-
-
-//        //testing code to write out the triangle that is causing issues.
-//        auto driver = GetGDALDriverManager()->GetDriverByName("ESRI Shapefile");
-//        auto shp = driver->Create("broken_tri.shp",0,0,0,GDT_Unknown,NULL);
-//        auto layer = shp->CreateLayer("poly",&srs,wkbPolygon,NULL);
-//
-//        auto feature = OGRFeature::CreateFeature( layer->GetLayerDefn());
-//        feature->SetGeometry(&poly);
-//        layer->CreateFeature(feature);
-//        GDALClose(shp);
-//
-//
-//        auto drv = GetGDALDriverManager()->GetDriverByName("GTiff");
-//        auto rvds = drv->Create("rtri.tiff",xsize,ysize,1,GDT_Float32,NULL);
-//
-//        char *pszSRS_WKT = NULL;
-//        srs.exportToWkt(&pszSRS_WKT);
-//        rvds->SetProjection(pszSRS_WKT);
-//        CPLFree(pszSRS_WKT);
-//
-//        GDALClose(rvds);
-
-//        exit(1);
-//
-//        CPLErr err = GDALRasterizeGeometries(rvds, 1, &bandlist[0], 1, (OGRGeometryH*)&geoms[0], NULL, NULL, &burnValue, options, NULL, NULL);
-
-
     }
 
-    CSLDestroy(options);
-
-    rasterized_triangle = boost::make_shared<raster>();
-    rasterized_triangle->setDs(rvds); //rvds owned now
-
-    float* mask = new float[xsize*ysize]; //mask will be owned
-    //copy the mask into the float array for the mask
-    rasterized_triangle->getBand()->RasterIO(GF_Read, 0, 0, xsize, ysize,
-                 mask, xsize, ysize, GDT_Float32,
-                 0, 0);
-
-    rasterized_triangle->setMask(mask);
-
-    //overwrite the band data (that has the mask) to be the dem data
-    float* dem = new float[xsize*ysize]; // triangle owns this now
-
-    r.getBand()->RasterIO(GF_Read, x1, y1, xsize, ysize,
-                                             dem, xsize, ysize, GDT_Float32,
-                                             0, 0);
-    rasterized_triangle->setBand(dem,xsize,ysize);
+    //make a window into the main extent
+    gt[0] = rgt[0] + (x_off * rgt[1]);
+    gt[1] = rgt[1];
+    gt[2] = 0.0;
+    gt[3] = rgt[3] + (y_off * rgt[5]);
+    gt[4] = 0.0;
+    gt[5] = rgt[5];
+
+    //vertexes in pixel space of the window
+    double px[3] = {(v0_in[0] - gt[0]) / gt[1], (v1_in[0] - gt[0]) / gt[1], (v2_in[0] - gt[0]) / gt[1]};
+    double py[3] = {(v0_in[1] - gt[3]) / gt[5], (v1_in[1] - gt[3]) / gt[5], (v2_in[1] - gt[3]) / gt[5]};
+
+    int row0 = std::max((int) std::floor(std::min(py[0], std::min(py[1], py[2]))), 0);
+    int row1 = std::min((int) std::floor(std::max(py[0], std::max(py[1], py[2]))), ysize - 1);
+
+    spans.assign(ysize, std::make_pair(0, -1));
+    for (int y = row0; y <= row1; y++)
+    {
+        double ylo = y;
+        double yhi = y + 1;
+
+        double xmin = std::numeric_limits<double>::infinity();
+        double xmax = -std::numeric_limits<double>::infinity();
+
+        //vertexes inside the strip
+        for (int i = 0; i < 3; i++)
+        {
+            if (py[i] >= ylo && py[i] <= yhi)
+            {
+                xmin = std::min(xmin, px[i]);
+                xmax = std::max(xmax, px[i]);
+            }
+        }
+
+        //each edge's crossing of the strip's top and bottom lines
+        for (int a = 0; a < 3; a++)
+        {
+            int b = (a + 1) % 3;
+            double dy = py[b] - py[a];
+            if (dy == 0)
+                continue;
+
+            for (double yl : {ylo, yhi})
+            {
+                if (yl >= std::min(py[a], py[b]) && yl <= std::max(py[a], py[b]))
+                {
+                    double xc = px[a] + (yl - py[a]) * (px[b] - px[a]) / dy;
+                    xmin = std::min(xmin, xc);
+                    xmax = std::max(xmax, xc);
+                }
+            }
+        }
+
+        if (xmin > xmax)
+            continue;
+
+        spans[y].first = std::max((int) std::floor(xmin), 0);
+        spans[y].second = std::min((int) std::floor(xmax), xsize - 1);
+    }
 
+    if (read_values)
+        this->read_values();
 
     double pz;
 
@@ -196,7 +152,7 @@ void triangle::make_rasterized(vertex v0_in, vertex v1_in, vertex v2_in, const r
     int is_nan_v[3]={0,0,0};
 
 
-    pz = rasterized_triangle->getXY(v0_in[0],v0_in[1]);
+    pz = getXY(v0_in[0],v0_in[1]);
     this->v0[0] = v0_in[0];
     this->v0[1] = v0_in[1];
     this->v0[2] = pz;
@@ -207,7 +163,7 @@ void triangle::make_rasterized(vertex v0_in, vertex v1_in, vertex v2_in, const r
     }
 
 
-    pz = rasterized_triangle->getXY(v1_in[0],v1_in[1]);
+    pz = getXY(v1_in[0],v1_in[1]);
     this->v1[0] = v1_in[0];
     this->v1[1] = v1_in[1];
     this->v1[2] = pz;
@@ -217,7 +173,7 @@ void triangle::make_rasterized(vertex v0_in, vertex v1_in, vertex v2_in, const r
     }
 
 
-    pz = rasterized_triangle->getXY(v2_in[0],v2_in[1]);
+    pz = getXY(v2_in[0],v2_in[1]);
     this->v2[0] = v2_in[0];
     this->v2[1] = v2_in[1];
     this->v2[2] = pz;
@@ -231,3 +187,153 @@ void triangle::make_rasterized(vertex v0_in, vertex v1_in, vertex v2_in, const r
     }
 
 }
+
+void triangle::read_values()
+{
+    if (!values.empty() || xsize == 0)
+        return;
+
+    //nodata is already nan
+    values.resize(xsize * ysize);
+    r->read_window(x_off, y_off, xsize, ysize, &values[0]);
+
+    //blank out the cells the triangle doesn't touch
+    for (int y = 0; y < ysize; y++)
+    {
+        for (int x = 0; x < xsize; x++)
+        {
+            if (x < spans[y].first || x > spans[y].second)
+                values[x + y * xsize] = nanf("");
+        }
+    }
+}
+
+// Bounds on |z - value| over the valid cells under the triangle, where z = -(a*x + b*y - d)/c is a plane in the
+// window's pixel space, from the raster's min/max pyramid. Over a block the plane's range is found from its corners,
+// so max(plane max - block min, block max - plane min) bounds the deviation of any cell in it. Blocks partly covered by
+// the triangle are refined down the pyramid while they could raise the upper bound. Only blocks wholly under the
+// triangle give a lower bound, as at least one of their valid cells is then under it.
+void triangle::plane_bounds(double a, double b, double c, double d, double& upper, double& lower) const
+{
+    upper = 0;
+    lower = 0;
+
+    //the coarsest level needed to cover the window with a few blocks
+    int level = 0;
+    while (level + 1 < r->pyramid_levels() && r->pyramid_block_size(level) < std::max(xsize, ysize))
+        level++;
+
+    int size = r->pyramid_block_size(level);
+    for (int by = y_off / size; by <= (y_off + ysize - 1) / size; by++)
+    {
+        for (int bx = x_off / size; bx <= (x_off + xsize - 1) / size; bx++)
+        {
+            plane_bounds_block(level, bx, by, a, b, c, d, upper, lower);
+        }
+    }
+}
+
+void triangle::plane_bounds_block(int level, int bx, int by, double a, double b, double c, double d,
+                                  double& upper, double& lower) const
+{
+    auto& block = r->pyramid_block(level, bx, by);
+    if (block.count == 0)
+        return; //all nodata
+
+    int size = r->pyramid_block_size(level);
+
+    //block extent in the window
+    int bx0 = bx * size - x_off;
+    int by0 = by * size - y_off;
+    int bx1 = std::min(bx0 + size, r->getDs()->GetRasterXSize() - x_off) - 1;
+    int by1 = std::min(by0 + size, r->getDs()->GetRasterYSize() - y_off) - 1;
+
+    int x0 = std::max(bx0, 0);
+    int y0 = std::max(by0, 0);
+    int x1 = std::min(bx1, xsize - 1);
+    int y1 = std::min(by1, ysize - 1);
+
+    bool touches = false;
+    bool inside = x0 == bx0 && y0 == by0 && x1 == bx1 && y1 == by1;
+    for (int y = y0; y <= y1; y++)
+    {
+        if (std::max(spans[y].first, x0) <= std::min(spans[y].second, x1))
+            touches = true;
+        if (spans[y].first > x0 || spans[y].second < x1)
+            inside = false;
+    }
+
+    if (!touches)
+        return;
+
+    double z[4] = {-(a * x0 + b * y0 - d) / c, -(a * x1 + b * y0 - d) / c,
+                   -(a * x0 + b * y1 - d) / c, -(a * x1 + b * y1 - d) / c};
+    double zmin = *std::min_element(z, z + 4);
+    double zmax = *std::max_element(z, z + 4);
+
+    double block_upper = std::max(zmax - block.min, block.max - zmin);
+
+    if (inside)
+    {
+        upper = std::max(upper, block_upper);
+        lower = std::max(lower, std::max(zmin - block.max, block.min - zmax));
+        return;
+    }
+
+    //can't be tightened any further, or wouldn't change the bound
+    if (level == 0 || block_upper <= upper)
+    {
+        upper = std::max(upper, block_upper);
+        return;
+    }
+
+    for (int cy = by * 2; cy <= by * 2 + 1 && cy < r->pyramid_ny(level - 1); cy++)
+    {
+        for (int cx = bx * 2; cx <= bx * 2 + 1 && cx < r->pyramid_nx(level - 1); cx++)
+        {
+            plane_bounds_block(level - 1, cx, cy, a, b, c, d, upper, lower);
+        }
+    }
+}
+
+double triangle::getXY(double x, double y) const
+{
+    auto pxpy = xy_to_pxpy(x,y);
+    return getpXpY(pxpy.first,pxpy.second);
+}
+
+std::pair<int,int> triangle::xy_to_pxpy(double x, double y) const
+{
+    int px = (int) ((x - gt[0]) / gt[1]);  // x pixel
+    int py = (int) ((y - gt[3]) / gt[5]);  // y pixel
+
+    //out of bound issue when we are off by one because of UTM -> pixel round off
+    if (px == xsize)
+        px = xsize - 1;
+
+    if (py == ysize)
+        py = ysize - 1;
+
+    if(py == -1)
+        py = 0;
+
+    if(px == -1)
+        px = 0;
+
+    return std::make_pair(px,py);
+}
+
+double triangle::getpXpY(int px, int py) const
+{
+    if (px < 0 || px >= xsize || py < 0 || py >= ysize)
+        return nan("");
+
+    if (values.empty())
+    {
+        if (px < spans[py].first || px > spans[py].second)
+            return nan("");
+        return r->getpXpY(x_off + px, y_off + py);
+    }
+
+    return values[px + py * xsize];
+}
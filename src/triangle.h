@@ -16,12 +16,7 @@
 #pragma once
 
 #include <utility>
-#include <boost/shared_ptr.hpp>
-
-#include <ogr_spatialref.h>
-#include <ogr_geometry.h>
-#include <gdal_alg.h>
-#include <ogrsf_frmts.h>
+#include <vector>
 
 #include <cmath>
 
@@ -33,18 +28,54 @@ class triangle
 {
 public:
     triangle();
-    void make_rasterized(vertex v0_in, vertex v1_in, vertex v2_in, const raster& r);
+    //read_values = false only computes the window and spans, the cell values are then looked up in the raster on demand
+    void make_rasterized(vertex v0_in, vertex v1_in, vertex v2_in, const raster& r, bool read_values = true);
+
+    //read the window's values if make_rasterized didn't
+    void read_values();
+
+    //conservative upper and lower bounds on |plane - value| over the valid cells under the triangle, from the raster's
+    //pyramid. The plane is z = -(a*x + b*y - d)/c in the window's pixel space
+    void plane_bounds(double a, double b, double c, double d, double& upper, double& lower) const;
 
+    //value of the cell under x,y
+    double getXY(double x, double y) const;
+
+    //value of the cell at px,py of the window, nan if the triangle doesn't touch it or it is nodata
+    double getpXpY(int px, int py) const;
+
+    //x,y to a pixel offset in the window
+    std::pair<int,int> xy_to_pxpy(double x, double y) const;
 
-    boost::shared_ptr<raster> rasterized_triangle;
     virtual ~triangle();
 
     bool is_nan;
 
+    //window of the raster under the triangle's bounding box
+    int x_off;
+    int y_off;
+    int xsize;
+    int ysize;
+
+    //the raster values of the window, row major. Cells the triangle doesn't touch and nodata are nan
+    std::vector<float> values;
+
+    //the raster this triangle was made from
+    const raster* r;
+
+    //first and last column of each row of the window touched by the triangle. Empty rows have first > second
+    std::vector< std::pair<int,int> > spans;
+
     //vertexes transformed to rasterized pixel offsets
     //x,y,z
     double v0[3];
     double v1[3];
     double v2[3];
-};
 
+private:
+    //geotransform of the window
+    double gt[6];
+
+    void plane_bounds_block(int level, int bx, int by, double a, double b, double c, double d,
+                            double& upper, double& lower) const;
+};
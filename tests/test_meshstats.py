@@ -0,0 +1,139 @@
+# Tests of meshstats.tri_stats against the per feature statistics meshstats computed before they were vectorized.
+# Run with pytest from the repository root.
+import math
+import os
+import sys
+
+import numpy as np
+from osgeo import gdal, ogr
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import meshstats
+
+nodata = -9999.
+
+
+# 20 x 20 raster of 2 m cells with its top left corner at (100, 200): a tilted plane with some noise, and a block of
+# nodata cells that the third triangle covers part of
+def make_raster():
+    rng = np.random.RandomState(42)
+    row, col = np.mgrid[0:20, 0:20]
+    array = (1000. + 3. * col - 2. * row + rng.normal(0., 1.5, (20, 20))).astype(np.float32)
+    array[9:11, 12:14] = nodata
+
+    ds = gdal.GetDriverByName('MEM').Create('', 20, 20, 1, gdal.GDT_Float32)
+    ds.SetGeoTransform((100., 2., 0., 200., 0., -2.))
+    band = ds.GetRasterBand(1)
+    band.SetNoDataValue(nodata)
+    band.WriteArray(array)
+    return ds
+
+
+# a large triangle, a thin one, one partly over nodata and a small one inside a single cell, which is degenerate once
+# its vertices are truncated to whole pixels. No vertex is on nodata or on a cell edge
+vertex = np.array([[103.3, 196.1], [131.7, 190.9], [109.1, 163.3],
+                   [111.5, 185.3], [135.9, 179.7], [112.7, 182.1],
+                   [120.3, 183.7], [133.1, 176.5], [121.9, 168.7],
+                   [127.2, 161.4], [127.9, 161.1], [127.5, 160.3]])
+elem = np.arange(len(vertex)).reshape(-1, 3)
+
+
+# The statistics of one triangle as the per feature version of meshstats computed them, one GDAL read per vertex and a
+# RasterizeLayer of the triangle over the window of its bounding box. Returns the angles, rmse and max difference, the
+# last two None if the triangle is degenerate in pixel space.
+def per_feature(raster_ds, tri):
+    gt = raster_ds.GetGeoTransform()
+    rb = raster_ds.GetRasterBand(1)
+
+    def extract_point(mx, my):
+        px = int((mx - gt[0]) / gt[1])
+        py = int((my - gt[3]) / gt[5])
+        return float(rb.ReadAsArray(px, py, 1, 1).flatten()[0])
+
+    (x1, y1), (x2, y2), (x3, y3) = tri
+    z1 = extract_point(x1, y1)
+    z2 = extract_point(x2, y2)
+    z3 = extract_point(x3, y3)
+
+    def angle(u, v):
+        return math.acos((u[0] * v[0] + u[1] * v[1]) / (math.hypot(*u) * math.hypot(*v))) * 180. / math.pi
+
+    angles = (angle((y3 - y1, x3 - x1), (y2 - y1, x2 - x1)),
+              angle((y1 - y3, x1 - x3), (y2 - y3, x2 - x3)),
+              angle((y1 - y2, x1 - x2), (y3 - y2, x3 - x2)))
+
+    # the window of the triangle's envelope, as bbox_to_pixel_offsets found it
+    wx1 = int((min(x1, x2, x3) - gt[0]) / gt[1])
+    wx2 = int((max(x1, x2, x3) - gt[0]) / gt[1]) + 1
+    wy1 = int((max(y1, y2, y3) - gt[3]) / gt[5])
+    wy2 = int((min(y1, y2, y3) - gt[3]) / gt[5]) + 1
+    xsize = min(wx2 - wx1, raster_ds.RasterXSize - wx1)
+    ysize = min(wy2 - wy1, raster_ds.RasterYSize - wy1)
+    src_array = rb.ReadAsArray(wx1, wy1, xsize, ysize)
+    new_gt = (gt[0] + wx1 * gt[1], gt[1], 0., gt[3] + wy1 * gt[5], 0., gt[5])
+
+    mem_ds = ogr.GetDriverByName('Memory').CreateDataSource('out')
+    mem_layer = mem_ds.CreateLayer('poly', None, ogr.wkbPolygon)
+    feature = ogr.Feature(mem_layer.GetLayerDefn())
+    feature.SetGeometry(ogr.CreateGeometryFromWkt('POLYGON ((%r %r, %r %r, %r %r, %r %r))' %
+                                                  (x1, y1, x2, y2, x3, y3, x1, y1)))
+    mem_layer.CreateFeature(feature)
+
+    rvds = gdal.GetDriverByName('MEM').Create('', xsize, ysize, 1, gdal.GDT_Byte)
+    rvds.SetGeoTransform(new_gt)
+    gdal.RasterizeLayer(rvds, [1], mem_layer, burn_values=[1], options=['ALL_TOUCHED=TRUE'])
+    rtri = np.ma.MaskedArray(src_array, mask=np.logical_or(src_array == nodata, np.logical_not(rvds.ReadAsArray())))
+
+    # vertices in the window's pixel space, as xyToPixel found them
+    def to_pixel(x, y):
+        px = min(max(int((x - new_gt[0]) / new_gt[1]), 0), xsize - 1)
+        py = min(max(int((y - new_gt[3]) / new_gt[5]), 0), ysize - 1)
+        return px, py
+
+    (x1, y1), (x2, y2), (x3, y3) = to_pixel(x1, y1), to_pixel(x2, y2), to_pixel(x3, y3)
+
+    u1, u2, u3 = x2 - x1, y2 - y1, z2 - z1
+    v1, v2, v3 = x3 - x1, y3 - y1, z3 - z1
+    a = u2 * v3 - v2 * u3
+    b = v1 * u3 - u1 * v3
+    c = u1 * v2 - v1 * u2
+    d = a * x1 + b * y1 + c * z1
+    if c == 0:
+        return angles, None, None
+
+    rmse = 0
+    n = 0
+    max_diff = -9999
+    for y in range(rtri.shape[0]):
+        for x in range(rtri.shape[1]):
+            if not np.ma.is_masked(rtri[y, x]):
+                diff = rtri[y, x] - -(a * x + b * y - d) / c
+                rmse += diff ** 2
+                n += 1
+                max_diff = max(max_diff, abs(diff))
+
+    return angles, math.sqrt(rmse / n), max_diff
+
+
+def test_tri_stats():
+    raster_ds = make_raster()
+    stats = meshstats.tri_stats(meshstats.load_raster(raster_ds), vertex, elem)
+
+    for i, tri in enumerate(elem):
+        angles, rmse, max_diff = per_feature(raster_ds, vertex[tri])
+        np.testing.assert_allclose(stats['angles'][i], angles)
+        if rmse is None:
+            assert np.isnan(stats['rmse'][i]) and np.isnan(stats['max_diff'][i])
+            continue
+        np.testing.assert_allclose(stats['rmse'][i], rmse)
+        np.testing.assert_allclose(stats['max_diff'][i], max_diff)
+
+
+# the same statistics from a window of the DEM that only covers the triangles
+def test_tri_stats_window():
+    raster_ds = make_raster()
+    whole = meshstats.tri_stats(meshstats.load_raster(raster_ds), vertex, elem)
+    window = meshstats.tri_stats(meshstats.load_raster(raster_ds, (1, 1, 18, 19)), vertex, elem)
+
+    for name in ['area', 'angles', 'rmse', 'max_diff']:
+        np.testing.assert_array_equal(window[name], whole[name])
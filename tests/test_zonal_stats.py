@@ -0,0 +1,111 @@
+# Tests of mesher.zonal_stats on a small in-memory raster. Run with pytest from the repository root.
+import os
+import sys
+
+import numpy as np
+from osgeo import gdal, ogr
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import mesher
+
+nodata = -9999.
+
+
+# 10 x 10 raster of 1 m cells with its top left corner at (0, 10). The left half is 2, except for a 7 at row 2, col 2,
+# and the right half is nodata
+def make_raster():
+    array = np.full((10, 10), nodata, dtype=np.float32)
+    array[:, 0:5] = 2
+    array[2, 2] = 7
+
+    ds = gdal.GetDriverByName('MEM').Create('', 10, 10, 1, gdal.GDT_Float32)
+    ds.SetGeoTransform((0., 1., 0., 10., 0., -1.))
+    band = ds.GetRasterBand(1)
+    band.SetNoDataValue(nodata)
+    band.WriteArray(array)
+    return ds
+
+
+# the triangles, in order: over valid cells (one of them the 7), only over nodata, outside the raster, and across the
+# edge of the nodata. In pixel space the first one is (1.5, 1.5), (3.7, 1.5), (1.5, 3.7), it touches the 8 cells of rows
+# and columns 1 to 3 but the one at row 3, col 3
+vertex = np.array([[1.5, 8.5], [3.7, 8.5], [1.5, 6.3],
+                   [6.5, 8.5], [8.5, 8.5], [6.5, 6.5],
+                   [20., 20.], [22., 20.], [20., 22.],
+                   [3.5, 3.5], [6.5, 3.5], [3.5, 1.5]])
+elem = np.arange(len(vertex)).reshape(-1, 3)
+
+
+def test_mode():
+    output = mesher.zonal_stats({'file': make_raster(), 'method': 'mode'}, vertex, elem)
+    np.testing.assert_array_equal(output, [2., nodata, nodata, 2.])
+
+
+def test_mean():
+    output = mesher.zonal_stats({'file': make_raster(), 'method': 'mean'}, vertex, elem)
+    assert output[0] == (7 * 2. + 7.) / 8
+    np.testing.assert_array_equal(output[1:], [nodata, nodata, 2.])
+
+
+# triangles without any valid cells get nodata whatever the method, and don't change the other triangles' values
+def test_no_valid_cells():
+    for method in ['mode', 'mean']:
+        alone = mesher.zonal_stats({'file': make_raster(), 'method': method}, vertex[9:12], elem[0:1])
+        together = mesher.zonal_stats({'file': make_raster(), 'method': method}, vertex, elem)
+        assert alone[0] == together[3]
+        assert together[1] == nodata
+        assert together[2] == nodata
+
+
+# triangles with their vertices and edges on the cell edges, or across them. The first is the whole top left cell, the
+# last two have their rightmost vertex on a column line and on a row line
+grid_vertex = np.array([[0., 10.], [1., 10.], [0., 9.],
+                        [2., 8.], [5., 8.], [2., 5.],
+                        [6., 9.], [9., 9.], [9., 6.],
+                        [0.5, 7.], [3.5, 7.], [2., 4.5],
+                        [6., 1.5], [6., 4.5], [8.5, 3.],
+                        [4., 6.], [7.5, 2.5], [4., 2.5],
+                        [7., 10.], [10., 10.], [10., 7.],
+                        [0.5, 7.], [3., 5.5], [0.5, 4.],
+                        [6.5, 3.5], [9.5, 1.], [8., 3.5]])
+grid_elem = np.arange(len(grid_vertex)).reshape(-1, 3)
+
+
+# The cells under each triangle as gdal.RasterizeLayer with ALL_TOUCHED=TRUE burns them, one triangle at a time
+def rasterized_masks(raster, vertex, elem):
+    masks = []
+    for tri in elem:
+        layer = ogr.GetDriverByName('Memory').CreateDataSource('out').CreateLayer('poly', None, ogr.wkbPolygon)
+        feature = ogr.Feature(layer.GetLayerDefn())
+        ring = [tuple(vertex[i]) for i in tri] + [tuple(vertex[tri[0]])]
+        feature.SetGeometry(ogr.CreateGeometryFromWkt('POLYGON ((%s))' % ', '.join('%r %r' % p for p in ring)))
+        layer.CreateFeature(feature)
+
+        ds = gdal.GetDriverByName('MEM').Create('', raster.RasterXSize, raster.RasterYSize, 1, gdal.GDT_Byte)
+        ds.SetGeoTransform(raster.GetGeoTransform())
+        gdal.RasterizeLayer(ds, [1], layer, burn_values=[1], options=['ALL_TOUCHED=TRUE'])
+        masks.append(ds.ReadAsArray() == 1)
+    return masks
+
+
+def test_triangle_cells_rasterize():
+    raster = make_raster()
+    masks = rasterized_masks(raster, grid_vertex, grid_elem)
+
+    cells = np.zeros((len(grid_elem), 10, 10), dtype=bool)
+    for tri, row, col in mesher.triangle_cells(raster.GetGeoTransform(), 10, 10, grid_vertex, grid_elem):
+        cells[tri, row, col] = True
+
+    for i in range(len(grid_elem)):
+        np.testing.assert_array_equal(cells[i], masks[i], 'triangle %d' % i)
+
+
+# zonal_stats of a raster where every cell has its own value against the mean of the rasterized cells
+def test_mean_rasterize():
+    raster = make_raster()
+    array = np.arange(100, dtype=np.float32).reshape(10, 10)
+    raster.GetRasterBand(1).WriteArray(array)
+
+    output = mesher.zonal_stats({'file': raster, 'method': 'mean'}, grid_vertex, grid_elem)
+    expected = [array[mask].mean() for mask in rasterized_masks(raster, grid_vertex, grid_elem)]
+    np.testing.assert_allclose(output, expected)